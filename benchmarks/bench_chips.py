@@ -0,0 +1,55 @@
+"""
+ Benchmark of random chip reads of ChipDataset over processed rasters
+
+    python -m benchmarks.bench_chips --size 5490 --rasters 4 --chip 256 --reads 5000
+"""
+import os
+import time
+import argparse
+import tempfile
+import numpy as np
+from code.tx import band_stack, build_profile
+from code.chip_dataset import ChipDataset
+from benchmarks.synthetic import write_bands
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=int, default=5490, help='raster width and height in pixels')
+    parser.add_argument('--rasters', type=int, default=4, help='number of processed rasters')
+    parser.add_argument('--chip', type=int, default=256, help='chip width and height in pixels')
+    parser.add_argument('--reads', type=int, default=5000, help='number of random chip reads')
+    parser.add_argument('--batch', type=int, default=64, help='chips per batched read')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        bands = write_bands(folder, args.size, ['B02', 'B03', 'B04', 'B08'])
+        rasters = [band_stack(bands, os.path.join(folder, f"product_{i}.tif"), normalize=True,
+                              profile=build_profile('cog')) for i in range(args.rasters)]
+        start = time.perf_counter()
+        dataset = ChipDataset(rasters, chip_size=args.chip, index_path=os.path.join(folder, 'chips.npz'))
+        print(f"index of {len(dataset)} chips built in {time.perf_counter() - start:.2f} s")
+        start = time.perf_counter()
+        ChipDataset(rasters, chip_size=args.chip, index_path=os.path.join(folder, 'chips.npz'))
+        print(f"index reloaded in {time.perf_counter() - start:.3f} s")
+
+        rng = np.random.default_rng(0)
+        indices = rng.integers(0, len(dataset), args.reads)
+        start = time.perf_counter()
+        for idx in indices:
+            dataset[int(idx)]
+        seconds = time.perf_counter() - start
+        print(f"single reads: {args.reads / seconds:,.0f} chips/s")
+
+        out = np.empty((args.batch, dataset.count, args.chip, args.chip), dtype=dataset.dtype)
+        start = time.perf_counter()
+        for i in range(0, args.reads, args.batch):
+            batch = indices[i:i + args.batch]
+            dataset.read_batch(batch, out=out[:len(batch)])
+        seconds = time.perf_counter() - start
+        print(f"batched reads: {args.reads / seconds:,.0f} chips/s")
+        dataset.close()
+
+
+if __name__ == '__main__':
+    main()
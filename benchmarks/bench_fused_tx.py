@@ -0,0 +1,71 @@
+"""
+ Benchmark of the fused stack -> clip -> reproject pass against the chain of intermediate GeoTIFFs
+
+    python -m benchmarks.bench_fused_tx --size 5490 --fraction 0.1
+    python -m benchmarks.bench_fused_tx --size 5490 --mixed --resampling bilinear
+    python -m benchmarks.bench_fused_tx --size 10980 --reproject --threads 8 --warp-threads 2
+"""
+import os
+import time
+import argparse
+import tempfile
+from code.tx import Tx
+from benchmarks.synthetic import write_bands, aoi_gdf
+
+
+def io_counters()->dict:
+    """Bytes read and written by this process (Linux only)."""
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(': ') for line in f.read().splitlines())
+        return {'read': int(counters['rchar']), 'write': int(counters['wchar'])}
+    except OSError:
+        return {'read': 0, 'write': 0}
+
+
+def run(sample, folder, gdf, fused, reproject_4326, resampling='nearest', num_threads=4, warp=None):
+    out_dir = tempfile.mkdtemp(dir=folder)
+    tx = Tx(sample, uuid='bench', local_dir=out_dir, tile='31TCJ', date='2023-06-01', format='UINT8',
+            reproject_4326=reproject_4326, fused=fused, resampling=resampling, num_threads=num_threads, warp=warp)
+    before, start = io_counters(), time.perf_counter()
+    if gdf is None:
+        tx.etl_process_tile(out_dir)
+    else:
+        tx.etl_process_by_polygon(out_dir, gdf.to_crs('EPSG:32631'))
+    seconds = time.perf_counter() - start
+    after = io_counters()
+    return {'seconds': seconds,
+            'read_mb': (after['read'] - before['read']) / 1e6,
+            'write_mb': (after['write'] - before['write']) / 1e6,
+            'output_mb': os.path.getsize(os.path.join(out_dir, 'bench.tif')) / 1e6}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=int, default=5490, help='band width and height in pixels')
+    parser.add_argument('--fraction', type=float, default=0.1, help='AOI width as a fraction of the tile width')
+    parser.add_argument('--reproject', action='store_true', help='reproject the output to EPSG:4326')
+    parser.add_argument('--mixed', action='store_true', help='add the 20 m bands B05 B11 B12 to the 10 m bands')
+    parser.add_argument('--resampling', default='nearest', help='resampling of the 20 m bands and of the warp')
+    parser.add_argument('--threads', type=int, default=4, help='decoding and warped block threads')
+    parser.add_argument('--warp-threads', type=int, default=1, help='GDAL warp threads per block')
+    parser.add_argument('--warp-mem', type=int, default=64, help='GDAL warp memory limit in MB')
+    parser.add_argument('--warp-resolution', type=float, default=None, help='EPSG:4326 resolution in degrees')
+    args = parser.parse_args()
+    warp = {'resolution': args.warp_resolution, 'warp_threads': args.warp_threads, 'warp_mem_limit': args.warp_mem}
+
+    with tempfile.TemporaryDirectory() as folder:
+        sample = write_bands(folder, args.size, ['B02', 'B03', 'B04', 'B08'])
+        if args.mixed:
+            sample += write_bands(folder, args.size // 2, ['B05', 'B11', 'B12'], resolution=20)
+        gdf = aoi_gdf(args.size, fraction=args.fraction)
+        print(f"{'mode':<10}{'aoi':<6}{'seconds':>10}{'read MB':>10}{'write MB':>10}{'output MB':>11}")
+        for aoi in (None, gdf):
+            for fused in (False, True):
+                r = run(sample, folder, aoi, fused, args.reproject, args.resampling, args.threads, warp)
+                print(f"{'fused' if fused else 'chain':<10}{'yes' if aoi is not None else 'no':<6}"
+                      f"{r['seconds']:>10.2f}{r['read_mb']:>10.1f}{r['write_mb']:>10.1f}{r['output_mb']:>11.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""
+ Benchmark of the output profiles: write time, file size and random window read latency
+
+    python -m benchmarks.bench_output_profiles --size 5490 --reads 200
+"""
+import os
+import time
+import argparse
+import tempfile
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+from code.tx import band_stack, build_profile
+from benchmarks.synthetic import write_bands
+
+PROFILES = {
+    'gtiff': build_profile('gtiff'),
+    'cog-deflate': build_profile('cog', compress='deflate'),
+    'cog-zstd': build_profile('cog', compress='zstd'),
+    'cog-lzw': build_profile('cog', compress='lzw'),
+}
+
+
+def random_reads(path:str, reads:int, window_size:int, seed:int=0)->float:
+    """Median latency in milliseconds of reading random windows of all bands."""
+    rng = np.random.default_rng(seed)
+    latencies = []
+    with rasterio.open(path) as src:
+        for _ in range(reads):
+            col = int(rng.integers(0, src.width - window_size))
+            row = int(rng.integers(0, src.height - window_size))
+            start = time.perf_counter()
+            src.read(window=Window(col, row, window_size, window_size))
+            latencies.append(time.perf_counter() - start)
+    return float(np.median(latencies) * 1000)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=int, default=5490, help='band width and height in pixels')
+    parser.add_argument('--reads', type=int, default=200, help='number of random window reads')
+    parser.add_argument('--window', type=int, default=256, help='window width and height in pixels')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        sample = write_bands(folder, args.size, ['B02', 'B03', 'B04', 'B08'])
+        print(f"{'profile':<14}{'write s':>10}{'size MB':>10}{'read ms':>10}")
+        for name, profile in PROFILES.items():
+            output_img = os.path.join(folder, f"{name}.tif")
+            start = time.perf_counter()
+            band_stack(sample, output_img, normalize=True, profile=profile)
+            seconds = time.perf_counter() - start
+            size = os.path.getsize(output_img) / 1e6
+            print(f"{name:<14}{seconds:>10.2f}{size:>10.1f}{random_reads(output_img, args.reads, args.window):>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+"""
+ Offline benchmark of search, download, transforms and AreaDataset iteration against a mock CopernicusHub
+
+    python -m benchmarks.bench_pipeline --sizes 1098 2745 --workers 1 4 --output bench.json
+
+Results are written as JSON, one record per (size, workers, stage), to compare commits.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import datetime
+import tempfile
+import subprocess
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+import numpy as np
+import geopandas as gpd
+from omegaconf import OmegaConf, DictConfig
+from code.tx import (normilize_s2, band_stack, fused_stack, clip_by_polygon, reproject_to_wgs84, mosaic_images,
+                     build_profile)
+from code.imagery_store import operator_from_config, warp_options
+from benchmarks.mock_hub import MockHub
+from benchmarks.synthetic import aoi_gdf
+
+ROOT = Path(__file__).resolve().parents[1]
+# The dataset module imports its siblings without the package prefix
+sys.path.append(str(ROOT / 'code'))
+
+TILES = ['31TCJ', '31TDJ', '31TCH', '31TDH']
+
+
+def measure(fn:Callable, repeat:int=1, setup:Optional[Callable]=None)->Dict:
+    """Median and best wall time of repeat calls of fn, setup runs untimed before each call"""
+    seconds = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        fn()
+        seconds.append(time.perf_counter() - start)
+    return {'seconds': float(np.median(seconds)), 'best_seconds': float(min(seconds)), 'repeat': repeat}
+
+
+def git_commit()->Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_config(hub:MockHub, folder:str, workers:int, dates:List[str])->DictConfig:
+    """Configuration of the repository pointed at the mock hub, with caches in folder"""
+    cfg = OmegaConf.load(ROOT / 'conf' / 'config.yaml')
+    imagery = cfg.imagery
+    imagery.api_url, imagery.api_id, imagery.api_secret = hub.api_url, 'bench', 'bench'
+    imagery.start_date, imagery.end_date = min(dates), f"{max(dates)}T23:59:59"
+    imagery.cloud_coverage_max = 100.0
+    imagery.session.token_url = hub.token_url
+    imagery.session.backoff_factor = 0.0
+    imagery.download.max_workers = workers
+    imagery.session.pool_size = max(imagery.session.pool_size, workers)
+    imagery.band_cache.dir = os.path.join(folder, 'bands')
+    imagery.catalogue.db = os.path.join(folder, 'catalogue.sqlite')
+    imagery.manifest.db = os.path.join(folder, 'manifest.sqlite')
+    imagery.local_index.db = os.path.join(folder, 'rasters.sqlite')
+    imagery.sink.zarr_dir = os.path.join(folder, 'cube')
+    return cfg
+
+
+def bench_operator(hub:MockHub, cfg:DictConfig, folder:str, aoi:gpd.GeoDataFrame, repeat:int)->Dict[str, Dict]:
+    imagery = cfg.imagery
+    operator = operator_from_config(imagery, Path(folder) / 'operator')
+    operator.bbox_aoi = aoi.geometry.iloc[0]
+    operator.bands = imagery.bands
+
+    def search():
+        operator.candidates_query = None
+        operator.select_product_by_tile(api_url=imagery.api_url, start_date=str(imagery.start_date),
+                                        end_date=str(imagery.end_date), platform_name=imagery.platform_name,
+                                        product_type=imagery.product_type, tile_id=TILES[0],
+                                        cloud_coverage_max=imagery.cloud_coverage_max)
+
+    def clear_catalogue():
+        operator.catalogue.conn.executescript("DELETE FROM searches; DELETE FROM search_products;")
+
+    results = {'select_product_by_tile': measure(search, repeat, setup=clear_catalogue),
+               'select_product_by_tile_cached': measure(search, repeat)}
+    product = dict(operator.product)
+    local_dir = os.path.join(folder, 'download')
+    os.makedirs(local_dir, exist_ok=True)
+    sample = []
+
+    def download():
+        operator.product = dict(product)
+        sample[:] = operator.download_product(product['uuid'], product['name'], int(imagery.resolution), local_dir)
+
+    hub.reset_stats()
+    results['download_product'] = measure(download, repeat,
+                                          setup=lambda: shutil.rmtree(imagery.band_cache.dir, ignore_errors=True))
+    results['download_product'].update({'bytes': hub.stats['bytes'] // repeat, 'http_requests': hub.stats['requests'],
+                                        'throttled': hub.stats['throttled']})
+    results['download_product_cached'] = measure(download, repeat)
+    results['sample'] = sorted(sample)
+    return results
+
+
+def bench_tx(sample:List[str], folder:str, aoi:gpd.GeoDataFrame, cfg:DictConfig, repeat:int)->Dict[str, Dict]:
+    transform = cfg.imagery.transform
+    profile = build_profile(**cfg.imagery.output)
+    out = lambda name: os.path.join(folder, name)
+    gdf = aoi.to_crs('EPSG:32631')
+    array = np.random.default_rng(0).integers(0, 10000, (len(sample), 1024, 1024), dtype=np.uint16)
+    results = {
+        'normilize_s2': measure(lambda: normilize_s2(array), repeat),
+        'band_stack': measure(lambda: band_stack(sample, out('stack.tif'), normalize=True,
+                                                 block_size=transform.block_size, num_threads=transform.num_threads,
+                                                 profile=profile), repeat),
+        'clip_by_polygon': measure(lambda: clip_by_polygon(out('stack.tif'), gdf, out('clip.tif'), profile=profile),
+                                   repeat),
+        'reproject_to_wgs84': measure(lambda: reproject_to_wgs84(out('stack.tif'), out('wgs84.tif'), profile=profile,
+                                                                 resampling=transform.resampling,
+                                                                 block_size=transform.block_size,
+                                                                 num_threads=transform.num_threads,
+                                                                 **warp_options(transform.warp)), repeat),
+        'mosaic_images': measure(lambda: mosaic_images([out('stack.tif'), out('clip.tif')], out('mosaic.tif'),
+                                                       profile=profile), repeat),
+        'fused_stack': measure(lambda: fused_stack(sample, out('fused.tif'), normalize=True, gdf=gdf,
+                                                   dst_crs='epsg:4326', block_size=transform.block_size,
+                                                   num_threads=transform.num_threads, profile=profile,
+                                                   **warp_options(transform.warp)), repeat),
+    }
+    results['normilize_s2']['pixels'] = int(array.size)
+    return results
+
+
+def bench_dataset(hub:MockHub, cfg:DictConfig, folder:str, aoi:gpd.GeoDataFrame, tiles:List[str])->Dict:
+    """Cold end-to-end iteration of an AreaDataset with one area per tile"""
+    from code.dataset import AreaDataset
+    areas = gpd.GeoDataFrame({'tile_id': tiles}, geometry=[aoi.geometry.iloc[0]] * len(tiles), crs='epsg:4326')
+    hub.reset_stats()
+    start = time.perf_counter()
+    dataset = AreaDataset(area_descriptor=areas, imagery_directory=os.path.join(folder, 'imagery'),
+                          config=cfg.imagery)
+    products = [dataset[idx] for idx in range(len(dataset))]
+    seconds = time.perf_counter() - start
+    return {'seconds': seconds, 'areas': len(tiles), 'products': sum(len(p) > 0 for p in products),
+            'areas_per_hour': len(tiles) / seconds * 3600, 'bytes': hub.stats['bytes'],
+            'http_requests': hub.stats['requests'], 'throttled': hub.stats['throttled'],
+            'logins': hub.stats['logins']}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1098], help='10 m band widths in pixels')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4], help='download concurrency levels')
+    parser.add_argument('--tiles', type=int, default=2, help='number of tiles of the AreaDataset run')
+    parser.add_argument('--dates', type=int, default=3, help='products per tile')
+    parser.add_argument('--driver', default='GTiff', help='band driver: GTiff or JP2OpenJPEG')
+    parser.add_argument('--throttle-every', type=int, default=0, help='answer every n-th request with a 429')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    parser.add_argument('--fraction', type=float, default=0.1, help='AOI width as a fraction of the tile width')
+    parser.add_argument('--repeat', type=int, default=3, help='timed repetitions of each stage')
+    parser.add_argument('--output', default='bench_pipeline.json', help='JSON results file')
+    args = parser.parse_args()
+
+    tiles = TILES[:max(1, min(args.tiles, len(TILES)))]
+    dates = [str(datetime.date(2023, 6, 1) + datetime.timedelta(days=5 * i)) for i in range(args.dates)]
+    records = []
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as folder:
+            aoi = aoi_gdf(size, fraction=args.fraction)
+            with MockHub(folder, tiles, dates, size=size, driver=args.driver,
+                         throttle_every=args.throttle_every, latency=args.latency) as hub:
+                for workers in args.workers:
+                    run_dir = tempfile.mkdtemp(dir=folder)
+                    cfg = bench_config(hub, run_dir, workers, dates)
+                    operator = bench_operator(hub, cfg, run_dir, aoi, args.repeat)
+                    sample = operator.pop('sample')
+                    stages = dict(operator)
+                    stages.update(bench_tx(sample, run_dir, aoi, cfg, args.repeat))
+                    cfg = bench_config(hub, tempfile.mkdtemp(dir=folder), workers, dates)
+                    stages['area_dataset'] = bench_dataset(hub, cfg, run_dir, aoi, tiles)
+                    for stage, result in stages.items():
+                        records.append({'size': size, 'workers': workers, 'stage': stage, **result})
+                        print(f"size {size:>6} workers {workers:>2} {stage:<32}{result['seconds']:>10.3f} s")
+
+    report = {'commit': git_commit(),
+              'created': datetime.datetime.now().isoformat(timespec='seconds'),
+              'python': platform.python_version(),
+              'machine': platform.machine(),
+              'cpus': os.cpu_count(),
+              'args': vars(args),
+              'results': records}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+"""
+ Benchmark of the radiometric stage on blocks of a 10 m band, in input GB/s on one core
+
+    python -m benchmarks.bench_radiometry --size 10980 --block 1024
+"""
+import time
+import argparse
+import numpy as np
+from code.tx import normilize_s2
+from code.radiometry import Radiometry
+
+
+def throughput(fn, blocks, repeat):
+    """Best input GB/s of repeat passes of fn over the blocks"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for block in blocks:
+            fn(block)
+        best = min(best, time.perf_counter() - start)
+    return sum(block.nbytes for block in blocks) / best / 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=int, default=10980, help='band width and height in pixels')
+    parser.add_argument('--block', type=int, default=1024, help='block width and height in pixels')
+    parser.add_argument('--repeat', type=int, default=3, help='timed passes over the band')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    band = rng.integers(0, 12000, (args.size, args.size), dtype=np.uint16)
+    band[:, :args.size // 10] = 0
+    blocks = [np.ascontiguousarray(band[row:row + args.block, col:col + args.block])
+              for row in range(0, args.size, args.block) for col in range(0, args.size, args.block)]
+    offsets = {'B04': -1000}
+    print(f"{'mapping':<36}{'GB/s':>8}")
+    print(f"{'normilize_s2 (uint8 table)':<36}{throughput(normilize_s2, blocks, args.repeat):>8.2f}")
+    for dtype in ('uint8', 'uint16', 'float32'):
+        # The percentile stretch is a fixed stretch once the percentiles of the band are known
+        for stretch in ('none', 'fixed'):
+            mapping = Radiometry(dtype=dtype, boa_offsets=offsets, stretch=stretch).mapping('B04')
+            print(f"{f'{dtype} {stretch} (table)':<36}{throughput(mapping, blocks, args.repeat):>8.2f}")
+        # Blocks of another dtype go through the float32 path
+        floats = [block.astype(np.int32) for block in blocks[:len(blocks) // 4]]
+        mapping = Radiometry(dtype=dtype, boa_offsets=offsets).mapping('B04')
+        print(f"{f'{dtype} fixed (float32 from int32)':<36}{throughput(mapping, floats, args.repeat):>8.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""
+ Benchmark of AOI -> MGRS tile lookup and footprint ranking
+
+    python -m benchmarks.bench_tile_index --aois 5000
+"""
+import time
+import argparse
+import numpy as np
+import geopandas as gpd
+from shapely.geometry import box
+from code.tile_index import TileIndex, coverage_ratio
+
+
+def synthetic_grid(step:float=0.9)->gpd.GeoDataFrame:
+    """World grid of overlapping ~110 km tiles, about as many as the S2 grid"""
+    xs, ys = np.meshgrid(np.arange(-180, 180, step * 0.9), np.arange(-80, 84, step * 0.9))
+    geoms = [box(x, y, x + step, y + step) for x, y in zip(xs.ravel(), ys.ravel())]
+    return gpd.GeoDataFrame({'tile_id': [f"T{i:06d}" for i in range(len(geoms))]}, geometry=geoms, crs='epsg:4326')
+
+
+def random_aois(n:int, seed:int=0)->np.ndarray:
+    rng = np.random.default_rng(seed)
+    x, y = rng.uniform(-179, 179, n), rng.uniform(-79, 82, n)
+    size = rng.uniform(0.05, 0.5, n)
+    return np.array([box(*b) for b in zip(x, y, x + size, y + size)])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--aois', type=int, default=5000, help='number of random AOIs')
+    parser.add_argument('--naive', type=int, default=50, help='number of AOIs for the naive baselines')
+    args = parser.parse_args()
+
+    grid = synthetic_grid()
+    aois = random_aois(args.aois)
+
+    start = time.perf_counter()
+    index = TileIndex(grid)
+    build = time.perf_counter() - start
+    start = time.perf_counter()
+    pairs = index.query_bulk(aois)
+    bulk = time.perf_counter() - start
+    print(f"{len(grid)} tiles, index built in {build * 1000:.0f} ms")
+    print(f"STRtree lookup: {args.aois} AOIs -> {len(pairs)} tiles in {bulk * 1000:.1f} ms "
+          f"({bulk / args.aois * 1e6:.1f} us/AOI)")
+
+    start = time.perf_counter()
+    for aoi in aois[:args.naive]:
+        grid[grid.intersects(aoi)]
+    naive = (time.perf_counter() - start) / args.naive
+    print(f"GeoDataFrame.intersects scan: {naive * 1e6:.1f} us/AOI")
+
+    # Ranking of the candidates of one tile against the AOI
+    candidates = grid.iloc[index.tree.query(aois[0].buffer(1.0))].reset_index(drop=True)
+    aoi = gpd.GeoDataFrame(geometry=[aois[0]], crs='epsg:4326')
+    start = time.perf_counter()
+    for _ in range(args.naive):
+        joined = gpd.overlay(df1=candidates, df2=aoi.assign(area_aoi=aoi.area), how='union')
+        joined['area_ratio'] = joined.area / joined['area_aoi']
+        joined.groupby('tile_id').agg({'area_ratio': 'sum'})
+    overlay = (time.perf_counter() - start) / args.naive
+    start = time.perf_counter()
+    for _ in range(args.naive):
+        coverage_ratio(candidates.geometry.to_numpy(), aois[0])
+    vectorized = (time.perf_counter() - start) / args.naive
+    print(f"Ranking {len(candidates)} footprints: overlay {overlay * 1000:.2f} ms, "
+          f"vectorized {vectorized * 1000:.3f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""
+ Checks of the windowed remote reads of code/remote_reader.py against the mock CopernicusHub
+
+    python -m benchmarks.check_remote_reader --size 1098 --fraction 0.1
+
+Every check raises AssertionError on failure and prints its name when it passes.
+"""
+import os
+import argparse
+import tempfile
+import numpy as np
+import rasterio
+import requests
+from omegaconf import OmegaConf
+from rasterio.features import geometry_window
+from rasterio.warp import transform_geom
+from shapely.geometry import mapping
+from code.imagery_store import operator_from_config
+from code.remote_reader import read_window, resolve_url
+from benchmarks.bench_pipeline import bench_config, ROOT, TILES
+from benchmarks.mock_hub import MockHub
+from benchmarks.synthetic import aoi_gdf
+
+DATES = ['2023-06-01']
+HEADERS = {'Authorization': 'Bearer check'}
+
+
+def check(name:str, condition:bool, detail:str=''):
+    assert condition, f"{name} failed {detail}"
+    print(f"ok  {name}")
+
+
+def band_url(hub:MockHub, band:str='B02', resolution:int=10)->str:
+    product_id, product = next(iter(hub.products.items()))
+    return f"{hub.api_url}/Products({product_id})/Nodes({product['Name']}_{band}_{resolution}m.jp2)/$value"
+
+
+def local_window(path:str, aoi)->np.ndarray:
+    with rasterio.open(path) as src:
+        window = geometry_window(src, [transform_geom('epsg:4326', src.crs, mapping(aoi))])
+        return src.read(window=window)
+
+
+def band_bytes(hub:MockHub, bands:list, resolution:int=10)->int:
+    """Size of the full files of the bands"""
+    return sum(os.path.getsize(hub.bands[(band, resolution)]) for band in bands)
+
+
+def download(hub:MockHub, folder:str, aoi)->list:
+    """Bands of the first product downloaded by an operator with partial reads"""
+    cfg = bench_config(hub, folder, workers=2, dates=DATES)
+    cfg.imagery.download.partial_read = True
+    imagery = cfg.imagery
+    operator = operator_from_config(imagery, os.path.join(folder, 'operator'))
+    operator.bbox_aoi = aoi
+    operator.bands = imagery.bands
+    operator.select_product_by_tile(api_url=imagery.api_url, start_date=str(imagery.start_date),
+                                    end_date=str(imagery.end_date), platform_name=imagery.platform_name,
+                                    product_type=imagery.product_type, tile_id=TILES[0],
+                                    cloud_coverage_max=imagery.cloud_coverage_max)
+    product = operator.product
+    local_dir = os.path.join(folder, 'download')
+    os.makedirs(local_dir, exist_ok=True)
+    return operator.download_product(product['uuid'], product['name'], int(imagery.resolution), local_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=int, default=1098, help='pixels of the 10 m bands')
+    parser.add_argument('--fraction', type=float, default=0.1, help='width of the AOI relative to the tile')
+    args = parser.parse_args()
+    aoi = aoi_gdf(args.size, fraction=args.fraction).geometry.iloc[0]
+    bands = list(OmegaConf.load(ROOT / 'conf' / 'config.yaml').imagery.bands)
+    session = requests.Session()
+    session.headers.update(HEADERS)
+
+    with tempfile.TemporaryDirectory() as folder, \
+            MockHub(os.path.join(folder, 'hub'), tiles=TILES[:1], dates=DATES, size=args.size) as hub:
+        band = hub.bands[('B02', 10)]
+        url, ranges = resolve_url(session, band_url(hub))
+        check('redirect resolved to a range-serving location', ranges and '/zipper/' in url)
+
+        hub.reset_stats()
+        window = read_window(url, aoi, os.path.join(folder, 'window.tif'), headers=HEADERS)
+        with rasterio.open(window) as src:
+            data = src.read()
+        check('window read over HTTP matches the local window', np.array_equal(data, local_window(band, aoi)))
+        check('only the window bytes are fetched', 0 < hub.stats['bytes'] < os.path.getsize(band),
+              f"({hub.stats['bytes']} of {os.path.getsize(band)} bytes)")
+
+        hub.reset_stats()
+        sample = download(hub, os.path.join(folder, 'ranges'), aoi)
+        full = band_bytes(hub, bands)
+        check('partial read of the product bands', len(sample) == len(bands) and hub.stats['bytes'] < full,
+              f"({hub.stats['bytes']} of {full} bytes served)")
+
+    with tempfile.TemporaryDirectory() as folder, \
+            MockHub(os.path.join(folder, 'hub'), tiles=TILES[:1], dates=DATES, size=args.size, ranges=False) as hub:
+        _, ranges = resolve_url(session, band_url(hub))
+        check('server without range support detected', not ranges)
+
+        hub.reset_stats()
+        sample = download(hub, folder, aoi)
+        full = band_bytes(hub, bands)
+        check('full download fallback without range support', len(sample) == len(bands) and hub.stats['bytes'] >= full,
+              f"({hub.stats['bytes']} of {full} bytes served)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""
+ Checks of the resumed, locked downloads of code/transfer.py against the mock CopernicusHub
+
+    python -m benchmarks.check_transfer --size 1098 --threads 8
+
+Every check raises AssertionError on failure and prints its name when it passes.
+"""
+import os
+import argparse
+import tempfile
+import threading
+from pathlib import Path
+import requests
+from code.band_cache import BandCache
+from code.transfer import download_file, download_bytes
+from benchmarks.mock_hub import MockHub, FILE_PATH
+
+
+def bearer_session()->requests.Session:
+    session = requests.Session()
+    session.headers['Authorization'] = 'Bearer check'
+    return session
+
+
+def check(name:str, condition:bool, detail:str=''):
+    assert condition, f"{name} failed {detail}"
+    print(f"ok  {name}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=int, default=1098, help='pixels of the 10 m bands')
+    parser.add_argument('--threads', type=int, default=8, help='concurrent downloads of the same file')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder, \
+            MockHub(folder, tiles=['31TCJ'], dates=['2023-06-01'], size=args.size) as hub:
+        product_id, product = next(iter(hub.products.items()))
+        node = f"{product['Name']}_B02_10m.jp2"
+        url = f"{hub.url}{FILE_PATH}/{product_id}/{node}"
+        with open(hub.file(product_id, node), 'rb') as f:
+            content = f.read()
+        cache = Path(folder) / 'cache' / product_id
+        cache.mkdir(parents=True)
+        target = cache / 'B02_10m.jp2'
+        part = target.with_name(target.name + '.part')
+
+        def fetch()->bytes:
+            if target.exists():
+                target.unlink()
+            download_file(bearer_session, url, str(target))
+            return target.read_bytes()
+
+        hub.reset_stats()
+        check('full download', fetch() == content and hub.stats['bytes'] == len(content))
+
+        # Resume: only the missing tail is requested
+        part.write_bytes(content[:len(content) // 2])
+        hub.reset_stats()
+        data = fetch()
+        check('resume from a part file', data == content and hub.stats['bytes'] == len(content) - len(content) // 2,
+              f"({hub.stats['bytes']} bytes served)")
+
+        # 416 with a part file holding the whole content
+        part.write_bytes(content)
+        hub.reset_stats()
+        check('416 on a complete part file', fetch() == content and hub.stats['bytes'] == 0)
+
+        # 416 with a stale part file longer than the remote file: restarted from 0
+        part.write_bytes(content + b'stale')
+        hub.reset_stats()
+        check('416 on an oversized part file', fetch() == content and hub.stats['bytes'] == len(content))
+
+        check('in-memory download', download_bytes(bearer_session, url) == content)
+
+        # Concurrent downloads of the same target: one transfer, the others reuse its file
+        target.unlink()
+        hub.reset_stats()
+        results, errors = [], []
+
+        def concurrent():
+            try:
+                results.append(download_file(bearer_session, url, str(target)))
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=concurrent) for _ in range(args.threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        check('locked concurrent downloads', not errors and target.read_bytes() == content
+              and hub.stats['bytes'] == len(content) and sum(r['bytes'] > 0 for r in results) == 1,
+              f"({hub.stats['bytes']} bytes served, errors {errors})")
+
+        # Eviction leaves the locks and part files of the transfers alone
+        part.write_bytes(b'in flight')
+        BandCache(Path(folder) / 'cache', max_size=0).evict()
+        check('eviction keeps lock and part files',
+              not target.exists() and part.exists() and target.with_name(target.name + '.lock').exists())
+        os.remove(part)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,258 @@
+"""
+ Local stand-in of the CopernicusHub OData catalogue, download service and identity endpoint
+"""
+import os
+import re
+import json
+import time
+import uuid
+import datetime
+import threading
+from typing import Dict, List, Optional
+from urllib.parse import urlsplit, parse_qs, unquote
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from shapely.geometry import mapping
+from benchmarks.synthetic import (S2_L2A_BANDS, product_name, mtd_xml, write_band, write_scl, tile_footprint)
+
+TOKEN_PATH = '/auth/realms/CDSE/protocol/openid-connect/token'
+ODATA_PATH = '/odata/v1'
+FILE_PATH = '/zipper'
+
+
+class MockHub():
+    """Serve synthetic L2A products of the given tiles over HTTP on 127.0.0.1.
+
+    Catalogue searches are answered from the products (tileId, dates, cloud cover and
+    PublicationDate filters, $top/$skip/$count paging or @odata.nextLink), `$value` nodes are
+    redirected to the file service which serves HTTP Range requests. Every `throttle_every`-th
+    catalogue or file request is answered with 429 and Retry-After, `latency` seconds are
+    added to every response. Bands of all products share the same synthetic rasters.
+    """
+    def __init__(self, folder:str, tiles:List[str], dates:List[str], size:int=1098, driver:str='GTiff',
+                 throttle_every:int=0, latency:float=0.0, ranges:bool=True):
+        self.folder = folder
+        self.size = size
+        self.throttle_every = throttle_every
+        self.latency = latency
+        self.ranges = ranges
+        self.stats = {'requests': 0, 'throttled': 0, 'bytes': 0, 'logins': 0, 'refreshes': 0}
+        self._lock = threading.Lock()
+        self.bands = self._write_bands(driver)
+        footprint = tile_footprint(size)
+        self.products = {}
+        for i, (tile, date) in enumerate((t, d) for t in tiles for d in dates):
+            name = product_name(tile, date)
+            product_id = str(uuid.UUID(int=i + 1))
+            cloud_cover = 0.5 + (i * 0.7) % 3.0
+            self.products[product_id] = {
+                'Id': product_id,
+                'Name': name,
+                'S3Path': f"/eodata/Sentinel-2/MSI/L2A/{date.replace('-', '/')}/{name}",
+                'ContentDate': {'Start': f"{date}T10:50:31.024Z", 'End': f"{date}T10:50:31.024Z"},
+                'OriginDate': f"{date}T13:45:12.000Z",
+                'PublicationDate': f"{date}T14:02:45.000Z",
+                'Footprint': f"geography'SRID=4326;{footprint.wkt}'",
+                'GeoFootprint': mapping(footprint),
+                'Attributes': [
+                    {'@odata.type': '#OData.CSC.StringAttribute', 'Name': 'tileId', 'Value': tile},
+                    {'@odata.type': '#OData.CSC.StringAttribute', 'Name': 'productType', 'Value': 'S2MSI2A'},
+                    {'@odata.type': '#OData.CSC.DoubleAttribute', 'Name': 'cloudCover', 'Value': cloud_cover},
+                    {'@odata.type': '#OData.CSC.IntegerAttribute', 'Name': 'relativeOrbitNumber', 'Value': 51}],
+                'mtd': mtd_xml(name, cloud_cover)}
+        self.server = None
+        self.thread = None
+
+    def _write_bands(self, driver:str)->Dict[tuple, str]:
+        ext = 'jp2' if driver == 'JP2OpenJPEG' else 'tif'
+        bands = {}
+        for i, (res, names) in enumerate(S2_L2A_BANDS.items()):
+            size = self.size * 10 // res
+            for j, band in enumerate(names):
+                path = os.path.join(self.folder, f"{band}_{res}m.{ext}")
+                if band == 'SCL':
+                    bands[(band, res)] = write_scl(path, size, resolution=res, seed=j, driver=driver)
+                else:
+                    bands[(band, res)] = write_band(path, size, resolution=res, seed=10 * i + j, driver=driver)
+        return bands
+
+    @property
+    def url(self)->str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    @property
+    def api_url(self)->str:
+        return f"{self.url}{ODATA_PATH}"
+
+    @property
+    def token_url(self)->str:
+        return f"{self.url}{TOKEN_PATH}"
+
+    def start(self)->'MockHub':
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self.server.daemon_threads = True
+        self.server.hub = self
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def reset_stats(self):
+        with self._lock:
+            self.stats = {key: 0 for key in self.stats}
+
+    def count(self, key:str, value:int=1):
+        with self._lock:
+            self.stats[key] += value
+
+    def throttled(self)->bool:
+        with self._lock:
+            self.stats['requests'] += 1
+            throttle = self.throttle_every > 0 and self.stats['requests'] % self.throttle_every == 0
+            self.stats['throttled'] += int(throttle)
+        return throttle
+
+    def search(self, query_filter:str)->List[Dict]:
+        tiles = re.search(r"Name eq 'tileId' and \((.*?)\)\)", query_filter)
+        tiles = set(re.findall(r"Value eq '(\w+)'", tiles.group(1))) if tiles else None
+        start = re.search(r"ContentDate/Start gt (\S+)", query_filter)
+        end = re.search(r"ContentDate/Start lt (\S+)", query_filter)
+        cloud = re.search(r"Name eq 'cloudCover' and att/OData.CSC.DoubleAttribute/Value le ([\d.]+)", query_filter)
+        published = re.search(r"PublicationDate gt (\S+)", query_filter)
+        values = []
+        for product in self.products.values():
+            attributes = {att['Name']: att['Value'] for att in product['Attributes']}
+            date = product['ContentDate']['Start']
+            if (tiles is None or attributes['tileId'] in tiles) \
+                    and (start is None or date > start.group(1)) and (end is None or date < end.group(1)) \
+                    and (cloud is None or attributes['cloudCover'] <= float(cloud.group(1))) \
+                    and (published is None or product['PublicationDate'] > published.group(1)):
+                values.append({k: v for k, v in product.items() if k != 'mtd'})
+        return values
+
+    def file(self, product_id:str, node:str)->Optional[str]:
+        """Local path (or MTD bytes) of the last node of a `$value` request"""
+        if node == 'MTD_MSIL2A.xml':
+            return self.products[product_id]['mtd']
+        match = re.match(r".*_(\w{3})_(\d{2})m\.jp2$", node)
+        if match is None:
+            return None
+        return self.bands.get((match.group(1), int(match.group(2))))
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def hub(self)->MockHub:
+        return self.server.hub
+
+    def _send(self, status:int, body:bytes=b'', headers:Optional[Dict[str, str]]=None):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if body and self.command != 'HEAD':
+            self.wfile.write(body)
+            self.hub.count('bytes', len(body))
+
+    def _json(self, payload:Dict):
+        self._send(200, json.dumps(payload).encode(), {'Content-Type': 'application/json'})
+
+    def do_POST(self):
+        if urlsplit(self.path).path != TOKEN_PATH:
+            return self._send(404)
+        form = parse_qs(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode())
+        grant = form.get('grant_type', [''])[0]
+        if grant == 'password' and form.get('username') and form.get('password'):
+            self.hub.count('logins')
+        elif grant == 'refresh_token' and form.get('refresh_token'):
+            self.hub.count('refreshes')
+        else:
+            return self._send(401)
+        self._json({'access_token': uuid.uuid4().hex, 'refresh_token': uuid.uuid4().hex,
+                    'expires_in': 600, 'refresh_expires_in': 3600, 'token_type': 'Bearer'})
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        if self.hub.latency > 0:
+            time.sleep(self.hub.latency)
+        if not self.headers.get('Authorization', '').startswith('Bearer '):
+            return self._send(401)
+        if self.hub.throttled():
+            return self._send(429, headers={'Retry-After': '0'})
+        parts = urlsplit(self.path)
+        path = unquote(parts.path)
+        if path.startswith(FILE_PATH):
+            return self._file(path)
+        if not path.startswith(ODATA_PATH):
+            return self._send(404)
+        path = path[len(ODATA_PATH):]
+        if path == '/Products':
+            return self._search(parse_qs(parts.query))
+        match = re.match(r"^/Products\(([\w-]+)\)(.*)$", path)
+        if match is None or match.group(1) not in self.hub.products:
+            return self._send(404)
+        product_id, nodes = match.groups()
+        if nodes == '':
+            return self._json({k: v for k, v in self.hub.products[product_id].items() if k != 'mtd'})
+        if nodes.endswith('/$value'):
+            node = re.findall(r"Nodes\(([^)]+)\)", nodes)[-1]
+            if self.hub.file(product_id, node) is None:
+                return self._send(404)
+            # The catalogue redirects the download to the file service
+            return self._send(302, headers={'Location': f"{FILE_PATH}/{product_id}/{node}"})
+        return self._send(404)
+
+    def _search(self, query:Dict[str, List[str]]):
+        values = self.hub.search(query.get('$filter', [''])[0])
+        top = int(query.get('$top', ['20'])[0])
+        skip = int(query.get('$skip', ['0'])[0])
+        payload = {'value': values[skip:skip + top]}
+        if query.get('$count', ['false'])[0].lower() == 'true':
+            payload['@odata.count'] = len(values)
+        elif skip + top < len(values):
+            payload['@odata.nextLink'] = f"{self.hub.api_url}/Products?$filter={query['$filter'][0]}" \
+                                         f"&$top={top}&$skip={skip + top}"
+        self._json(payload)
+
+    def _file(self, path:str):
+        _, product_id, node = path[len(FILE_PATH):].split('/', 2)
+        if product_id not in self.hub.products:
+            return self._send(404)
+        content = self.hub.file(product_id, node)
+        if content is None:
+            return self._send(404)
+        if isinstance(content, str):
+            with open(content, 'rb') as f:
+                content = f.read()
+        size = len(content)
+        headers = {'Content-Type': 'application/octet-stream',
+                   'Last-Modified': datetime.datetime(2023, 6, 1).strftime('%a, %d %b %Y %H:%M:%S GMT')}
+        match = re.match(r"bytes=(\d+)-(\d*)", self.headers.get('Range', ''))
+        if not self.hub.ranges or match is None:
+            if self.hub.ranges:
+                headers['Accept-Ranges'] = 'bytes'
+            return self._send(200, content, headers)
+        first = int(match.group(1))
+        last = min(int(match.group(2)) if match.group(2) else size - 1, size - 1)
+        if first >= size:
+            return self._send(416, headers={'Content-Range': f"bytes */{size}"})
+        headers.update({'Accept-Ranges': 'bytes', 'Content-Range': f"bytes {first}-{last}/{size}"})
+        self._send(206, content[first:last + 1], headers)
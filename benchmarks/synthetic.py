@@ -0,0 +1,135 @@
+"""
+ Synthetic Sentinel-2 like rasters for benchmarks
+"""
+from typing import List
+import numpy as np
+import geopandas as gpd
+import rasterio
+from rasterio.transform import from_origin
+from shapely.geometry import box
+
+# Upper left corner of the S2 tile 31TCJ (Toulouse) in EPSG:32631
+TILE_ORIGIN = (300000.0, 4900020.0)
+TILE_CRS = 'EPSG:32631'
+
+
+def write_band(path:str, size:int, resolution:int=10, seed:int=0, driver:str='GTiff')->str:
+    """Write a uint16 band of size x size pixels with reflectance-like values."""
+    rng = np.random.default_rng(seed)
+    # Smooth field plus noise so compression ratios are closer to real scenes than white noise
+    y, x = np.mgrid[0:size, 0:size]
+    field = 1500 + 1000 * np.sin(x / 97.0 + seed) * np.cos(y / 131.0)
+    data = (field + rng.normal(0, 150, (size, size))).clip(1, 10000).astype(np.uint16)
+    meta = {'driver': driver, 'dtype': 'uint16', 'count': 1, 'width': size, 'height': size,
+            'crs': TILE_CRS, 'transform': from_origin(*TILE_ORIGIN, resolution, resolution), 'nodata': 0}
+    with rasterio.open(path, 'w', **meta) as dst:
+        dst.write(data, 1)
+    return path
+
+
+def write_bands(folder:str, size:int, bands:List[str], resolution:int=10)->List[str]:
+    return [write_band(f"{folder}/{band}_{resolution}m.tif", size, resolution, seed=i)
+            for i, band in enumerate(bands)]
+
+
+def aoi_gdf(size:int, resolution:int=10, fraction:float=0.1)->gpd.GeoDataFrame:
+    """Square AOI in the middle of the synthetic tile covering `fraction` of its width."""
+    extent = size * resolution
+    half = extent * fraction / 2
+    cx, cy = TILE_ORIGIN[0] + extent / 2, TILE_ORIGIN[1] - extent / 2
+    return gpd.GeoDataFrame(geometry=[box(cx - half, cy - half, cx + half, cy + half)], crs=TILE_CRS).to_crs('epsg:4326')
+
+
+# Bands of the L2A IMG_DATA folders per resolution
+S2_L2A_BANDS = {10: ['B02', 'B03', 'B04', 'B08'],
+                20: ['B02', 'B03', 'B04', 'B05', 'B06', 'B07', 'B8A', 'B11', 'B12', 'SCL'],
+                60: ['B01', 'B02', 'B03', 'B04', 'B05', 'B06', 'B07', 'B8A', 'B09', 'B11', 'B12', 'SCL']}
+S2_BAND_IDS = ['B01', 'B02', 'B03', 'B04', 'B05', 'B06', 'B07', 'B08', 'B8A', 'B09', 'B10', 'B11', 'B12']
+
+
+def product_name(tile:str, date:str, orbit:int=51)->str:
+    """L2A product name of a tile and sensing date (YYYY-MM-DD)"""
+    day = date.replace('-', '')
+    return f"S2B_MSIL2A_{day}T105031_N0509_R{orbit:03d}_T{tile}_{day}T134512.SAFE"
+
+
+def image_files(name:str)->List[str]:
+    """IMAGE_FILE entries of the MTD of a product, without the .jp2 extension"""
+    tile, sensing = name.split('_')[5], name.split('_')[2]
+    granule = f"GRANULE/L2A_{tile}_A041234_{sensing}/IMG_DATA"
+    return [f"{granule}/R{res}m/{tile}_{sensing}_{band}_{res}m" for res, bands in S2_L2A_BANDS.items() for band in bands]
+
+
+def mtd_xml(name:str, cloud_cover:float, boa_offset:int=-1000)->bytes:
+    """MTD_MSIL2A.xml of a product with the elements read by the pipeline"""
+    sensing = name.split('_')[2]
+    start = f"{sensing[:4]}-{sensing[4:6]}-{sensing[6:8]}T{sensing[9:11]}:{sensing[11:13]}:{sensing[13:15]}.024Z"
+    files = '\n'.join(f"            <IMAGE_FILE>{f}</IMAGE_FILE>" for f in image_files(name))
+    offsets = '\n'.join(f'          <BOA_ADD_OFFSET band_id="{i}">{boa_offset}</BOA_ADD_OFFSET>'
+                        for i in range(len(S2_BAND_IDS)))
+    return f"""<?xml version="1.0" encoding="UTF-8" standalone="no"?>
+<n1:Level-2A_User_Product xmlns:n1="https://psd-14.sentinel2.eo.esa.int/PSD/User_Product_Level-2A.xsd">
+  <n1:General_Info>
+    <Product_Info>
+      <PRODUCT_START_TIME>{start}</PRODUCT_START_TIME>
+      <PRODUCT_URI>{name}</PRODUCT_URI>
+      <PROCESSING_LEVEL>Level-2A</PROCESSING_LEVEL>
+      <PRODUCT_TYPE>S2MSI2A</PRODUCT_TYPE>
+      <PROCESSING_BASELINE>05.09</PROCESSING_BASELINE>
+      <Datatake datatakeIdentifier="GS2B_{sensing}_041234_N05.09">
+        <SPACECRAFT_NAME>Sentinel-2B</SPACECRAFT_NAME>
+        <DATATAKE_SENSING_START>{start}</DATATAKE_SENSING_START>
+        <SENSING_ORBIT_NUMBER>{int(name.split('_')[4][1:])}</SENSING_ORBIT_NUMBER>
+        <SENSING_ORBIT_DIRECTION>DESCENDING</SENSING_ORBIT_DIRECTION>
+      </Datatake>
+      <Product_Organisation>
+        <Granule_List>
+          <Granule datastripIdentifier="S2B_OPER_MSI_L2A_DS" granuleIdentifier="S2B_OPER_MSI_L2A_TL" imageFormat="JPEG2000">
+{files}
+          </Granule>
+        </Granule_List>
+      </Product_Organisation>
+    </Product_Info>
+    <Product_Image_Characteristics>
+      <Special_Values>
+        <SPECIAL_VALUE_TEXT>NODATA</SPECIAL_VALUE_TEXT>
+        <SPECIAL_VALUE_INDEX>0</SPECIAL_VALUE_INDEX>
+      </Special_Values>
+      <Special_Values>
+        <SPECIAL_VALUE_TEXT>SATURATED</SPECIAL_VALUE_TEXT>
+        <SPECIAL_VALUE_INDEX>65535</SPECIAL_VALUE_INDEX>
+      </Special_Values>
+      <QUANTIFICATION_VALUES_LIST>
+        <BOA_QUANTIFICATION_VALUE unit="none">10000</BOA_QUANTIFICATION_VALUE>
+        <AOT_QUANTIFICATION_VALUE unit="none">1000.0</AOT_QUANTIFICATION_VALUE>
+        <WVP_QUANTIFICATION_VALUE unit="cm">1000.0</WVP_QUANTIFICATION_VALUE>
+      </QUANTIFICATION_VALUES_LIST>
+      <BOA_ADD_OFFSET_VALUES_LIST>
+{offsets}
+      </BOA_ADD_OFFSET_VALUES_LIST>
+    </Product_Image_Characteristics>
+  </n1:General_Info>
+  <n1:Quality_Indicators_Info>
+    <Cloud_Coverage_Assessment>{cloud_cover:.6f}</Cloud_Coverage_Assessment>
+  </n1:Quality_Indicators_Info>
+</n1:Level-2A_User_Product>
+""".encode()
+
+
+def write_scl(path:str, size:int, resolution:int=20, seed:int=0, driver:str='GTiff')->str:
+    """Write a scene classification band (20 or 60 m), mostly vegetation with a few clouds"""
+    rng = np.random.default_rng(seed)
+    data = rng.choice([4, 5, 6, 8, 9], size=(size, size), p=[0.6, 0.2, 0.1, 0.05, 0.05]).astype(np.uint8)
+    meta = {'driver': driver, 'dtype': 'uint8', 'count': 1, 'width': size, 'height': size,
+            'crs': TILE_CRS, 'transform': from_origin(*TILE_ORIGIN, resolution, resolution),
+            'nodata': 0}
+    with rasterio.open(path, 'w', **meta) as dst:
+        dst.write(data, 1)
+    return path
+
+
+def tile_footprint(size:int, resolution:int=10):
+    """WGS84 footprint of the synthetic tile of size x size pixels"""
+    extent = size * resolution
+    tile = box(TILE_ORIGIN[0], TILE_ORIGIN[1] - extent, TILE_ORIGIN[0] + extent, TILE_ORIGIN[1])
+    return gpd.GeoSeries([tile], crs=TILE_CRS).to_crs('epsg:4326').iloc[0]
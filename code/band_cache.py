@@ -0,0 +1,77 @@
+"""
+ Persistent cache of downloaded product files
+"""
+import os
+import logging
+import threading
+from pathlib import Path
+from typing import Iterable, Optional
+
+log = logging.getLogger(__name__)
+
+# Download locks and in-flight part files (see transfer.download_file), never evicted
+TRANSFER_SUFFIXES = ('.lock', '.part')
+
+
+class BandCache():
+    """Files of a product stored as `{cache_dir}/{uuid}/{band}_{resolution}m.jp2`.
+
+    The cache is bounded by `max_size` bytes and evicts the least recently used files,
+    the access time being kept in the file mtime. Lock and part files of the transfers are left
+    alone, removing them would break the downloads of other threads and processes.
+    """
+    def __init__(self, cache_dir: Path, max_size: int = 50 * 1024**3):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self._lock = threading.Lock()
+
+    def path(self, uuid: str, band: str, resolution: int, suffix: str = '.jp2') -> Path:
+        return self.cache_dir / str(uuid) / f"{band}_{int(resolution)}m{suffix}"
+
+    def file(self, uuid: str, name: str) -> Path:
+        return self.cache_dir / str(uuid) / name
+
+    def get(self, uuid: str, band: str, resolution: int, suffix: str = '.jp2') -> Optional[Path]:
+        return self.touch(self.path(uuid, band, resolution, suffix))
+
+    def touch(self, path: Path) -> Optional[Path]:
+        if not path.is_file():
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+
+    def size(self) -> int:
+        return sum(f.stat().st_size for f in self.cache_dir.glob('*/*') if f.is_file())
+
+    def evict(self, protect: Iterable[str] = ()):
+        """Remove least recently used files until the cache fits into max_size."""
+        protected = {str(Path(p)) for p in protect}
+        with self._lock:
+            files = []
+            for f in self.cache_dir.glob('*/*'):
+                if f.suffix in TRANSFER_SUFFIXES:
+                    continue
+                try:
+                    stat = f.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, f))
+            total = sum(size for _, size, _ in files)
+            for _, size, f in sorted(files):
+                if total <= self.max_size:
+                    break
+                if str(f) in protected:
+                    continue
+                try:
+                    f.unlink()
+                    total -= size
+                    log.info(f"Evicted {f.parent.name}/{f.name} from band cache")
+                except FileNotFoundError:
+                    pass
+            for folder in self.cache_dir.iterdir():
+                if folder.is_dir() and not any(folder.iterdir()):
+                    folder.rmdir()
@@ -0,0 +1,155 @@
+"""
+ Local SQLite cache of the CopernicusHub catalogue
+"""
+import json
+import time
+import sqlite3
+import logging
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from shapely.geometry import shape
+
+log = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS products (
+    uuid TEXT PRIMARY KEY,
+    name TEXT,
+    tile_id TEXT,
+    product_type TEXT,
+    cloud_cover REAL,
+    content_date TEXT,
+    publication_date TEXT,
+    payload TEXT,
+    fetched_at REAL
+);
+CREATE INDEX IF NOT EXISTS products_tile ON products (tile_id, content_date);
+CREATE VIRTUAL TABLE IF NOT EXISTS products_bbox USING rtree (id, minx, maxx, miny, maxy);
+CREATE TABLE IF NOT EXISTS searches (
+    query TEXT PRIMARY KEY,
+    synced_at REAL,
+    last_publication TEXT
+);
+CREATE TABLE IF NOT EXISTS search_products (
+    query TEXT,
+    uuid TEXT,
+    PRIMARY KEY (query, uuid)
+);
+CREATE TABLE IF NOT EXISTS metadata (
+    uuid TEXT PRIMARY KEY,
+    payload TEXT,
+    fetched_at REAL
+);
+"""
+
+
+def _attribute(product: Dict, name: str):
+    for att in product.get('Attributes', []):
+        if att.get('Name') == name:
+            return att.get('Value')
+    return None
+
+
+class CatalogueStore():
+    """Search responses and `Products(uuid)` metadata of the catalogue kept in SQLite.
+
+    Search results older than `search_ttl` seconds are refreshed incrementally, metadata
+    older than `metadata_ttl` seconds is requested again. In offline mode every answer
+    comes from the store.
+    """
+    def __init__(self,
+                 db_path: Path,
+                 search_ttl: float = 24 * 3600,
+                 metadata_ttl: float = 30 * 24 * 3600,
+                 offline: bool = False):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.search_ttl = search_ttl
+        self.metadata_ttl = metadata_ttl
+        self.offline = offline
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        with self._lock, self.conn:
+            self.conn.executescript(SCHEMA)
+
+    def search(self, query: str) -> Optional[Dict]:
+        """Cached products of a search filter with its sync state, None if never synced."""
+        with self._lock:
+            row = self.conn.execute("SELECT synced_at, last_publication FROM searches WHERE query = ?",
+                                    (query,)).fetchone()
+            if row is None:
+                return None
+            payloads = self.conn.execute(
+                "SELECT p.payload FROM search_products s JOIN products p ON p.uuid = s.uuid WHERE s.query = ?",
+                (query,)).fetchall()
+        return {'values': [json.loads(p[0]) for p in payloads],
+                'synced_at': row[0],
+                'last_publication': row[1],
+                'fresh': time.time() - row[0] < self.search_ttl}
+
+    def save_search(self, query: str, values: List[Dict], synced_at: Optional[float] = None):
+        """Record the products of a search, products already known for the query are kept."""
+        synced_at = synced_at or time.time()
+        with self._lock, self.conn:
+            for product in values:
+                self._upsert_product(product, synced_at)
+                self.conn.execute("INSERT OR IGNORE INTO search_products (query, uuid) VALUES (?, ?)",
+                                  (query, product['Id']))
+            last = self.conn.execute(
+                "SELECT MAX(p.publication_date) FROM search_products s JOIN products p ON p.uuid = s.uuid "
+                "WHERE s.query = ?", (query,)).fetchone()[0]
+            self.conn.execute("INSERT OR REPLACE INTO searches (query, synced_at, last_publication) VALUES (?, ?, ?)",
+                              (query, synced_at, last))
+
+    def _upsert_product(self, product: Dict, fetched_at: float):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO products (uuid, name, tile_id, product_type, cloud_cover, content_date, "
+            "publication_date, payload, fetched_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (product['Id'], product.get('Name'), _attribute(product, 'tileId'),
+             _attribute(product, 'productType'), _attribute(product, 'cloudCover'),
+             (product.get('ContentDate') or {}).get('Start'), product.get('PublicationDate'),
+             json.dumps(product), fetched_at))
+        rowid = self.conn.execute("SELECT rowid FROM products WHERE uuid = ?", (product['Id'],)).fetchone()[0]
+        self.conn.execute("DELETE FROM products_bbox WHERE id = ?", (rowid,))
+        if product.get('GeoFootprint'):
+            minx, miny, maxx, maxy = shape(product['GeoFootprint']).bounds
+            self.conn.execute("INSERT INTO products_bbox (id, minx, maxx, miny, maxy) VALUES (?, ?, ?, ?, ?)",
+                              (rowid, minx, maxx, miny, maxy))
+
+    def find_products(self,
+                      product_type: str,
+                      start_date: str,
+                      end_date: str,
+                      cloud_coverage_max: float,
+                      tile_ids: Optional[List[str]] = None,
+                      bbox: Optional[Tuple[float, float, float, float]] = None) -> List[Dict]:
+        """Answer a search from the stored products, by tile ids or by bbox (minx, miny, maxx, maxy)."""
+        sql = "SELECT p.payload FROM products p"
+        params = []
+        if bbox is not None:
+            sql += " JOIN products_bbox b ON b.id = p.rowid" \
+                   " WHERE b.minx <= ? AND b.maxx >= ? AND b.miny <= ? AND b.maxy >= ?"
+            params += [bbox[2], bbox[0], bbox[3], bbox[1]]
+        else:
+            sql += " WHERE 1"
+        sql += " AND p.product_type = ? AND p.content_date > ? AND p.content_date < ? AND p.cloud_cover <= ?"
+        params += [product_type, str(start_date), str(end_date), float(cloud_coverage_max)]
+        if tile_ids:
+            sql += f" AND p.tile_id IN ({','.join('?' * len(tile_ids))})"
+            params += [str(t) for t in tile_ids]
+        with self._lock:
+            rows = self.conn.execute(sql, params).fetchall()
+        return [json.loads(r[0]) for r in rows]
+
+    def metadata(self, uuid: str) -> Optional[Dict]:
+        with self._lock:
+            row = self.conn.execute("SELECT payload, fetched_at FROM metadata WHERE uuid = ?", (uuid,)).fetchone()
+        if row is None or (not self.offline and time.time() - row[1] >= self.metadata_ttl):
+            return None
+        return json.loads(row[0])
+
+    def save_metadata(self, uuid: str, payload: Dict):
+        with self._lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO metadata (uuid, payload, fetched_at) VALUES (?, ?, ?)",
+                              (uuid, json.dumps(payload), time.time()))
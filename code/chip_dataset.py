@@ -0,0 +1,201 @@
+"""
+ Chip-level dataset over the processed rasters for model training
+"""
+import os
+import glob
+import logging
+import threading
+from collections import OrderedDict
+from typing import Optional, Sequence, Tuple
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.windows import Window
+
+log = logging.getLogger(__name__)
+
+# Scene classification classes of clouds and shadows: cloud shadow, medium and high probability, cirrus
+SCL_CLOUDY = (3, 8, 9, 10)
+INDEX_DTYPE = np.dtype([('raster', np.int32), ('col', np.int32), ('row', np.int32)])
+
+
+class ChipDataset():
+    """Fixed-size chips of the processed `{uuid}.tif` rasters.
+
+    The index of the chips is computed once from decimated reads (served by the overviews of the
+    cog profile): chips with more than max_nodata of nodata pixels, or more than max_cloud of
+    cloudy pixels in the scene classification band `scl_band`, are left out. It can be saved to
+    index_path and is reused while the rasters do not change.
+
+    Open datasets are kept in an LRU cache of cache_size handles per process. The cache is dropped
+    in a forked or unpickled worker, so the dataset can be handed to multi-process loaders. Chips
+    are read straight into the returned (or given) arrays, `read_batch` fills one
+    (n, bands, chip_size, chip_size) array.
+    """
+    def __init__(self,
+                 rasters: Sequence[str],
+                 chip_size: int = 256,
+                 stride: Optional[int] = None,
+                 max_nodata: float = 0.0,
+                 max_cloud: float = 1.0,
+                 scl_band: Optional[int] = None,
+                 cache_size: int = 64,
+                 index_path: Optional[str] = None):
+        self.rasters = [str(r) for r in rasters]
+        self.chip_size = chip_size
+        self.stride = stride or chip_size
+        self.max_nodata = max_nodata
+        self.max_cloud = max_cloud
+        self.scl_band = scl_band
+        self.cache_size = cache_size
+        self._reset_handles()
+        self.count, self.dtype = self._band_layout()
+        self.index = self._load_index(index_path) if index_path else None
+        if self.index is None:
+            self.index = self._build_index()
+            if index_path:
+                self._save_index(index_path)
+        log.info(f"{len(self.index)} chips of {chip_size} px in {len(self.rasters)} rasters")
+
+    @classmethod
+    def from_directory(cls, directory: str, pattern: str = '*.tif', **kwargs) -> 'ChipDataset':
+        rasters = sorted(glob.glob(os.path.join(directory, pattern)))
+        if len(rasters) == 0:
+            raise ValueError(f"No {pattern} rasters in {directory}")
+        return cls(rasters, **kwargs)
+
+    def __len__(self):
+        return len(self.index)
+
+    # Handles
+
+    def _reset_handles(self):
+        self._pid = os.getpid()
+        self._handles = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _dataset(self, raster: int) -> rasterio.DatasetReader:
+        if self._pid != os.getpid():
+            # Forked worker: GDAL handles of the parent must not be used
+            self._reset_handles()
+        with self._lock:
+            src = self._handles.get(raster)
+            if src is not None:
+                self._handles.move_to_end(raster)
+                return src
+            src = rasterio.open(self.rasters[raster])
+            self._handles[raster] = src
+            if len(self._handles) > self.cache_size:
+                _, oldest = self._handles.popitem(last=False)
+                oldest.close()
+            return src
+
+    def close(self):
+        with self._lock:
+            for src in self._handles.values():
+                src.close()
+            self._handles.clear()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ('_handles', '_lock', '_pid'):
+            state.pop(key)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._reset_handles()
+
+    def _band_layout(self) -> Tuple[int, np.dtype]:
+        """Band count and dtype shared by all the rasters, chips of a batch are read into one array"""
+        if len(self.rasters) == 0:
+            raise ValueError("No rasters to build the chip dataset from")
+        layouts = {}
+        for path in self.rasters:
+            with rasterio.open(path) as src:
+                layouts.setdefault((src.count, np.dtype(src.dtypes[0])), []).append(path)
+        if len(layouts) > 1:
+            found = ', '.join(f"{count} bands of {dtype} in {len(paths)} rasters (e.g. {paths[0]})"
+                              for (count, dtype), paths in layouts.items())
+            raise ValueError(f"Rasters of a chip dataset must share their band count and dtype, found {found}")
+        return next(iter(layouts))
+
+    # Index
+
+    def _raster_chips(self, raster: int) -> np.ndarray:
+        src = self._dataset(raster)
+        # Decimated masks with about 16 x 16 samples per chip
+        factor = max(1, self.chip_size // 16)
+        shape = (max(1, src.height // factor), max(1, src.width // factor))
+        nodata = src.nodata if src.nodata is not None else 0
+        valid = src.read(1, out_shape=shape, resampling=Resampling.nearest) != nodata
+        cloudy = None
+        if self.scl_band is not None:
+            scl = src.read(self.scl_band, out_shape=shape, resampling=Resampling.nearest)
+            cloudy = np.isin(scl, SCL_CLOUDY)
+        rows = np.arange(0, src.height - self.chip_size + 1, self.stride)
+        cols = np.arange(0, src.width - self.chip_size + 1, self.stride)
+        chips = []
+        step = self.chip_size // factor
+        for row in rows:
+            for col in cols:
+                r, c = row // factor, col // factor
+                block = valid[r:r + step, c:c + step]
+                if block.size == 0 or 1 - block.mean() > self.max_nodata:
+                    continue
+                if cloudy is not None and cloudy[r:r + step, c:c + step][block].mean() > self.max_cloud:
+                    continue
+                chips.append((raster, col, row))
+        return np.array(chips, dtype=INDEX_DTYPE)
+
+    def _build_index(self) -> np.ndarray:
+        chips = [self._raster_chips(raster) for raster in range(len(self.rasters))]
+        return np.concatenate(chips) if chips else np.zeros(0, dtype=INDEX_DTYPE)
+
+    def _signature(self) -> np.ndarray:
+        """Rasters, their modification times and the chip parameters the index depends on"""
+        params = [self.chip_size, self.stride, self.max_nodata, self.max_cloud, self.scl_band]
+        return np.array(self.rasters + [str(os.path.getmtime(r)) for r in self.rasters] + [str(p) for p in params])
+
+    def _load_index(self, index_path: str) -> Optional[np.ndarray]:
+        if not os.path.exists(index_path):
+            return None
+        with np.load(index_path) as saved:
+            if saved['signature'].shape != self._signature().shape or \
+                    not np.array_equal(saved['signature'], self._signature()):
+                log.info(f"Chip index {index_path} is outdated, rebuilding it")
+                return None
+            return saved['index']
+
+    def _save_index(self, index_path: str):
+        tmp = f"{index_path}.part.npz"
+        np.savez(tmp, index=self.index, signature=self._signature())
+        os.replace(tmp, index_path)
+
+    # Reads
+
+    def chip(self, idx: int) -> Tuple[str, Window, rasterio.Affine]:
+        """Raster path, window and geotransform of a chip"""
+        raster, col, row = self.index[idx]
+        window = Window(int(col), int(row), self.chip_size, self.chip_size)
+        return self.rasters[raster], window, self._dataset(int(raster)).window_transform(window)
+
+    def read(self, idx: int, out: Optional[np.ndarray] = None) -> np.ndarray:
+        """(bands, chip_size, chip_size) array of a chip, read into out when given"""
+        raster, col, row = self.index[idx]
+        if out is None:
+            out = np.empty((self.count, self.chip_size, self.chip_size), dtype=self.dtype)
+        return self._dataset(int(raster)).read(window=Window(int(col), int(row), self.chip_size, self.chip_size),
+                                               out=out)
+
+    def __getitem__(self, idx: int) -> np.ndarray:
+        return self.read(idx)
+
+    def read_batch(self, indices: Sequence[int], out: Optional[np.ndarray] = None) -> np.ndarray:
+        """(n, bands, chip_size, chip_size) array of chips, grouped by raster to reuse the open handles"""
+        indices = np.asarray(indices)
+        if out is None:
+            out = np.empty((len(indices), self.count, self.chip_size, self.chip_size), dtype=self.dtype)
+        for i in np.argsort(self.index['raster'][indices], kind='stable'):
+            self.read(int(indices[i]), out=out[i])
+        return out
@@ -0,0 +1,176 @@
+"""
+ Temporal compositing of many dates of a tile
+"""
+import logging
+import warnings
+import threading
+from typing import Dict, List
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.windows import Window, bounds as window_bounds
+from code.tx import normilize_s2, profile_meta, build_overviews, part_path, commit_part, read_on_grid, finest_band, \
+    output_grid, band_resampling, band_name, band_normalizers
+from code.metrics import timed
+
+log = logging.getLogger(__name__)
+
+# Scene classification classes kept as clear: vegetation, not vegetated, water, unclassified, snow
+SCL_CLEAR = (4, 5, 6, 7, 11)
+METHODS = ('median', 'best_pixel', 'lowest_cloud')
+
+
+class _Handles():
+    """Open datasets per thread, rasterio datasets must not be shared between threads"""
+    def __init__(self):
+        self.local = threading.local()
+        self.opened = []
+        self.lock = threading.Lock()
+
+    def get(self, path: str) -> rasterio.DatasetReader:
+        if not hasattr(self.local, 'handles'):
+            self.local.handles = {}
+        handles = self.local.handles
+        if path not in handles:
+            handles[path] = rasterio.open(path)
+            with self.lock:
+                self.opened.append(handles[path])
+        return handles[path]
+
+    def close(self):
+        for src in self.opened:
+            src.close()
+
+
+def _clear(handles: _Handles, scene: Dict, bounds, shape) -> np.array:
+    if scene.get('scl') is None:
+        return np.ones(shape, dtype=bool)
+    return np.isin(read_on_grid(handles.get(scene['scl']), bounds, shape), SCL_CLEAR)
+
+
+def _read_band(handles: _Handles, scene: Dict, band: str, bounds, shape, resampling: Resampling,
+               boa_offset: bool = False) -> np.array:
+    """Band of a scene on the block grid, its DN shifted by the BOA offset of the scene with boa_offset"""
+    data = read_on_grid(handles.get(band), bounds, shape, band_resampling(band, resampling))
+    offset = (scene.get('boa_offsets') or {}).get(band_name(band), 0) if boa_offset else 0
+    if offset == 0:
+        return data
+    # Valid pixels stay above the nodata value 0
+    shifted = np.clip(data.astype(np.int32) + offset, 1, np.iinfo(np.uint16).max).astype(np.uint16)
+    return np.where(data > 0, shifted, 0).astype(np.uint16)
+
+
+def _composite_block(handles: _Handles, scenes: List[Dict], bounds, shape, method: str,
+                     resampling: Resampling = Resampling.nearest, boa_offset: bool = False) -> np.array:
+    nbands = len(scenes[0]['bands'])
+    out = np.zeros((nbands,) + shape, dtype=np.uint16)
+    if method == 'lowest_cloud':
+        # Clear pixels of the least cloudy scene first, the next scenes only fill the gaps
+        filled = np.zeros(shape, dtype=bool)
+        for scene in sorted(scenes, key=lambda sc: sc.get('cloudcoverage', 0)):
+            take = _clear(handles, scene, bounds, shape) & ~filled
+            if take.any():
+                for b, band in enumerate(scene['bands']):
+                    out[b][take] = _read_band(handles, scene, band, bounds, shape, resampling, boa_offset)[take]
+                filled |= take
+            if filled.all():
+                break
+    elif method == 'best_pixel':
+        # Darkest clear pixel of the first band (blue) is the least hazy one
+        best = np.full(shape, np.iinfo(np.uint16).max, dtype=np.uint16)
+        found = np.zeros(shape, dtype=bool)
+        for scene in scenes:
+            data = [_read_band(handles, scene, band, bounds, shape, resampling, boa_offset) for band in scene['bands']]
+            better = _clear(handles, scene, bounds, shape) & (data[0] > 0) & (~found | (data[0] < best))
+            for b in range(nbands):
+                out[b][better] = data[b][better]
+            best[better] = data[0][better]
+            found |= better
+    else:
+        # Median over the clear pixels of all scenes, the block is sized so memory stays bounded
+        stack = np.full((len(scenes), nbands) + shape, np.nan, dtype=np.float32)
+        for i, scene in enumerate(scenes):
+            clear = _clear(handles, scene, bounds, shape)
+            for b, band in enumerate(scene['bands']):
+                data = _read_band(handles, scene, band, bounds, shape, resampling, boa_offset)
+                stack[i, b][clear & (data > 0)] = data[clear & (data > 0)]
+        with warnings.catch_warnings():
+            # All-NaN pixels without any clear observation stay nodata
+            warnings.simplefilter('ignore', category=RuntimeWarning)
+            median = np.nanmedian(stack, axis=0)
+        out[:] = np.nan_to_num(median, nan=0).astype(np.uint16)
+    return out
+
+
+@timed('composite')
+def composite(scenes: List[Dict], output_img: str, method: str = 'median', normalize: bool = False,
+              block_size: int = 512, num_threads: int = 4, memory_limit: int = 256 * 1024**2,
+              profile: Dict = None, resampling: str = 'nearest', grid_resolution: float = None,
+              radiometry=None) -> str:
+    """Composite many dates of the same grid block by block.
+
+    scenes are dicts with the band paths ('bands'), the scene classification path ('scl', optional)
+    and 'cloudcoverage'. The grid is the one of the finest band of the first scene (coarsened to
+    grid_resolution), the other bands are resampled to it with resampling (class bands with nearest).
+    The output tiles are reduced in num_threads parallel threads, 'lowest_cloud' and 'best_pixel' keep
+    a running result per tile, 'median' reduces each tile in sub-blocks small enough for the stack of
+    all dates of a sub-block to fit into memory_limit.
+
+    With a Radiometry, the DN of every scene are shifted by its own BOA offsets ('boa_offsets') when
+    read, so scenes of mixed processing baselines are composited on one scale, and the composite
+    is mapped like a single product.
+    """
+    if method not in METHODS:
+        raise ValueError(f"Unknown composite method {method}, expected one of {METHODS}")
+    nbands = len(scenes[0]['bands'])
+    sub_size = block_size
+    if method == 'median':
+        side = int(np.sqrt(memory_limit / max(1, num_threads) / (len(scenes) * nbands * 4)))
+        sub_size = max(16, side // 16 * 16)
+
+    boa_offset = radiometry is not None
+    with ExitStack() as stack:
+        srcs = [stack.enter_context(rasterio.open(band)) for band in scenes[0]['bands']]
+        transform, width, height = output_grid(srcs, grid_resolution)
+        meta_out = finest_band(srcs).meta.copy()
+        meta_out.update({'driver': 'GTiff', 'count': nbands, 'nodata': 0, 'dtype': 'uint16',
+                         'transform': transform, 'width': width, 'height': height,
+                         'tiled': True, 'blockxsize': block_size, 'blockysize': block_size})
+        # The percentile stretch reads the first scene, whose offsets are already applied to the composite
+        normalizers = band_normalizers(scenes[0]['bands'], srcs, normalize, radiometry, meta_out,
+                                        src_offsets=scenes[0].get('boa_offsets') if boa_offset else None)
+
+    handles = _Handles()
+
+    def process(window):
+        # Tiles of the output profile, written whole so compressed tiles are never rewritten
+        height, width = int(window.height), int(window.width)
+        block = np.zeros((nbands, height, width), dtype=np.uint16)
+        for row in range(0, height, sub_size):
+            for col in range(0, width, sub_size):
+                sub = Window(window.col_off + col, window.row_off + row,
+                             min(sub_size, width - col), min(sub_size, height - row))
+                block[:, row:row + int(sub.height), col:col + int(sub.width)] = _composite_block(
+                    handles, scenes, window_bounds(sub, meta_out['transform']), (int(sub.height), int(sub.width)),
+                    method, Resampling[resampling], boa_offset)
+        return np.stack([norm(band) if callable(norm) else (normilize_s2(band) if norm else band)
+                         for band, norm in zip(block, normalizers)])
+
+    tmp_img = part_path(output_img)
+    try:
+        with rasterio.open(tmp_img, 'w', **profile_meta(meta_out, profile)) as dest, \
+                ThreadPoolExecutor(max_workers=max(1, num_threads)) as executor:
+            windows = [window for _, window in dest.block_windows(1)]
+            # Submit a few blocks ahead only, so finished blocks do not pile up in memory
+            step = max(1, num_threads) * 2
+            for i in range(0, len(windows), step):
+                for window, block in zip(windows[i:i + step], executor.map(process, windows[i:i + step])):
+                    dest.write(block, window=window)
+            build_overviews(dest, profile)
+    finally:
+        handles.close()
+    commit_part(tmp_img, output_img)
+    log.info(f"Composite of {len(scenes)} scenes ({method}) written to {output_img}")
+    return output_img
@@ -0,0 +1,142 @@
+"""
+ Zarr datacube sink of processed products
+"""
+import fcntl
+import logging
+import datetime
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List, Optional
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+import xarray as xr
+import zarr
+from numcodecs import Blosc
+from code.exception import OperatorValidationException
+
+log = logging.getLogger(__name__)
+
+EPOCH = datetime.date(1970, 1, 1)
+# Per-date coordinates stored next to the time axis
+TIME_COORDS = {'uuid': '<U64', 'cloudcoverage': 'float32', 'orbit': 'int32', 'nodata': 'int32', 'complete': 'bool'}
+
+
+@contextmanager
+def _file_lock(path: Path):
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _orbit(product: Dict) -> int:
+    orbit = product.get('orbit', product.get('orbit_number', -1))
+    try:
+        return int(str(orbit).lstrip('R'))
+    except ValueError:
+        return -1
+
+
+class ZarrCubeSink():
+    """One chunked, compressed (time, band, y, x) Zarr datacube per tile.
+
+    A writer reserves its time index under a file lock and then writes its own chunks
+    (one time step per chunk), so writers of different dates run concurrently. A reserved time
+    step stays marked incomplete until all its chunks are written. Time steps are stored in
+    arrival order, `open` sorts them by date and leaves out the incomplete ones.
+    """
+    def __init__(self, root: Path, chunk_size: int = 512, compressor: str = 'zstd', clevel: int = 3):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.chunk_size = chunk_size
+        self.compressor = Blosc(cname=compressor, clevel=clevel, shuffle=Blosc.BITSHUFFLE)
+
+    def store_path(self, tile: str) -> Path:
+        return self.root / f"{tile}.zarr"
+
+    def _create(self, group: zarr.Group, src: rasterio.DatasetReader, bands):
+        group.attrs.update({'crs': src.crs.to_wkt(), 'transform': list(src.transform)[:6]})
+        data = group.create_dataset('reflectance', shape=(0, src.count, src.height, src.width),
+                                    chunks=(1, src.count, self.chunk_size, self.chunk_size),
+                                    dtype=src.dtypes[0], fill_value=0, compressor=self.compressor)
+        data.attrs['_ARRAY_DIMENSIONS'] = ['time', 'band', 'y', 'x']
+        time = group.create_dataset('time', shape=(0,), chunks=(4096,), dtype='int64')
+        time.attrs.update({'_ARRAY_DIMENSIONS': ['time'], 'units': 'days since 1970-01-01',
+                           'calendar': 'proleptic_gregorian'})
+        for name, dtype in TIME_COORDS.items():
+            coord = group.create_dataset(name, shape=(0,), chunks=(4096,), dtype=dtype)
+            coord.attrs['_ARRAY_DIMENSIONS'] = ['time']
+        band = group.array('band', np.array(bands, dtype='<U8'))
+        band.attrs['_ARRAY_DIMENSIONS'] = ['band']
+        # Pixel centres of the grid
+        x = src.transform.c + (np.arange(src.width) + 0.5) * src.transform.a
+        y = src.transform.f + (np.arange(src.height) + 0.5) * src.transform.e
+        group.array('x', x).attrs['_ARRAY_DIMENSIONS'] = ['x']
+        group.array('y', y).attrs['_ARRAY_DIMENSIONS'] = ['y']
+
+    def append(self, tile: str, raster_path: str, product: Dict, bands: Optional[List[str]] = None) -> int:
+        """Append a processed product to the cube of its tile and return its time index.
+
+        bands label the bands of the raster in their order (its band descriptions, then the
+        product bands, by default). A product already in the cube overwrites its time step.
+        """
+        path = self.store_path(tile)
+        with rasterio.open(raster_path) as src:
+            if bands is None:
+                bands = list(src.descriptions) if all(src.descriptions) else \
+                    product.get('bands') or [f"B{i}" for i in range(1, src.count + 1)]
+            with _file_lock(Path(f"{path}.lock")):
+                group = zarr.open_group(str(path), mode='a')
+                if 'reflectance' not in group:
+                    self._create(group, src, list(bands))
+                if 'complete' not in group:
+                    # Cubes written before the completion mark hold complete time steps only
+                    coord = group.array('complete', np.ones(group['time'].shape, dtype=bool), chunks=(4096,))
+                    coord.attrs['_ARRAY_DIMENSIONS'] = ['time']
+                data = group['reflectance']
+                if data.shape[1:] != (src.count, src.height, src.width):
+                    raise OperatorValidationException(
+                        f"Grid of {raster_path} {(src.count, src.height, src.width)} does not match the cube "
+                        f"{data.shape[1:]} of tile {tile}")
+                if list(group['band'][:]) != list(bands):
+                    raise OperatorValidationException(
+                        f"Bands {list(bands)} of {raster_path} do not match the bands {list(group['band'][:])} "
+                        f"of the cube of tile {tile}")
+                date = datetime.date.fromisoformat(str(product['product_date'])[:10])
+                values = {'time': (date - EPOCH).days,
+                          'uuid': str(product.get('uuid', '')),
+                          'cloudcoverage': float(product.get('cloudcoverage', np.nan)),
+                          'orbit': _orbit(product),
+                          'nodata': int(product.get('nodata', src.nodata or 0)),
+                          'complete': False}
+                existing = np.flatnonzero(group['uuid'][:] == values['uuid'])
+                if len(existing) > 0:
+                    # Reprocessed product: its time step is overwritten in place
+                    idx = int(existing[0])
+                    for name, value in values.items():
+                        group[name][idx] = value
+                else:
+                    # Reserve the time index of this product
+                    idx = data.shape[0]
+                    data.resize((idx + 1,) + data.shape[1:])
+                    for name, value in values.items():
+                        group[name].append(np.array([value], dtype=group[name].dtype))
+
+            # Chunk rows of this time step belong to this writer only
+            for row in range(0, src.height, self.chunk_size):
+                window = Window(0, row, src.width, min(self.chunk_size, src.height - row))
+                data[idx, :, row:row + int(window.height), :] = src.read(window=window)
+            with _file_lock(Path(f"{path}.lock")):
+                group['complete'][idx] = True
+        log.info(f"Product {product.get('uuid')} appended to {path.name} at time index {idx}")
+        return idx
+
+    def open(self, tile: str) -> xr.Dataset:
+        """Complete time steps of the cube of tile sorted by date"""
+        cube = xr.open_zarr(str(self.store_path(tile)), consolidated=False)
+        if 'complete' in cube:
+            cube = cube.isel(time=np.flatnonzero(cube['complete'].values))
+        return cube.sortby('time')
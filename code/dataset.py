@@ -4,8 +4,12 @@ import pandas as pd
 import geopandas as gpd
 import shapely
 from omegaconf import DictConfig
-from imagery_store import CopernicusHubOperator
-from typing import Optional, Union
+from imagery_store import operator_from_config, output_params
+from code.metrics import span
+from code.manifest import params_hash
+from code.raster_index import RasterIndex, raster_params
+from code.tx import clip_by_bounds, build_profile
+from typing import List, Optional, Union
 import logging
 log = logging.getLogger(__name__)
 
@@ -22,9 +26,10 @@ class AreaDataset():
                  ):
         self.config = config
         self.imagery_dir = Path(imagery_directory)
-        self.imagery_store = CopernicusHubOperator(api_url=self.config.api_url,
-                 api_id=self.config.api_id,api_secret=self.config.api_secret, cache_dir=self.imagery_dir)
+        self.imagery_store = operator_from_config(self.config, self.imagery_dir)
         self.area_descriptor = area_descriptor
+        self.searched = False
+        self.raster_index = RasterIndex(Path(config.local_index.db)) if config.local_index.enabled else None
         if not self.imagery_dir.exists():
             self.imagery_dir.mkdir(parents=True, exist_ok=True)
 
@@ -32,20 +37,77 @@ class AreaDataset():
 
         return len(self.area_descriptor)
 
-    def __getitem__(self, idx):
+    def area(self, idx):
+        """Bounds and tile id of an area of the descriptor"""
         area = self.area_descriptor.iloc[idx]
         if isinstance(area['geometry'], str):
             area_coords = tuple(shapely.from_wkt(area['geometry']).bounds)
         else:
             area_coords = tuple(area['geometry'].bounds)
+        return area_coords, str(area['tile_id'])
+
+    def search(self, indices: Optional[List[int]] = None):
+        """Search the candidates of the tiles of the area descriptor (of the areas indices) in bulk"""
+        if 'tile_id' in self.area_descriptor.columns:
+            areas = self.area_descriptor if indices is None else self.area_descriptor.iloc[list(indices)]
+            self.imagery_store.search_products(platform_name=self.config.platform_name,
+                                               product_type=self.config.product_type,
+                                               start_date=str(self.config.start_date),
+                                               end_date=str(self.config.end_date),
+                                               cloud_coverage_max=self.config.cloud_coverage_max,
+                                               tile_ids=areas['tile_id'].astype(str).tolist())
+        self.searched = True
+
+    def from_cache(self, area_coords, tile_id):
+        """Product of the area cut from an indexed raster of the cache, None when no raster fits"""
+        cfg = self.config
+        bands = list(cfg.bands)
+        # Rasters processed with other parameters (CRS, resampling, radiometry, profile) are not served
+        params = raster_params(output_params(cfg, int(cfg.resolution), area_coords))
+        entries = self.raster_index.query(area_coords, start_date=str(cfg.start_date), end_date=str(cfg.end_date),
+                                          bands=bands, resolution=int(cfg.resolution), data_format=cfg.format,
+                                          max_cloud=cfg.cloud_coverage_max,
+                                          min_coverage=cfg.local_index.min_coverage, params=params)
+        for entry in entries:
+            key = params_hash({'bounds': [round(c, 7) for c in area_coords], 'bands': bands, 'params': params})
+            item_path = self.imagery_dir / f"{entry['uuid']}_{key}.tif"
+            if not item_path.exists():
+                with span('area_cache', tile=tile_id, product=entry['uuid']):
+                    written = clip_by_bounds(entry['path'], area_coords, str(item_path),
+                                             indexes=[entry['bands'].index(b) + 1 for b in bands],
+                                             min_valid=cfg.local_index.min_coverage,
+                                             profile=build_profile(**cfg.output))
+                if written is None:
+                    continue
+            log.info(f"Area of tile {tile_id} served from {entry['path']}")
+            return {'uuid': entry['uuid'],
+                    'tile': entry['tile_id'],
+                    'product_date': entry['product_date'],
+                    'cloudcoverage': entry['cloud_cover'],
+                    'bands': bands,
+                    'num_bands': len(bands),
+                    'crs': entry['crs'],
+                    'local_dir': str(item_path),
+                    'source': entry['path']}
+        return None
+
+    def __getitem__(self, idx):
+        area_coords, tile_id = self.area(idx)
+        if self.raster_index is not None:
+            product = self.from_cache(area_coords, tile_id)
+            if product is not None:
+                return product
+        if not self.searched:
+            self.search()
 
         # Select and download S2 tile
-        self.imagery_store.imagery(area_coords=area_coords,
-                              tile_id=str(area['tile_id']),
-                              cfg=self.config,
-                              start_date=str(self.config.start_date),
-                              end_date=str(self.config.end_date),
-                              resolution=int(self.config.resolution))
+        with span('area', area=idx, tile=tile_id):
+            self.imagery_store.imagery(area_coords=area_coords,
+                                  tile_id=tile_id,
+                                  cfg=self.config,
+                                  start_date=str(self.config.start_date),
+                                  end_date=str(self.config.end_date),
+                                  resolution=int(self.config.resolution))
 
         product = self.imagery_store.product
 
@@ -1,4 +1,5 @@
-from imagery_store import CopernicusHubOperator
+import os
+from imagery_store import CopernicusHubOperator, operator_from_config
 import hydra
 from omegaconf import DictConfig
 import pandas as pd
@@ -6,6 +7,9 @@ import geopandas as gpd
 import shapely
 
 from code.dataset import AreaDataset
+from code.scheduler import PipelineScheduler
+from code.tile_index import TileIndex, load_tile_index
+from code.metrics import METRICS
 
 import logging
 log = logging.getLogger(__name__)
@@ -19,6 +23,7 @@ def read_file_as_gdf(aoi_path:str, out_crs:str='epsg:4326')-> gpd.GeoDataFrame:
         region_gdf = gpd.GeoDataFrame(region_df,
                                       geometry=[shapely.from_wkt(geom) for geom in region_df.geometry],
                                       crs=out_crs)
+        return region_gdf
     elif aoi_path.endswith(tuple(['.geojson', '.gpkg', '.shp'])):
         region_gdf = gpd.read_file(aoi_path)
         # Reproject CRS of aoi to WGS84
@@ -31,27 +36,67 @@ def read_file_as_gdf(aoi_path:str, out_crs:str='epsg:4326')-> gpd.GeoDataFrame:
 
 
 
-@hydra.main(version_base=None, config_path="../conf", config_name='config')
-def main(cfg:DictConfig):
-    if len(cfg.data.tile_ids)==0:
-        gdf_aoi = pd.DataFrame(read_file_as_gdf(aoi_path='data/toulouse_bbox_wgs84.geojson'))
-    else:
-        df_tiles = pd.DataFrame(cfg.data.tile_ids, columns=['tile_id'])
+def catalogue_tile_index(cfg:DictConfig, aois)->TileIndex:
+    """Tile index of the footprints of the catalogue products of the AOIs (or of the listed tiles)"""
+    operator = operator_from_config(cfg.imagery, cfg.cache.feature_dir)
+    products = operator.search_products(platform_name=cfg.imagery.platform_name,
+                                        product_type=cfg.imagery.product_type,
+                                        start_date=str(cfg.imagery.start_date),
+                                        end_date=str(cfg.imagery.end_date),
+                                        cloud_coverage_max=cfg.imagery.cloud_coverage_max,
+                                        tile_ids=[str(t) for t in cfg.data.tile_ids] or None,
+                                        aois=aois)
+    if products.empty:
+        return TileIndex(gpd.GeoDataFrame({'tileId': []}, geometry=[], crs='epsg:4326'), id_column='tileId')
+    return TileIndex(products[['tileId', 'geometry']].dissolve(by='tileId').reset_index(), id_column='tileId')
 
 
-    dataset = AreaDataset(area_descriptor=gdf_aoi, imagery_directory=cfg.cache.feature_dir, config=cfg)
+def area_descriptor(cfg:DictConfig)->pd.DataFrame:
+    """Areas (AOI and tile) to process: the MGRS tiles of the AOI, or the listed tiles with their geometry.
 
-    # # Process product from selected dataset
-    # for idx, row in dataset.area_descriptor.iterrows():
-    #     try:
-    #         process_product(idx, row, dataset, cfg, sds, db, down_df)
-    #     except Exception as e:
-    #         log.info(f"Failed to process tile = {row['tile_id']}")
+    Tiles are looked up in the global S2 tile grid, or in the footprints of a catalogue search when
+    the grid file is missing.
+    """
+    aoi_gdf = read_file_as_gdf(aoi_path=cfg.data.aoi, out_crs=cfg.data.crs) if len(cfg.data.tile_ids) == 0 else None
+    if os.path.isfile(cfg.data.global_dataset):
+        tile_index = load_tile_index(cfg.data.global_dataset)
+    else:
+        log.info(f"Tile grid {cfg.data.global_dataset} not found, tiles are looked up in the catalogue")
+        tile_index = catalogue_tile_index(cfg, None if aoi_gdf is None else list(aoi_gdf.geometry))
+    if aoi_gdf is not None:
+        return pd.DataFrame(tile_index.areas(aoi_gdf))
+    tile_ids = [str(t) for t in cfg.data.tile_ids]
+    gdf_aoi = pd.DataFrame({'tile_id': tile_ids, 'geometry': tile_index.geometry(tile_ids)})
+    return gdf_aoi[gdf_aoi['geometry'].notna()]
 
 
+@hydra.main(version_base=None, config_path="../conf", config_name='config')
+def main(cfg:DictConfig):
+    # Spans of every stage, written as JSON lines and summarised at the end of the run
+    METRICS.configure(enabled=cfg.metrics.enabled, jsonl=cfg.metrics.jsonl, prometheus=cfg.metrics.prometheus)
+    # MGRS tiles of the AOI (or the geometry of the listed tiles)
+    gdf_aoi = area_descriptor(cfg)
 
+    if cfg.scheduler.enabled:
+        # Download and transform all areas of the descriptor in pipelined stages
+        scheduler = PipelineScheduler(area_descriptor=gdf_aoi, imagery_directory=cfg.cache.feature_dir,
+                                      config=cfg.imagery,
+                                      download_workers=cfg.scheduler.download_workers,
+                                      transform_workers=cfg.scheduler.transform_workers,
+                                      queue_size=cfg.scheduler.queue_size,
+                                      retries=cfg.scheduler.retries)
+        scheduler.run()
+    else:
+        dataset = AreaDataset(area_descriptor=gdf_aoi, imagery_directory=cfg.cache.feature_dir, config=cfg.imagery)
+        for idx in range(len(dataset)):
+            try:
+                dataset[idx]
+            except Exception as e:
+                log.info(f"Failed to process area {idx}: {e}")
 
     log.info('Data is retrieved')
+    METRICS.report()
+    METRICS.close()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,21 +1,33 @@
-import datetime
+import shapely
 from shapely.geometry import box, shape
 from pathlib import Path
-from typing import Tuple, Dict
+from typing import Tuple, Dict, List, Optional
 import numpy as np
 import pandas as pd
 import geopandas as gpd
 import tempfile
+import time
 import os
-import glob
 import re
 import logging
-import requests
-import tqdm
 import xml.etree.ElementTree as ET
-from omegaconf import DictConfig
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from omegaconf import DictConfig, ListConfig, OmegaConf
 from code.exception import OperatorInteractionException
-from code.tx import Tx
+from code.metrics import span, timed
+from code.band_cache import BandCache
+from code.catalogue_store import CatalogueStore
+from code.datacube import ZarrCubeSink
+from code.manifest import Manifest, params_hash
+from code.session import TokenManager, build_session, TOKEN_URL
+from code.remote_reader import read_window, resolve_url
+from code.transfer import download_files, download_stream
+from code.memory_store import MemoryStore
+from code.raster_index import RasterIndex
+from code.radiometry import Radiometry, boa_offsets
+from code.tile_index import coverage_ratio
+from code.tx import Tx, build_profile, band_name
 
 log = logging.getLogger(__name__)
 logging.getLogger('rasterio._filepath').setLevel(logging.ERROR)
@@ -25,14 +37,55 @@ class CopernicusHubOperator():
                  api_url:str,
                  api_id: str,
                  api_secret: str,
-                 cache_dir: Path):
+                 cache_dir: Path,
+                 max_workers: int = 4,
+                 chunk_size: int = 1024*1024,
+                 pool_size: int = 8,
+                 retries: int = 5,
+                 backoff_factor: float = 1.0,
+                 token_url: str = TOKEN_URL,
+                 token_manager: Optional[TokenManager] = None,
+                 band_cache_dir: Optional[Path] = None,
+                 band_cache_max_size: int = 50 * 1024**3,
+                 catalogue_db: Optional[Path] = None,
+                 catalogue_search_ttl: float = 24 * 3600,
+                 catalogue_metadata_ttl: float = 30 * 24 * 3600,
+                 offline: bool = False,
+                 partial_read: bool = False,
+                 manifest_db: Optional[Path] = None,
+                 verify_checksum: bool = False,
+                 memory_budget: Optional[int] = None):
         self.config = {'user': api_id,
                        'password': api_secret,
                        'api_url':  api_url
                        }
+        # Copernicus Data Space allows 4 concurrent connections per user
+        self.max_workers = max_workers
+        self.chunk_size = chunk_size
+        # Read only the windows of the bands intersecting the AOI
+        self.partial_read = partial_read
         self.data_folder = cache_dir
         self.data_folder.mkdir(parents=True, exist_ok=True)
-        self.session_starttime = datetime.datetime(2000,1,1,0,0,0)
+        # One keep-alive connection pool per operator, the token manager can be shared between operators
+        self.token_manager = token_manager or TokenManager(
+            username=api_id, password=api_secret, token_url=token_url,
+            session=build_session(pool_size=1, retries=retries, backoff_factor=backoff_factor))
+        self.session = build_session(token_manager=self.token_manager, pool_size=max(pool_size, max_workers),
+                                     retries=retries, backoff_factor=backoff_factor)
+        # Downloaded bands survive between runs, keyed by product uuid, band and resolution
+        self.band_cache = BandCache(band_cache_dir or self.data_folder / 'bands', max_size=band_cache_max_size)
+        # Search responses and product metadata of the catalogue, offline mode answers from it only
+        self.catalogue = CatalogueStore(catalogue_db or self.data_folder / 'catalogue.sqlite',
+                                        search_ttl=catalogue_search_ttl, metadata_ttl=catalogue_metadata_ttl,
+                                        offline=offline)
+        # Bands and intermediates of imagery() held in memory up to memory_budget bytes, disk-based without
+        self.memory_budget = memory_budget
+        # Completed outputs, finished products are not downloaded again
+        self.manifest = Manifest(manifest_db or self.data_folder / 'manifest.sqlite', verify_checksum=verify_checksum)
+        self.skipped = False
+        # Candidates of the last tile search
+        self.candidates = None
+        self.candidates_query = None
 
     def imagery(self,
                 area_coords: Tuple,
@@ -42,6 +95,35 @@ class CopernicusHubOperator():
                 tile_id:str,
                 resolution: int = 10) -> tuple[Dict[str, np.ndarray], tuple[int, int]]:
 
+        # Download product and process bands, in memory buffers spilling to tmpfolder with a memory budget
+        with tempfile.TemporaryDirectory(dir=self.data_folder) as tmpfolder, \
+                (MemoryStore(self.memory_budget, spill_dir=tmpfolder) if self.memory_budget else nullcontext()) as store:
+            sample = self.fetch(area_coords=area_coords, start_date=start_date, end_date=end_date, cfg=cfg,
+                                tile_id=tile_id, resolution=resolution, local_dir=tmpfolder, store=store)
+            if len(sample) > 0:
+                try:
+                    transform_product(sample, self.product, cfg, self.data_folder, tmpfolder, store=store)
+                except Exception:
+                    log.exception("Sample transformation failed")
+
+    def fetch(self,
+              area_coords: Tuple,
+              start_date: str,
+              end_date: str,
+              cfg: DictConfig,
+              tile_id:str,
+              resolution: int,
+              local_dir: str,
+              store: Optional[MemoryStore] = None) -> List:
+        """Select the product of the area and download its bands, the selected product is kept in `self.product`.
+
+        With compositing enabled, the least cloudy products of the tile are downloaded with their
+        scene classification and returned as scenes for `composite`. Products whose output is complete
+        in the manifest with the same processing parameters are skipped: nothing is returned and
+        `self.skipped` is set. With a store, downloaded bands are kept in its memory buffers.
+        """
+        self.skipped = False
+
         # Scan of S2 products for search period: max output selection is 20 products
         self.bbox_aoi = box(*area_coords)
         self.bands = cfg.bands
@@ -54,31 +136,98 @@ class CopernicusHubOperator():
                                     product_type=cfg.product_type,
                                     tile_id=tile_id,
                                     cloud_coverage_max=cfg.cloud_coverage_max)
+        if len(self.product) == 0:
+            return []
+
+        # Output already built with the same processing parameters
+        if cfg.composite.enabled:
+            products = self.ranked.sort_values('cloudCover').head(cfg.composite.max_products)['Id'].tolist()
+            output_uuid = composite_uuid(self.product['tile'], start_date, end_date, cfg.composite.method)
+        else:
+            products, output_uuid = None, self.product['uuid']
+        params = output_params(cfg, resolution, area_coords, products)
+        entry = self.manifest.completed(output_uuid, params_hash(params))
+        if entry is not None:
+            log.info(f"Output {entry['path']} is up to date, skipping product {output_uuid}")
+            self.product.update({'uuid': output_uuid, 'params_hash': entry['params_hash']})
+            self.skipped = True
+            return []
+
+        if cfg.composite.enabled:
+            scenes = self.fetch_scenes(start_date=start_date, end_date=end_date, resolution=resolution,
+                                       local_dir=local_dir, max_products=cfg.composite.max_products,
+                                       method=cfg.composite.method, store=store)
+            self.product.update({'params_hash': params_hash(params), 'params': params})
+            return scenes
+
+        sample = self.download_product(product_id=self.product['uuid'],
+                                       product_name=self.product['name'],
+                                       resolution=resolution,
+                                       local_dir=local_dir,
+                                       store=store)
+        self.product.update({'params_hash': params_hash(params), 'params': params})
+        if len(sample) == 0:
+            log.info("Download request failed")
+            raise OperatorInteractionException(
+                'CopernicusHub operator interaction not possible. Please check the account devices activity : https://dataspace.copernicus.eu/')
+        missing = missing_bands(sample, self.bands)
+        if missing:
+            # A partial band set is neither transformed nor recorded as complete, a retry reads the cached bands
+            raise OperatorInteractionException(f"Bands {', '.join(missing)} of product {self.product['name']} "
+                                               "could not be downloaded")
+        return sample
+
+    def fetch_scenes(self, start_date: str, end_date: str, resolution: int, local_dir: str,
+                     max_products: int, method: str, store: Optional[MemoryStore] = None) -> List[Dict]:
+        """Download the max_products least cloudy products of the last tile selection with their SCL band"""
+        scenes = []
+        for _, row in self.ranked.sort_values('cloudCover').head(max_products).iterrows():
+            self.product = self._product_from_row(row)
+            scene_dir = os.path.join(local_dir, str(self.product['uuid']))
+            os.makedirs(scene_dir, exist_ok=True)
+            try:
+                bands = self.download_product(product_id=self.product['uuid'],
+                                              product_name=self.product['name'],
+                                              resolution=resolution,
+                                              local_dir=scene_dir,
+                                              scl=True,
+                                              store=store)
+            except OperatorInteractionException as e:
+                log.info(f"Product {self.product['name']} left out of the composite: {e}")
+                continue
+            if not missing_bands(bands, self.bands):
+                scenes.append({'uuid': self.product['uuid'],
+                               'bands': sorted(bands, key=band_name),
+                               'scl': self.product.get('scl'),
+                               'cloudcoverage': float(self.product['cloudcoverage']),
+                               'product_date': self.product['product_date'],
+                               'quantification': self.product.get('quantification', 10000.0),
+                               'boa_offsets': self.product.get('boa_offsets', {})})
+        if len(scenes) == 0:
+            raise OperatorInteractionException('No product of the composite could be downloaded')
+        tile = self.product['tile']
+        self.product = {'uuid': composite_uuid(tile, start_date, end_date, method),
+                        'tile': tile,
+                        'product_date': f"{start_date[:10]}_{end_date[:10]}",
+                        'products': [scene['uuid'] for scene in scenes],
+                        'cloudcoverage': float(np.mean([scene['cloudcoverage'] for scene in scenes])),
+                        # The BOA offsets of each scene are applied when it is read by the composite
+                        'quantification': scenes[0]['quantification'],
+                        'bands': self.bands,
+                        'num_bands': len(self.bands),
+                        'composite': method}
+        return scenes
 
-        # Download product and process bands
-        if len(self.product)>0:
-            with tempfile.TemporaryDirectory(dir=self.data_folder) as tmpfolder:
-                self.download_product(product_id=self.product['uuid'],
-                                      product_name=self.product['name'],
-                                      local_dir=tmpfolder,
-                                      resolution=resolution)
-                if len(os.listdir(tmpfolder)) > 1:
-                    try:
-                        sample = glob.glob(f'{tmpfolder}/*.jp2')
-                        sample.sort()
-                        tx = Tx(sample, uuid=self.product['uuid'], local_dir=self.data_folder,
-                           tile=self.product['tile'], date=self.product['product_date'], format=cfg.format)
-                        tx.etl_process(tmpfolder)
-                    except Exception:
-                        log.exception("Sample transformation failed")
-                else:
-                    log.info("Download request failed")
-                    raise OperatorInteractionException(
-                        'CopernicusHub operator interaction not possible. Please check the account devices activity : https://dataspace.copernicus.eu/')
     def read_product_metadata(self, uuid):
         try:
-            meta_url = f"{self.config['api_url']}/Products({uuid})"
-            metadata = requests.get(meta_url).json()
+            metadata = self.catalogue.metadata(uuid)
+            if metadata is None:
+                if self.catalogue.offline:
+                    raise OperatorInteractionException(f"Product {uuid} is not in the catalogue cache")
+                meta_url = f"{self.config['api_url']}/Products({uuid})"
+                with span('metadata', product=uuid):
+                    metadata = self.session.get(meta_url).json()
+                self.catalogue.save_metadata(uuid, metadata)
             name = metadata['Name']
             return {'uuid': uuid,
                     'name': name,
@@ -89,33 +238,41 @@ class CopernicusHubOperator():
             log.info(f"Product uuid is wrong: {e}")
             return None
 
-    def download_product(self, product_id:str, product_name:str, local_dir:str, resolution:str):
-        # Download XML metadata file of the product
-        self.product.update(self.read_product_metadata(product_id))
-        try:
-            meta_url = f"{self.config['api_url']}/Products({product_id})/Nodes({product_name})/Nodes(MTD_MSIL2A.xml)/$value"
-            response = self.get_session().get(meta_url, allow_redirects=False)
-
-            while response.status_code in (301, 302, 303, 307):
-                meta_url = response.headers["Location"]
-                response = self.get_session().get(meta_url, allow_redirects=False)
-
-            #Save XML file into tempfolder
-            outfile = Path(f"{local_dir}/MTD_MSIL2A.xml")
-            outfile.write_bytes(response.content)
-        except Exception :
-            log.info("Request to download product metadat is failed")
+    @timed('download', product='product_id')
+    def download_product(self, product_id:str, product_name:str, resolution:str,
+                         local_dir:Optional[str]=None, scl:bool=False,
+                         store:Optional[MemoryStore]=None)->List[str]:
+        """Download the selected bands of a product and return their paths in the band cache.
+
+        Bands already in the cache are not requested again. With partial reads, only the windows
+        of the bands intersecting `self.bbox_aoi` are read into local_dir and their paths returned.
+        With scl, the 20 m scene classification is downloaded too and its path kept in
+        `self.product['scl']`. With a store, missing bands (and windows) are written to its memory
+        buffers instead of the band cache.
+        """
+        # Request the product metadata and its XML metadata file concurrently
+        meta_url = f"{self.config['api_url']}/Products({product_id})/Nodes({product_name})/Nodes(MTD_MSIL2A.xml)/$value"
+        outfile = self.band_cache.file(product_id, 'MTD_MSIL2A.xml')
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            metadata = executor.submit(self.read_product_metadata, product_id)
+            if self.band_cache.touch(outfile) is None:
+                mtd = executor.submit(download_files, self.get_session, [(meta_url, str(outfile))],
+                                      1, self.chunk_size)
+                if not mtd.result():
+                    log.info("Request to download product metadat is failed")
+            self.product.update(metadata.result() or {})
 
         # Read XML metadat file
         try:
-            xml_file = ET.fromstring(response.content)
+            xml_file = ET.parse(str(outfile)).getroot()
         except Exception as e:
             log.info(f"{e}. \n Rerun token access")
-            xml_file = ET.parse(str(outfile))
-            xml_file = xml_file.getroot()
+            raise OperatorInteractionException(f"Metadata file of product {product_name} is not readable")
 
         # Product meta data
-        band_location = [f"{product_name}/{f.text}.jp2".split("/") for f in xml_file.iter() for i in self.bands if f.tag == "IMAGE_FILE" and re.match(f".*_{i}_{str(resolution)}m", f.text)]
+        image_files = native_image_files([f.text for f in xml_file.iter() if f.tag == "IMAGE_FILE"],
+                                         self.bands, int(resolution))
+        band_location = [f"{product_name}/{image_file}.jp2".split("/") for _, image_file in image_files.values()]
         product_date = product_name.split("_")[2][:4] + "-" + product_name.split("_")[2][4:6] + "-" + product_name.split("_")[2][6:8]
         bands = [f[-1].split("_")[2] for f in band_location]
         self.product.update({ 'uuid':product_id,
@@ -127,40 +284,104 @@ class CopernicusHubOperator():
                         'orbitdirection': [f.text for f in xml_file.iter() if f.tag == 'SENSING_ORBIT_DIRECTION'][0],
                         'tile': product_name.split("_")[5][1:],
                         'nodata': [int(f.text) for f in xml_file.iter() if f.tag == 'SPECIAL_VALUE_INDEX'][0],
+                        # Processing baseline 04.00 and later shift the digital numbers by BOA_ADD_OFFSET
+                        'quantification': ([float(f.text) for f in xml_file.iter() if f.tag == 'BOA_QUANTIFICATION_VALUE']
+                                           or [10000.0])[0],
+                        'boa_offsets': boa_offsets(xml_file),
                         "bands":  bands,
                         'num_bands': len(bands),
                         })
-
-        # Build the url for each file using Nodes() method
-        for band_file in tqdm(band_location):
+        # Each band is downloaded at its native resolution and resampled to the target grid by the transforms
+        resolutions = {band: res for band, (res, _) in image_files.items()}
+        self.product['resolutions'] = resolutions
+        if scl:
+            # Scene classification of L2A products is only delivered at 20 and 60 m
+            scl_location = [f"{product_name}/{f.text}.jp2".split("/") for f in xml_file.iter() if f.tag == "IMAGE_FILE" and re.match(".*_SCL_20m", f.text)]
+            if 'SCL' not in resolutions:
+                band_location += scl_location[:1]
+                resolutions.update({'SCL': 20} if len(scl_location) > 0 else {})
+
+        # Build the url for each missing file using Nodes() method and download the bands concurrently
+        sample, jobs = {}, []
+        for band, band_file in zip(resolutions.keys(), band_location):
+            cached = self.band_cache.get(product_id, band, resolutions[band])
+            if cached is not None:
+                sample[band] = str(cached)
+                continue
             url = f"{self.config['api_url']}/Products({product_id})/Nodes({product_name})/Nodes({band_file[1]})/Nodes({band_file[2]})/Nodes({band_file[3]})/Nodes({band_file[4]})/Nodes({band_file[5]})/$value"
-            response = self.get_session().get(url, allow_redirects=False)
-
-            while response.status_code in (301, 302, 303, 307):
-                url = response.headers["Location"]
-                response = self.get_session().get(url, stream=True)
-
-            # Download the product into a local directory
-            with open(Path(local_dir)/band_file[5],'wb') as output_img:
-                for chunk in response.iter_content(chunk_size=8192):
-                    if chunk:
-                        output_img.write(chunk)
+            jobs.append((band, url))
+        if len(sample) > 0:
+            log.info(f"{len(sample)} of {len(band_location)} bands of {product_name} read from the band cache")
+
+        partial = self.partial_read and local_dir is not None
+        windows = {}
+        if partial and len(jobs) > 0:
+            windows = self._read_windows(dict(jobs), local_dir, store)
+            # Full-file download remains for the bands whose server does not support ranges
+            jobs = [(band, url) for band, url in jobs if windows[band] is None]
+            windows = {band: window for band, window in windows.items() if window is not None}
+
+        if store is not None and len(jobs) > 0:
+            # Band bytes go straight from the response into memory buffers, nothing is written to disk.
+            # The buffer is reserved from the Content-Length before the first byte is read, so the
+            # budget bounds the memory of the concurrent downloads.
+            def fetch_band(band, url):
+                try:
+                    output = download_stream(self.get_session, url,
+                                             lambda size: store.open(f"{band}_{resolutions[band]}m.jp2", size),
+                                             self.chunk_size)
+                    output.close()
+                    return output.name
+                except Exception as e:
+                    log.info(f"Download of band {band} failed: {e}")
+                    return None
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                buffers = dict(zip([band for band, _ in jobs], executor.map(fetch_band, *zip(*jobs))))
+            sample.update({band: path for band, path in buffers.items() if path is not None})
+            jobs = []
+        results = download_files(self.get_session,
+                                 [(url, str(self.band_cache.path(product_id, band, resolutions[band]))) for band, url in jobs],
+                                 max_workers=self.max_workers, chunk_size=self.chunk_size)
+        downloaded = {r['path'] for r in results}
+        for band, _ in jobs:
+            if str(self.band_cache.path(product_id, band, resolutions[band])) in downloaded:
+                sample[band] = str(self.band_cache.path(product_id, band, resolutions[band]))
+        self.band_cache.evict(protect=list(sample.values()) + [str(outfile)])
+        if partial:
+            # Local bands are clipped to the same window as the remote ones
+            windows.update(self._read_windows(sample, local_dir, store))
+            sample = windows
+        if scl:
+            self.product['scl'] = sample.pop('SCL', None)
+        return list(sample.values())
+
+    def _read_windows(self, paths: Dict[str, str], local_dir: str,
+                      store: Optional[MemoryStore] = None) -> Dict[str, Optional[str]]:
+        """Read the windows of the bands intersecting `self.bbox_aoi` into local_dir.
+
+        A remote band whose server does not support range requests is returned as None.
+        """
+        headers = {'Authorization': f"Bearer {self.token_manager.access_token()}"}
+
+        def read(band, path):
+            with span('window_read', band=band) as record:
+                if path.startswith(('http://', 'https://')):
+                    path, ranges = resolve_url(self.session, path)
+                    if not ranges:
+                        log.info(f"Server does not support range requests, downloading the full band {band}")
+                        return None
+                # The memory store reserves the size of the window
+                output_img = os.path.join(local_dir, f"{band}_window.tif") if store is None else \
+                    (lambda size: store.path(f"{band}_window.tif", size))
+                output_img = read_window(path, self.bbox_aoi, output_img, headers=headers)
+                record['bytes_written'] = os.path.getsize(output_img) if os.path.isfile(output_img) else 0
+                return output_img
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return dict(zip(paths.keys(), executor.map(read, paths.keys(), paths.values())))
 
     def get_session(self):
-        current_time = datetime.datetime.now()
-
-        if (current_time - self.session_starttime).seconds >= 600:
-            response = self.get_access_token(username=self.config['user'], password=self.config['password'])
-            self.tokens = response
-            self.session_starttime = current_time
-
-        access_token = self.tokens["access_token"]
-        # resfresh_token = response["refresh_token"]
-
-        session = requests.Session()
-        session.headers["Authorization"] = f"Bearer {access_token}"
-
-        return session
+        return self.session
 
     def select_product(self, api_url, platform_name, start_date, end_date, product_type, cloud_coverage_max,
                        out_crs='epsg:4326', bbox_aoi=None, tile_id=None):
@@ -179,29 +400,136 @@ class CopernicusHubOperator():
                                out_crs)
 
     def select_product_by_aoi(self, api_url,platform_name, start_date, end_date, product_type, out_crs, cloud_coverage_max, bbox_aoi):
-        search_query = f"{api_url}/Products?$filter=Collection/Name eq '{platform_name}'" \
-                       f" and Attributes/OData.CSC.StringAttribute/any(att:att/Name eq 'productType' and att/OData.CSC.StringAttribute/Value eq '{product_type}')" \
-                       f" and ContentDate/Start gt {str(start_date)} and ContentDate/Start lt {str(end_date)}" \
-                        f" and OData.CSC.Intersects(area=geography'SRID=4326;{bbox_aoi}')" \
-                       f" and Attributes/OData.CSC.DoubleAttribute/any(att:att/Name eq 'cloudCover' and att/OData.CSC.DoubleAttribute/Value le {float(cloud_coverage_max)})" \
-                       f"&$expand=Attributes"
-        response = requests.get(search_query).json()
-        df = pd.DataFrame.from_dict(response['value'])
-        try:
-            # Unpack Attributes
-            att = df['Attributes'].values
-            attrs = []
-            for item in att:
-                attrs.append([{i['Name']: i['Value']} for i in item])
-
-            df0 = pd.DataFrame([{k: v for d in i for k, v in d.items()} for i in attrs])
-            df1 = pd.concat([df, df0], axis=1)
-            self.products = df1.drop(['Attributes'], axis=1)
-
-        except Exception:
-            self.products = pd.DataFrame()
+        self.products = self.search_products(platform_name=platform_name,
+                                             product_type=product_type,
+                                             start_date=start_date,
+                                             end_date=end_date,
+                                             cloud_coverage_max=cloud_coverage_max,
+                                             aois=[bbox_aoi],
+                                             out_crs=out_crs,
+                                             api_url=api_url)
+        if self.products.empty:
             log.info(f"No products to download. Please change dates or Cloud coverage max level")
 
+    def search_products(self,
+                        platform_name: str,
+                        product_type: str,
+                        start_date: str,
+                        end_date: str,
+                        cloud_coverage_max: float,
+                        tile_ids: Optional[List[str]] = None,
+                        aois: Optional[List] = None,
+                        out_crs: str = 'epsg:4326',
+                        api_url: Optional[str] = None,
+                        batch_size: int = 40,
+                        page_size: int = 1000) -> gpd.GeoDataFrame:
+        """Search the catalogue for many tiles or AOIs at once.
+
+        Tile ids (or AOIs) are combined `batch_size` at a time into one OData filter, the result
+        pages of all queries are requested concurrently and the candidates are returned as one
+        GeoDataFrame. Candidates of a tile search are kept in `self.candidates` for
+        `select_product_by_tile`.
+        """
+        api_url = api_url or self.config['api_url']
+        base_filter = f"Collection/Name eq '{platform_name}'" \
+                      f" and Attributes/OData.CSC.StringAttribute/any(att:att/Name eq 'productType' and att/OData.CSC.StringAttribute/Value eq '{product_type}')" \
+                      f" and ContentDate/Start gt {str(start_date)} and ContentDate/Start lt {str(end_date)}" \
+                      f" and Attributes/OData.CSC.DoubleAttribute/any(att:att/Name eq 'cloudCover' and att/OData.CSC.DoubleAttribute/Value le {float(cloud_coverage_max)})"
+        filters = []
+        tile_ids = [str(t) for t in dict.fromkeys(tile_ids or [])]
+        for i in range(0, len(tile_ids), batch_size):
+            tiles = " or ".join([f"att/OData.CSC.StringAttribute/Value eq '{t}'" for t in tile_ids[i:i + batch_size]])
+            filters.append(f"{base_filter} and Attributes/OData.CSC.StringAttribute/any(att:att/Name eq 'tileId' and ({tiles}))")
+        # AOIs are geometries or WKT strings, the filters use their WKT and the offline search their bounds
+        aois = [shapely.from_wkt(aoi) if isinstance(aoi, str) else aoi for aoi in (aois or [])]
+        for i in range(0, len(aois), batch_size):
+            areas = " or ".join([f"OData.CSC.Intersects(area=geography'SRID=4326;{aoi}')" for aoi in aois[i:i + batch_size]])
+            filters.append(f"{base_filter} and ({areas})")
+
+        if self.catalogue.offline:
+            values = []
+            if len(tile_ids) > 0:
+                values += self.catalogue.find_products(product_type, start_date, end_date, cloud_coverage_max,
+                                                       tile_ids=tile_ids)
+            for aoi in aois:
+                values += self.catalogue.find_products(product_type, start_date, end_date, cloud_coverage_max,
+                                                       bbox=aoi.bounds)
+        else:
+            with span('search', tiles=len(tile_ids), aois=len(aois)) as record:
+                values = self._query_products(api_url, filters, page_size)
+                record['products'] = len(values)
+        products = self._products_to_frame(values)
+        if products.empty:
+            products = gpd.GeoDataFrame(products, geometry=[], crs=out_crs)
+        else:
+            products = products.drop_duplicates(subset='Id').reset_index(drop=True)
+            products = gpd.GeoDataFrame(products, crs=out_crs,
+                                        geometry=[shape(geo) for geo in products['GeoFootprint']])
+        if len(tile_ids) > 0:
+            self.candidates = products
+            self.candidates_query = {'query': (platform_name, product_type, str(start_date), str(end_date),
+                                               float(cloud_coverage_max)),
+                                     'tile_ids': set(tile_ids)}
+        return products
+
+    def _query_products(self, api_url: str, filters: List[str], page_size: int) -> List[Dict]:
+        """Read the products of the filters from the catalogue cache, refreshing it when needed.
+
+        Filters never synced are requested in full, expired ones only for the products
+        published after their last sync.
+        """
+        values, remote = [], {}
+        for query_filter in filters:
+            cached = self.catalogue.search(query_filter)
+            if cached is None:
+                remote[query_filter] = query_filter
+                continue
+            values += cached['values']
+            if not cached['fresh']:
+                remote[query_filter] = query_filter if cached['last_publication'] is None else \
+                    f"{query_filter} and PublicationDate gt {cached['last_publication']}"
+        synced_at = time.time()
+        for query_filter, new_values in zip(remote.keys(), self._request_pages(api_url, list(remote.values()), page_size)):
+            self.catalogue.save_search(query_filter, new_values, synced_at=synced_at)
+            values += new_values
+        return values
+
+    def _request_pages(self, api_url: str, filters: List[str], page_size: int) -> List[List[Dict]]:
+        """Read all result pages of each filter.
+
+        The first pages are requested concurrently, their `@odata.count` gives the remaining
+        pages which are then requested concurrently with $skip. `@odata.nextLink` is followed
+        when the server does not return a count.
+        """
+        queries = [f"{api_url}/Products?$filter={f}&$expand=Attributes&$top={page_size}&$count=True" for f in filters]
+        get_json = lambda url: self.session.get(url).json()
+        values = [[] for _ in queries]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            pages = []
+            for i, (search_query, response) in enumerate(zip(queries, executor.map(get_json, queries))):
+                values[i].extend(response.get('value', []))
+                count = response.get('@odata.count')
+                if count is not None:
+                    pages += [(i, f"{search_query}&$skip={skip}") for skip in range(page_size, int(count), page_size)]
+                else:
+                    while response.get('@odata.nextLink'):
+                        response = get_json(response['@odata.nextLink'])
+                        values[i].extend(response.get('value', []))
+            for (i, _), response in zip(pages, executor.map(get_json, [page for _, page in pages])):
+                values[i].extend(response.get('value', []))
+        return values
+
+    @staticmethod
+    def _products_to_frame(values: List[Dict]) -> pd.DataFrame:
+        """Unpack the `Attributes` of OData products into columns in one step."""
+        df = pd.DataFrame.from_records(values)
+        if df.empty or 'Attributes' not in df.columns:
+            return pd.DataFrame()
+        att = df['Attributes'].explode().dropna()
+        att = pd.DataFrame(att.tolist(), index=att.index)
+        attrs = att.pivot_table(index=att.index, columns='Name', values='Value', aggfunc='first')
+        return df.drop(['Attributes'], axis=1).join(attrs)
+
     def select_product_by_tile(self,
                                api_url,
                                platform_name,
@@ -211,83 +539,182 @@ class CopernicusHubOperator():
                                tile_id,
                                cloud_coverage_max,
                                out_crs='epsg:4326'):
-        # NOTE: to add selection by geometry add the following line -
-        # Read attributes
-        search_query = f"{api_url}/Products?$filter=Collection/Name eq '{platform_name}'" \
-                       f" and Attributes/OData.CSC.StringAttribute/any(att:att/Name eq 'productType' and att/OData.CSC.StringAttribute/Value eq '{product_type}')" \
-                       f" and ContentDate/Start gt {str(start_date)} and ContentDate/Start lt {str(end_date)}" \
-                       f" and Attributes/OData.CSC.StringAttribute/any(att:att/Name eq 'tileId' and att/OData.CSC.StringAttribute/Value eq '{str(tile_id)}')" \
-                       f" and Attributes/OData.CSC.DoubleAttribute/any(att:att/Name eq 'cloudCover' and att/OData.CSC.DoubleAttribute/Value le {float(cloud_coverage_max)})" \
-                       f"&$expand=Attributes"
-
-        response = requests.get(search_query).json()
-        df = pd.DataFrame.from_dict(response['value'])
-
-        try:
-            # Unpack Attributes
-            att = df['Attributes'].values
-            attrs = []
-            for item in att:
-                attrs.append([{i['Name']: i['Value']} for i in item])
-
-            df0 = pd.DataFrame([{k: v for d in i for k, v in d.items()} for i in attrs])
-            df1 = pd.concat([df, df0], axis=1)
-            self.products = df1.drop(['Attributes'], axis=1)
-
-        except Exception:
-            self.products = pd.DataFrame()
+        # Read candidates of a previous bulk search, search this tile alone otherwise
+        query = (platform_name, product_type, str(start_date), str(end_date), float(cloud_coverage_max))
+        if self.candidates_query is None or self.candidates_query['query'] != query \
+                or str(tile_id) not in self.candidates_query['tile_ids']:
+            self.search_products(platform_name=platform_name,
+                                 product_type=product_type,
+                                 start_date=start_date,
+                                 end_date=end_date,
+                                 cloud_coverage_max=cloud_coverage_max,
+                                 tile_ids=[tile_id],
+                                 out_crs=out_crs,
+                                 api_url=api_url)
+        if 'tileId' in self.candidates.columns:
+            self.products = self.candidates[self.candidates['tileId'] == str(tile_id)].reset_index(drop=True)
+        else:
+            self.products = self.candidates.iloc[0:0]
+        if self.products.empty:
             log.info(f"No products to download. Please change dates or Cloud coverage level: {tile_id}")
 
         if not self.products.empty:
-            products = gpd.GeoDataFrame(self.products, crs=out_crs,
-                                        geometry=[shape(geo) for geo in self.products['GeoFootprint']])
-
-            aoi = gpd.GeoDataFrame(geometry=[self.bbox_aoi], crs=out_crs)
-            aoi['area_aoi'] = aoi.area
+            # Part of the AOI covered by each product footprint, the newest product wins a tie
+            products = self.products.copy()
+            products['area_ratio'] = coverage_ratio(products.geometry.to_numpy(), self.bbox_aoi)
+            results = products.sort_values(['area_ratio', 'OriginDate'], ascending=False)
 
-            # Intersection of product and polygon of AOI
-            gdf_joined = gpd.overlay(df1=products, df2=aoi, how='union')
-            gdf_joined['area_joined'] = gdf_joined.area
-            gdf_joined['area_ratio'] = gdf_joined['area_joined'] / gdf_joined['area_aoi']
-            results = gdf_joined.groupby(['Id']).agg({'area_ratio': 'sum'}).reset_index()
-            results = results.sort_values('area_ratio', ascending=False)
-            results = products[products['Id'] == results['Id'].iloc[0]]
-            results = results.sort_values('OriginDate', ascending=False)
+            self.ranked = results.reset_index(drop=True)
 
             # Select the first row
             try:
-                self.product = {'uuid': results['Id'].iloc[0],
-                                'name': results["Name"].iloc[0],
-                                's3path': results["S3Path"].iloc[0],
-                                'tile': results['tileId'].iloc[0],
-                                'product_date': results['OriginDate'].iloc[0][:10],
-                                'cloudcoverage': results['cloudCover'].iloc[0],
-                                'bands': self.bands,
-                                'num_bands': len(self.bands),
-                                'orbit': results['relativeOrbitNumber'].iloc[0],
-                                'geom': results["geometry"].iloc[0].wkt
-                                }
+                self.product = self._product_from_row(results.iloc[0])
             except Exception:
                 self.product = {}
         else:
+            self.ranked = self.products
             self.product = {}
 
-
-    def get_access_token(self, username: str, password: str) -> str:
-        data = {
-            "client_id": "cdse-public",
-            "username": username,
-            "password": password,
-            "grant_type": "password",
-        }
-        try:
-            r = requests.post("https://identity.dataspace.copernicus.eu/auth/realms/CDSE/protocol/openid-connect/token",
-                              data=data,
-                              )
-            r.raise_for_status()
-        except Exception:
-            log.exception(
-                f"Access token creation failed. Response from the server was: {r.json()}"
-            )
-        return r.json()
-
+    def _product_from_row(self, row: pd.Series) -> Dict:
+        return {'uuid': row['Id'],
+                'name': row["Name"],
+                's3path': row["S3Path"],
+                'tile': row['tileId'],
+                'product_date': row['OriginDate'][:10],
+                'cloudcoverage': row['cloudCover'],
+                'bands': self.bands,
+                'num_bands': len(self.bands),
+                'orbit': row['relativeOrbitNumber'],
+                'geom': row["geometry"].wkt
+                }
+
+
+def native_image_files(image_files: List[str], bands: List[str], resolution: int) -> Dict[str, Tuple[int, str]]:
+    """Resolution and IMAGE_FILE of each band: the target resolution when the band is delivered at it,
+    its finest resolution otherwise (e.g. B05-B07, B11, B12 and SCL at 20 m for a 10 m target)"""
+    available = {}
+    for image_file in image_files:
+        match = re.match(r".*_(\w{3})_(\d{2})m$", image_file)
+        if match is not None:
+            available.setdefault(match.group(1), {})[int(match.group(2))] = image_file
+    selected = {}
+    for band in bands:
+        if band not in available:
+            log.info(f"Band {band} is not in the product")
+            continue
+        res = resolution if resolution in available[band] else min(available[band])
+        selected[band] = (res, available[band][res])
+    return selected
+
+
+def transform_product(sample: List, product: Dict, cfg: DictConfig, output_dir: Path, tempfolder: str,
+                      store: Optional[MemoryStore] = None) -> str:
+    """Transform the downloaded bands of a product (or the scenes of a composite) into `{uuid}.tif` in output_dir,
+    or append them to the datacube of the tile with the zarr sink, and return the written GeoTIFF"""
+    bands = sample[0]['bands'] if cfg.composite.enabled else sorted(sample, key=band_name)
+    if cfg.composite.enabled and not cfg.radiometry.boa_offset:
+        sample = [{**scene, 'boa_offsets': {}} for scene in sample]
+    sink = sink_from_config(cfg.sink)
+    index = RasterIndex(Path(cfg.local_index.db)) if cfg.local_index.enabled else None
+    with span('transform', product=product['uuid']) as record:
+        record['bytes_read'] = sum(os.path.getsize(band) for band in bands if os.path.isfile(band))
+        tx = Tx(bands, uuid=product['uuid'], local_dir=output_dir,
+                tile=product['tile'], date=product['product_date'], format=cfg.format,
+                reproject_4326=cfg.transform.warp.enabled,
+                block_size=cfg.transform.block_size, num_threads=cfg.transform.num_threads,
+                fused=cfg.transform.fused, profile=build_profile(**cfg.output),
+                sink=sink, metadata=product, store=store, resampling=cfg.transform.resampling,
+                warp=warp_options(cfg.transform.warp), index=index,
+                radiometry=radiometry_from_config(cfg, product),
+                grid_resolution=float(cfg.resolution))
+        if cfg.composite.enabled:
+            tx.etl_process_composite(sample, tempfolder, method=cfg.composite.method)
+        else:
+            tx.etl_process_tile(tempfolder)
+        record['bytes_written'] = os.path.getsize(tx.output) if os.path.isfile(tx.output) else 0
+    if product.get('params_hash') and (cfg.composite.enabled or not missing_bands(sample, cfg.bands)):
+        # The output is complete, later runs with the same parameters skip the product
+        manifest = Manifest(Path(cfg.manifest.db))
+        if sink is None:
+            manifest.record(product['uuid'], product['params_hash'], tx.output, params=product.get('params'),
+                            checksum=cfg.manifest.checksum)
+        else:
+            manifest.record(product['uuid'], product['params_hash'], str(sink.store_path(product['tile'])),
+                            params=product.get('params'), size=False)
+    return tx.output
+
+
+def missing_bands(sample: List[str], bands: List[str]) -> List[str]:
+    """Bands missing from the downloaded band paths of a sample"""
+    downloaded = {band_name(path) for path in sample}
+    return [band for band in bands if band not in downloaded]
+
+
+def composite_uuid(tile: str, start_date: str, end_date: str, method: str) -> str:
+    return f"{tile}_{start_date[:10]}_{end_date[:10]}_{method}"
+
+
+def warp_options(config: DictConfig) -> Dict:
+    """Keyword arguments of the reprojection to EPSG:4326 from the transform.warp section"""
+    resolution = config.resolution
+    return {'resolution': list(resolution) if isinstance(resolution, ListConfig) else resolution,
+            'warp_threads': config.threads, 'warp_mem_limit': config.mem_limit_mb}
+
+
+def output_params(cfg: DictConfig, resolution: int, area_coords: Tuple, products: Optional[List[str]] = None) -> Dict:
+    """Processing parameters an output depends on, outputs in EPSG:4326 add the warp options"""
+    params = {'bands': list(cfg.bands),
+              'resolution': int(resolution),
+              'format': cfg.format,
+              'resampling': cfg.transform.resampling,
+              # Partial reads clip the bands to the AOI
+              'clip': box(*area_coords).wkt if cfg.download.partial_read else None,
+              'output': OmegaConf.to_container(cfg.output, resolve=True),
+              'sink': cfg.sink.type,
+              'radiometry': OmegaConf.to_container(cfg.radiometry, resolve=True),
+              'composite': {'method': cfg.composite.method, 'products': products} if cfg.composite.enabled else None}
+    if cfg.transform.warp.enabled and not cfg.composite.enabled:
+        params['warp'] = {'crs': 'epsg:4326', 'resolution': warp_options(cfg.transform.warp)['resolution']}
+    return params
+
+
+def radiometry_from_config(cfg: DictConfig, product: Dict) -> Optional[Radiometry]:
+    """Radiometric stage of the transforms with the BOA offsets of the product, None to keep the digital
+    numbers. Without a dtype, format UINT8 maps the reflectances to uint8."""
+    config = cfg.radiometry
+    dtype = config.dtype or ('uint8' if cfg.format == 'UINT8' else None)
+    if dtype is None:
+        return None
+    return Radiometry(dtype=dtype, quantification=product.get('quantification', 10000.0),
+                      boa_offsets=product.get('boa_offsets') if config.boa_offset else None,
+                      scale=OmegaConf.to_container(config.scale), offset=OmegaConf.to_container(config.offset),
+                      stretch=config.stretch, value_range=tuple(config.range),
+                      percentiles=tuple(config.percentiles), nodata=config.nodata)
+
+
+def sink_from_config(config: DictConfig) -> Optional[ZarrCubeSink]:
+    """Output sink of the transforms, None for the `{uuid}.tif` GeoTIFF outputs"""
+    if config.type == 'zarr':
+        return ZarrCubeSink(Path(config.zarr_dir), chunk_size=config.chunk_size, compressor=config.compressor)
+    return None
+
+
+def operator_from_config(config: DictConfig, cache_dir: Path,
+                         token_manager: Optional[TokenManager] = None) -> CopernicusHubOperator:
+    """CopernicusHubOperator configured from the imagery section of the configuration"""
+    return CopernicusHubOperator(api_url=config.api_url, api_id=config.api_id, api_secret=config.api_secret,
+                                 cache_dir=Path(cache_dir),
+                                 max_workers=config.download.max_workers, chunk_size=config.download.chunk_size,
+                                 pool_size=config.session.pool_size, retries=config.session.retries,
+                                 backoff_factor=config.session.backoff_factor, token_url=config.session.token_url,
+                                 token_manager=token_manager,
+                                 band_cache_dir=Path(config.band_cache.dir),
+                                 band_cache_max_size=int(config.band_cache.max_size_gb * 1024**3),
+                                 catalogue_db=Path(config.catalogue.db),
+                                 catalogue_search_ttl=config.catalogue.search_ttl_hours * 3600,
+                                 catalogue_metadata_ttl=config.catalogue.metadata_ttl_days * 24 * 3600,
+                                 offline=config.catalogue.offline,
+                                 partial_read=config.download.partial_read,
+                                 manifest_db=Path(config.manifest.db),
+                                 verify_checksum=config.manifest.verify_checksum,
+                                 memory_budget=int(config.memory.budget_mb * 1024**2) if config.memory.enabled else None)
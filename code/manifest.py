@@ -0,0 +1,107 @@
+"""
+ Manifest of the completed outputs of the ETL
+"""
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import logging
+import threading
+from pathlib import Path
+from typing import Dict, Optional
+
+log = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outputs (
+    uuid TEXT,
+    params_hash TEXT,
+    path TEXT,
+    size INTEGER,
+    checksum TEXT,
+    params TEXT,
+    completed_at REAL,
+    PRIMARY KEY (uuid, params_hash)
+);
+CREATE INDEX IF NOT EXISTS outputs_path ON outputs (path);
+"""
+
+
+def params_hash(params: Dict) -> str:
+    """Stable hash of the processing parameters of an output"""
+    return hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+def file_checksum(path: str, chunk_size: int = 1024 * 1024) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Manifest():
+    """Outputs completed per product uuid and hash of the processing parameters.
+
+    An output is done when its row exists and the file still has the recorded size (and
+    checksum with verify_checksum). Rows of missing or truncated files and rows of other
+    parameters of the same uuid are dropped, so the product is processed again. The database
+    is shared by the processes of a run.
+    """
+    def __init__(self, db_path: Path, verify_checksum: bool = False):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.verify_checksum = verify_checksum
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(str(self.db_path), timeout=60, check_same_thread=False)
+        with self._lock, self.conn:
+            self.conn.executescript(SCHEMA)
+
+    def _valid(self, path: str, size: Optional[int], checksum: Optional[str]) -> bool:
+        if not os.path.exists(path):
+            return False
+        if size is None:
+            # Outputs appended to a datacube have no size of their own
+            return True
+        if os.path.getsize(path) != size:
+            return False
+        return not self.verify_checksum or checksum is None or file_checksum(path) == checksum
+
+    def completed(self, uuid: str, params_hash: str) -> Optional[Dict]:
+        """Entry of a valid output of uuid with these parameters, None when it has to be (re)built"""
+        with self._lock:
+            rows = self.conn.execute("SELECT params_hash, path, size, checksum FROM outputs WHERE uuid = ?",
+                                     (uuid,)).fetchall()
+        entry = None
+        for row_hash, path, size, checksum in rows:
+            if row_hash != params_hash:
+                log.info(f"Processing parameters of {uuid} changed, rebuilding {Path(path).name}")
+            elif self._valid(path, size, checksum):
+                entry = {'uuid': uuid, 'params_hash': row_hash, 'path': path, 'size': size, 'checksum': checksum}
+                continue
+            else:
+                log.info(f"Output {path} of {uuid} is missing or truncated, repairing it")
+            self.remove(uuid, row_hash)
+        return entry
+
+    def record(self, uuid: str, params_hash: str, path: str, params: Optional[Dict] = None,
+               checksum: bool = True, size: bool = True):
+        """Record the finished output of uuid, replacing the entries of other products written to path.
+
+        Without size, path is shared by many products (a datacube) and only checked for existence.
+        """
+        size = os.path.getsize(path) if size else None
+        checksum = file_checksum(path) if checksum and size is not None else None
+        with self._lock, self.conn:
+            if size is not None:
+                self.conn.execute("DELETE FROM outputs WHERE path = ? AND NOT (uuid = ? AND params_hash = ?)",
+                                  (str(path), uuid, params_hash))
+            self.conn.execute("INSERT OR REPLACE INTO outputs (uuid, params_hash, path, size, checksum, params, "
+                              "completed_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                              (uuid, params_hash, str(path), size, checksum,
+                               json.dumps(params, default=str) if params is not None else None, time.time()))
+
+    def remove(self, uuid: str, params_hash: str):
+        with self._lock, self.conn:
+            self.conn.execute("DELETE FROM outputs WHERE uuid = ? AND params_hash = ?", (uuid, params_hash))
@@ -0,0 +1,122 @@
+"""
+ In-memory rasters of a product in GDAL /vsimem/ buffers
+"""
+import os
+import uuid
+import logging
+import threading
+from typing import BinaryIO, Dict, Optional, Tuple
+from rasterio.io import MemoryFile
+
+log = logging.getLogger(__name__)
+
+
+def is_memory_path(path: str) -> bool:
+    return str(path).startswith('/vsimem/')
+
+
+class _BufferWriter():
+    """Writable MemoryFile of a store, its bytes stay in the store after close"""
+    def __init__(self, store: 'MemoryStore', name: str, size: int):
+        self.store = store
+        self.filename = name
+        self.memfile = MemoryFile(filename=name)
+        with store._lock:
+            store.files[self.memfile.name] = (self.memfile, size)
+
+    @property
+    def name(self) -> str:
+        return self.memfile.name
+
+    def write(self, data: bytes) -> int:
+        return self.memfile.write(data)
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        return self.memfile.seek(offset, whence)
+
+    def truncate(self):
+        # A MemoryFile can not be truncated, the restarted content goes into a new buffer
+        memfile = MemoryFile(filename=self.filename)
+        with self.store._lock:
+            _, size = self.store.files.pop(self.memfile.name)
+            self.store.files[memfile.name] = (memfile, size)
+        self.memfile.close()
+        self.memfile = memfile
+
+    def close(self):
+        pass
+
+
+class MemoryStore():
+    """Band and intermediate rasters of one product kept in `MemoryFile` buffers.
+
+    Paths returned by `write` and `path` are /vsimem/ paths read and written by GDAL like local
+    files, so the tx functions work on them unchanged. Once `budget` bytes are held, new files
+    spill to spill_dir on disk. Closing the store frees every buffer.
+    """
+    def __init__(self, budget: int, spill_dir: str):
+        self.budget = budget
+        self.spill_dir = spill_dir
+        self.used = 0
+        self.files: Dict[str, Tuple[MemoryFile, int]] = {}
+        self._lock = threading.Lock()
+
+    def _reserve(self, size: int) -> bool:
+        with self._lock:
+            if self.used + size > self.budget:
+                return False
+            self.used += size
+            return True
+
+    def _spill(self, name: str) -> str:
+        os.makedirs(self.spill_dir, exist_ok=True)
+        log.info(f"Memory budget of {self.budget / 1e6:.0f} MB reached, spilling {name} to disk")
+        # The band stays the first part of the name, e.g. B02_10m_1a2b3c4d.jp2
+        stem, ext = os.path.splitext(name)
+        return os.path.join(self.spill_dir, f"{stem}_{uuid.uuid4().hex[:8]}{ext}")
+
+    def write(self, name: str, data: bytes) -> str:
+        """Path of a file holding data, in memory when it fits into the budget"""
+        if not self._reserve(len(data)):
+            path = self._spill(name)
+            with open(path, 'wb') as f:
+                f.write(data)
+            return path
+        memfile = MemoryFile(data, filename=name)
+        with self._lock:
+            self.files[memfile.name] = (memfile, len(data))
+        return memfile.name
+
+    def open(self, name: str, size: Optional[int]) -> BinaryIO:
+        """File object to write a file of size bytes into, a buffer when it fits into the budget and
+        a spilled file otherwise (also when the size is unknown). Its path is its `name`."""
+        if size is None or not self._reserve(size):
+            return open(self._spill(name), 'wb')
+        return _BufferWriter(self, name, size)
+
+    def path(self, name: str, size_hint: int = 0) -> str:
+        """Path of a new raster of about size_hint bytes to be written by GDAL"""
+        if not self._reserve(size_hint):
+            return self._spill(name)
+        memfile = MemoryFile(filename=name)
+        with self._lock:
+            self.files[memfile.name] = (memfile, size_hint)
+        return memfile.name
+
+    def release(self, path: str):
+        with self._lock:
+            memfile, size = self.files.pop(path, (None, 0))
+            self.used -= size
+        if memfile is not None:
+            memfile.close()
+
+    def close(self):
+        for path in list(self.files):
+            self.release(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
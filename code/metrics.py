@@ -0,0 +1,212 @@
+"""
+ Per-stage spans of the ETL exported as JSON lines and Prometheus textfile
+"""
+import os
+import json
+import time
+import socket
+import inspect
+import logging
+import resource
+import threading
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+from typing import Dict, List, Optional
+
+log = logging.getLogger(__name__)
+
+# Processes spawned by the scheduler inherit the JSON lines file through the environment
+ENV_JSONL = 'ETL_METRICS_JSONL'
+
+
+def peak_rss() -> int:
+    """Peak resident set size of this process in bytes"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Metrics():
+    """Collector of the spans of the run.
+
+    A span is one stage of one product (search, token, transfer, stack, clip, ...) with its
+    duration, bytes read/written, HTTP requests and retries done by its thread, and the peak RSS
+    of the process. Finished spans are appended to a JSON lines file shared by all processes of
+    the run. When disabled, `span` returns a shared no-op context and nothing is recorded.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.jsonl = None
+        self.prometheus = None
+        self.local = threading.local()
+        self._lock = threading.Lock()
+        self._file = None
+        self.counters = {'http_requests': 0, 'http_retries': 0, 'http_redirects': 0}
+        jsonl = os.environ.get(ENV_JSONL)
+        if jsonl:
+            # Child process of a run, its spans are appended to the file of the parent
+            self.configure(enabled=True, jsonl=jsonl, mode='a')
+
+    def configure(self, enabled: bool = False, jsonl: Optional[str] = None, prometheus: Optional[str] = None,
+                  mode: str = 'w'):
+        self.close()
+        self.enabled = bool(enabled) and jsonl is not None
+        self.jsonl = str(jsonl) if self.enabled else None
+        self.prometheus = str(prometheus) if self.enabled and prometheus else None
+        if self.enabled:
+            os.makedirs(os.path.dirname(os.path.abspath(self.jsonl)), exist_ok=True)
+            if mode == 'w':
+                open(self.jsonl, 'w').close()
+            # O_APPEND in every process, each line lands at the end of the file whoever writes it
+            self._file = open(self.jsonl, 'a', buffering=1)
+            os.environ[ENV_JSONL] = self.jsonl
+        else:
+            os.environ.pop(ENV_JSONL, None)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def span(self, stage: str, **fields):
+        if not self.enabled:
+            return _NOOP
+        return self._span(stage, fields)
+
+    @contextmanager
+    def _span(self, stage: str, fields: Dict):
+        record = {'stage': stage, **fields}
+        stack = self.local.__dict__.setdefault('spans', [])
+        if stack and 'product' in stack[-1] and 'product' not in record:
+            record['product'] = stack[-1]['product']
+        record.update({'http_requests': 0, 'http_retries': 0})
+        stack.append(record)
+        start, wall = time.perf_counter(), time.time()
+        try:
+            yield record
+            record['status'] = 'ok'
+        except BaseException as e:
+            record['status'] = 'error'
+            record['error'] = type(e).__name__
+            raise
+        finally:
+            stack.pop()
+            record.update({'start': wall, 'seconds': time.perf_counter() - start, 'peak_rss': peak_rss(),
+                           'pid': os.getpid(), 'thread': threading.current_thread().name})
+            self._emit(record)
+
+    def _emit(self, record: Dict):
+        line = json.dumps(record, default=str)
+        with self._lock:
+            if self._file is not None:
+                self._file.write(line + '\n')
+
+    def on_response(self, response, *args, **kwargs):
+        """requests response hook counting requests, retries and redirects of the thread's spans"""
+        if not self.enabled:
+            return
+        retries = getattr(getattr(response, 'raw', None), 'retries', None)
+        retries = len(retries.history) if retries is not None else 0
+        with self._lock:
+            self.counters['http_requests'] += 1
+            self.counters['http_retries'] += retries
+            self.counters['http_redirects'] += int(response.is_redirect)
+        for record in self.local.__dict__.get('spans', []):
+            record['http_requests'] += 1
+            record['http_retries'] += retries
+
+    def read_records(self) -> List[Dict]:
+        if self.jsonl is None or not os.path.exists(self.jsonl):
+            return []
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+        with open(self.jsonl) as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def summary(self) -> Dict[str, Dict]:
+        """Per-stage totals of all spans of the JSON lines file"""
+        stages = {}
+        for record in self.read_records():
+            stages.setdefault(record['stage'], []).append(record)
+        summary = {}
+        for stage, records in stages.items():
+            seconds = sorted(r['seconds'] for r in records)
+            summary[stage] = {'count': len(records),
+                              'errors': sum(r.get('status') == 'error' for r in records),
+                              'seconds': sum(seconds),
+                              'p50': seconds[int(0.50 * (len(seconds) - 1))],
+                              'p95': seconds[int(0.95 * (len(seconds) - 1))],
+                              'bytes_read': sum(r.get('bytes_read', 0) for r in records),
+                              'bytes_written': sum(r.get('bytes_written', 0) for r in records),
+                              'http_requests': sum(r.get('http_requests', 0) for r in records),
+                              'http_retries': sum(r.get('http_retries', 0) for r in records),
+                              'peak_rss': max(r.get('peak_rss', 0) for r in records)}
+        return summary
+
+    def write_prometheus(self, summary: Dict[str, Dict], path: str):
+        """Write the summary for the node exporter textfile collector, atomically"""
+        metrics = {'etl_stage_spans_total': 'count', 'etl_stage_errors_total': 'errors',
+                   'etl_stage_seconds_total': 'seconds', 'etl_stage_seconds_p95': 'p95',
+                   'etl_stage_bytes_read_total': 'bytes_read', 'etl_stage_bytes_written_total': 'bytes_written',
+                   'etl_stage_http_requests_total': 'http_requests', 'etl_stage_http_retries_total': 'http_retries',
+                   'etl_stage_peak_rss_bytes': 'peak_rss'}
+        host = socket.gethostname()
+        lines = []
+        for name, key in metrics.items():
+            lines.append(f"# TYPE {name} {'counter' if name.endswith('_total') else 'gauge'}")
+            lines += [f'{name}{{stage="{stage}",host="{host}"}} {values[key]}' for stage, values in summary.items()]
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp, path)
+
+    def report(self) -> Dict[str, Dict]:
+        """Log the per-stage summary of the run and export it to Prometheus when configured"""
+        if not self.enabled:
+            return {}
+        summary = self.summary()
+        log.info(f"{'stage':<14}{'spans':>7}{'errors':>7}{'seconds':>10}{'p50':>8}{'p95':>8}"
+                 f"{'MB read':>10}{'MB written':>11}{'requests':>9}{'retries':>8}{'peak MB':>9}")
+        for stage, s in sorted(summary.items(), key=lambda item: -item[1]['seconds']):
+            log.info(f"{stage:<14}{s['count']:>7}{s['errors']:>7}{s['seconds']:>10.1f}{s['p50']:>8.2f}{s['p95']:>8.2f}"
+                     f"{s['bytes_read'] / 1e6:>10.1f}{s['bytes_written'] / 1e6:>11.1f}{s['http_requests']:>9}"
+                     f"{s['http_retries']:>8}{s['peak_rss'] / 1e6:>9.0f}")
+        if self.prometheus:
+            self.write_prometheus(summary, self.prometheus)
+        return summary
+
+
+_NOOP = nullcontext({})
+
+METRICS = Metrics()
+
+
+def span(stage: str, **fields):
+    """Context manager recording a span of stage, yields the record to add bytes or other fields to"""
+    return METRICS.span(stage, **fields)
+
+
+def timed(stage: str, **arguments):
+    """Decorator recording a span of stage per call.
+
+    arguments map span fields to argument names of the function (e.g. product='product_id'),
+    the size of the returned file (or list of files) is recorded as bytes written.
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not METRICS.enabled:
+                return func(*args, **kwargs)
+            bound = signature.bind(*args, **kwargs).arguments
+            fields = {field: bound[name] for field, name in arguments.items() if bound.get(name) is not None}
+            with METRICS.span(stage, **fields) as record:
+                result = func(*args, **kwargs)
+                files = [result] if isinstance(result, str) else result if isinstance(result, list) else []
+                files = [f for f in files if isinstance(f, str) and os.path.isfile(f)]
+                if files:
+                    record['bytes_written'] = sum(os.path.getsize(f) for f in files)
+                return result
+        return wrapper
+    return decorator
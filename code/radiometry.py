@@ -0,0 +1,140 @@
+"""
+ Radiometric mapping of the L2A digital numbers to the output values
+"""
+import logging
+from typing import Dict, List, Optional, Sequence, Tuple
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+
+log = logging.getLogger(__name__)
+
+# Band ids of the BOA_ADD_OFFSET elements of MTD_MSIL2A.xml
+S2_BAND_IDS = ['B01', 'B02', 'B03', 'B04', 'B05', 'B06', 'B07', 'B08', 'B8A', 'B09', 'B10', 'B11', 'B12']
+DTYPES = ('uint8', 'uint16', 'float32')
+STRETCHES = ('none', 'fixed', 'percentile')
+
+
+def boa_offsets(xml_root) -> Dict[str, int]:
+    """BOA_ADD_OFFSET of each band of an MTD_MSIL2A.xml, empty before processing baseline 04.00"""
+    return {S2_BAND_IDS[int(f.attrib['band_id'])]: int(f.text) for f in xml_root.iter()
+            if f.tag == 'BOA_ADD_OFFSET' and int(f.attrib.get('band_id', -1)) in range(len(S2_BAND_IDS))}
+
+
+class BandMapping():
+    """Mapping `DN * gain + bias` of one band clipped to [low, high] and cast to dtype, nodata kept.
+
+    uint16 blocks go through a 65536 entry lookup table computed once, other blocks through
+    in-place float32 operations.
+    """
+    def __init__(self, gain: float, bias: float, dtype: str, low: float, high: float,
+                 nodata: Optional[int] = None, out_nodata=0):
+        self.gain, self.bias = gain, bias
+        self.dtype = np.dtype(dtype)
+        self.low, self.high = low, high
+        self.nodata, self.out_nodata = nodata, out_nodata
+        self._lut = None
+
+    @property
+    def lut(self) -> np.ndarray:
+        if self._lut is None:
+            values = np.arange(65536, dtype=np.float64) * self.gain + self.bias
+            lut = np.clip(values, self.low, self.high).astype(self.dtype)
+            if self.nodata is not None and 0 <= self.nodata < 65536:
+                lut[self.nodata] = self.out_nodata
+            self._lut = lut
+        return self._lut
+
+    def __call__(self, block: np.ndarray) -> np.ndarray:
+        if block.dtype == np.uint16:
+            return np.take(self.lut, block)
+        out = block.astype(np.float32)
+        out *= np.float32(self.gain)
+        out += np.float32(self.bias)
+        np.clip(out, self.low, self.high, out=out)
+        if self.nodata is not None:
+            out[block == self.nodata] = self.out_nodata
+        return out.astype(self.dtype, copy=False)
+
+
+class Radiometry():
+    """Radiometric stage of the transforms.
+
+    The reflectance `(DN + BOA_ADD_OFFSET) / quantification` of a band is multiplied by its scale
+    and shifted by its offset, then stretched: 'fixed' maps value_range, 'percentile' the
+    percentiles of the band, to the output range (1..255 for uint8, 1..65535 for uint16, 0..1 for
+    float32), 'none' keeps reflectances (x255 for uint8, x quantification for uint16). Input nodata
+    pixels are written as 0 (NaN for float32) and valid pixels never take that value.
+    """
+    def __init__(self,
+                 dtype: str = 'uint8',
+                 quantification: float = 10000,
+                 boa_offsets: Optional[Dict[str, int]] = None,
+                 scale: Optional[Dict[str, float]] = None,
+                 offset: Optional[Dict[str, float]] = None,
+                 stretch: str = 'fixed',
+                 value_range: Tuple[float, float] = (0.0, 1.0),
+                 percentiles: Tuple[float, float] = (2.0, 98.0),
+                 nodata: Optional[int] = 0):
+        if dtype not in DTYPES:
+            raise ValueError(f"Unknown radiometry dtype {dtype}, expected one of {list(DTYPES)}")
+        if stretch not in STRETCHES:
+            raise ValueError(f"Unknown stretch {stretch}, expected one of {list(STRETCHES)}")
+        self.dtype = dtype
+        self.quantification = float(quantification)
+        self.boa_offsets = dict(boa_offsets or {})
+        self.scale = dict(scale or {})
+        self.offset = dict(offset or {})
+        self.stretch = stretch
+        self.value_range = tuple(value_range)
+        self.percentiles = tuple(percentiles)
+        self.nodata = nodata
+
+    @property
+    def out_nodata(self):
+        if self.nodata is None:
+            return None
+        return np.nan if self.dtype == 'float32' else 0
+
+    def _affine(self, band: str) -> Tuple[float, float]:
+        """gain and bias of the value `DN * gain + bias` of band before the stretch"""
+        scale = self.scale.get(band, 1.0)
+        return scale / self.quantification, self.boa_offsets.get(band, 0) * scale / self.quantification + \
+            self.offset.get(band, 0.0)
+
+    def _band_percentiles(self, src: rasterio.DatasetReader) -> Tuple[float, float]:
+        """DN percentiles of the valid pixels of a decimated read (served by the overviews when present)"""
+        factor = max(1, max(src.width, src.height) // 1024)
+        data = src.read(1, out_shape=(max(1, src.height // factor), max(1, src.width // factor)),
+                        resampling=Resampling.nearest)
+        if self.nodata is not None:
+            data = data[data != self.nodata]
+        if data.size == 0:
+            return 0.0, 1.0
+        return tuple(float(p) for p in np.percentile(data, self.percentiles))
+
+    def mapping(self, band: str, src: Optional[rasterio.DatasetReader] = None, src_offset: int = 0) -> BandMapping:
+        """Mapping of the DN of band, src is read for the percentile stretch with src_offset added to its
+        DN (the BOA offset of a scene already applied to the mapped data, e.g. by the composites)"""
+        gain, bias = self._affine(band)
+        if self.dtype == 'float32':
+            low, high = (-np.inf, np.inf) if self.stretch == 'none' else (0.0, 1.0)
+        else:
+            # Valid pixels stay above the nodata value
+            low, high = (1.0 if self.nodata is not None else 0.0), float(np.iinfo(self.dtype).max)
+        if self.stretch == 'none':
+            factor = {'uint8': 255.0, 'uint16': self.quantification, 'float32': 1.0}[self.dtype]
+            return BandMapping(gain * factor, bias * factor, self.dtype, low, high, self.nodata, self.out_nodata)
+        if self.stretch == 'percentile':
+            if src is None:
+                raise ValueError(f"The percentile stretch of band {band} needs its raster")
+            start, stop = sorted((p + src_offset) * gain + bias for p in self._band_percentiles(src))
+        else:
+            start, stop = self.value_range
+        factor = (1.0 if self.dtype == 'float32' else high) / max(stop - start, 1e-12)
+        return BandMapping(gain * factor, (bias - start) * factor, self.dtype, low, high, self.nodata,
+                           self.out_nodata)
+
+    def band_maps(self, bands: Sequence[str], srcs: List[rasterio.DatasetReader],
+                  src_offsets: Optional[Dict[str, int]] = None) -> List[BandMapping]:
+        return [self.mapping(band, src, (src_offsets or {}).get(band, 0)) for band, src in zip(bands, srcs)]
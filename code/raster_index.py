@@ -0,0 +1,247 @@
+"""
+ Spatial index of the rasters written to the local cache
+
+    python -m code.raster_index --db cache/rasters.sqlite list
+    python -m code.raster_index --db cache/rasters.sqlite query --bbox 1.35 43.55 1.50 43.65 --start 2023-05-01
+    python -m code.raster_index --db cache/rasters.sqlite evict --before 2023-01-01 --delete-files
+"""
+import os
+import json
+import time
+import sqlite3
+import logging
+import argparse
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+import rasterio
+import shapely
+from shapely.geometry import box, shape, mapping
+from rasterio.warp import transform_geom
+from code.manifest import params_hash
+
+log = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS rasters (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE,
+    uuid TEXT,
+    tile_id TEXT,
+    product_date TEXT,
+    bands TEXT,
+    resolution INTEGER,
+    format TEXT,
+    cloud_cover REAL,
+    composite TEXT,
+    crs TEXT,
+    params TEXT,
+    footprint TEXT,
+    size INTEGER,
+    added_at REAL
+);
+CREATE INDEX IF NOT EXISTS rasters_date ON rasters (product_date);
+CREATE VIRTUAL TABLE IF NOT EXISTS rasters_bbox USING rtree (id, minx, maxx, miny, maxy);
+"""
+
+COLUMNS = ['id', 'path', 'uuid', 'tile_id', 'product_date', 'bands', 'resolution', 'format', 'cloud_cover',
+           'composite', 'crs', 'params', 'footprint', 'size', 'added_at']
+# Processing parameters a raster depends on besides its bands, resolution and AOI
+RASTER_PARAMS = ('format', 'resampling', 'output', 'radiometry', 'warp')
+
+
+def raster_params(params: Dict) -> str:
+    """Hash of the processing parameters of a raster (output_params) an indexed raster must match"""
+    return params_hash({key: params.get(key) for key in RASTER_PARAMS})
+
+
+def footprint(src: rasterio.DatasetReader) -> shapely.Geometry:
+    """EPSG:4326 footprint of a raster, its edges densified to follow the curvature of the reprojection"""
+    edges = shapely.segmentize(box(*src.bounds), max(src.width * abs(src.transform.a),
+                                                    src.height * abs(src.transform.e)) / 16)
+    return shape(transform_geom(src.crs, 'EPSG:4326', mapping(edges)))
+
+
+class RasterIndex():
+    """R-tree over the EPSG:4326 footprints of the `{uuid}.tif` outputs of the cache.
+
+    Each raster is stored with its product date, bands, resolution, format and cloud cover, so an
+    AOI can be looked up locally before any catalogue search. Rasters removed from the disk are
+    dropped from the index when a query meets them.
+    """
+    def __init__(self, db_path: Path):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(str(self.db_path), timeout=60, check_same_thread=False)
+        with self._lock, self.conn:
+            self.conn.executescript(SCHEMA)
+            columns = [row[1] for row in self.conn.execute("PRAGMA table_info(rasters)")]
+            if 'params' not in columns:
+                # Entries of older indexes have no parameters and are never served
+                self.conn.execute("ALTER TABLE rasters ADD COLUMN params TEXT")
+
+    def add(self, path: str, product: Dict, bands: Optional[List[str]] = None):
+        """Index the raster at path written for product with bands in the order of its bands,
+        replacing an earlier entry of the same path"""
+        params = product.get('params') or {}
+        with rasterio.open(path) as src:
+            geometry = footprint(src)
+            crs = src.crs.to_string()
+            resolution = params.get('resolution') or int(round(abs(src.transform.a)))
+            data_format = params.get('format') or src.dtypes[0].upper()
+        row = {'path': str(path),
+               'uuid': str(product.get('uuid')),
+               'tile_id': product.get('tile'),
+               'product_date': product.get('product_date'),
+               'bands': json.dumps(list(bands or params.get('bands') or product.get('bands') or [])),
+               'resolution': int(resolution),
+               'format': data_format,
+               'cloud_cover': product.get('cloudcoverage'),
+               'composite': product.get('composite'),
+               'crs': crs,
+               'params': raster_params(params) if params else None,
+               'footprint': geometry.wkt,
+               'size': os.path.getsize(path),
+               'added_at': time.time()}
+        minx, miny, maxx, maxy = geometry.bounds
+        with self._lock, self.conn:
+            self._delete(self.conn.execute("SELECT id FROM rasters WHERE path = ?", (str(path),)).fetchall())
+            cursor = self.conn.execute(f"INSERT INTO rasters ({', '.join(row)}) VALUES ({', '.join('?' * len(row))})",
+                                       tuple(row.values()))
+            self.conn.execute("INSERT INTO rasters_bbox VALUES (?, ?, ?, ?, ?)",
+                              (cursor.lastrowid, minx, maxx, miny, maxy))
+        log.info(f"Indexed {path} of {row['tile_id']} {row['product_date']}")
+
+    def _delete(self, ids: List[Tuple]):
+        self.conn.executemany("DELETE FROM rasters WHERE id = ?", ids)
+        self.conn.executemany("DELETE FROM rasters_bbox WHERE id = ?", ids)
+
+    def _entry(self, row: Tuple) -> Dict:
+        entry = dict(zip(COLUMNS, row))
+        entry['bands'] = json.loads(entry['bands'])
+        return entry
+
+    def entries(self, tile_id: Optional[str] = None) -> List[Dict]:
+        query, args = f"SELECT {', '.join(COLUMNS)} FROM rasters", ()
+        if tile_id is not None:
+            query, args = query + " WHERE tile_id = ?", (tile_id,)
+        with self._lock:
+            rows = self.conn.execute(query + " ORDER BY tile_id, product_date", args).fetchall()
+        return [self._entry(row) for row in rows]
+
+    def query(self,
+              area_coords: Tuple,
+              start_date: Optional[str] = None,
+              end_date: Optional[str] = None,
+              bands: Optional[Sequence[str]] = None,
+              resolution: Optional[int] = None,
+              data_format: Optional[str] = None,
+              max_cloud: Optional[float] = None,
+              min_coverage: float = 1.0,
+              params: Optional[str] = None) -> List[Dict]:
+        """Indexed rasters covering at least min_coverage of the AOI bounds with the requested bands,
+        resolution and format, within the dates and cloud cover, the best covering and least cloudy first.
+
+        params is the `raster_params` of the current processing parameters (CRS, resampling,
+        radiometry, output profile), rasters processed otherwise are left out.
+        """
+        aoi = box(*area_coords)
+        minx, miny, maxx, maxy = area_coords
+        query = (f"SELECT {', '.join('r.' + c for c in COLUMNS)} FROM rasters r JOIN rasters_bbox b ON r.id = b.id "
+                 "WHERE b.minx <= ? AND b.maxx >= ? AND b.miny <= ? AND b.maxy >= ? AND r.composite IS NULL")
+        args = [maxx, minx, maxy, miny]
+        for condition, value in (("r.product_date >= ?", start_date and str(start_date)[:10]),
+                                 ("r.product_date <= ?", end_date and str(end_date)[:10]),
+                                 ("r.resolution = ?", resolution and int(resolution)),
+                                 ("r.format = ?", data_format),
+                                 ("r.cloud_cover <= ?", max_cloud),
+                                 ("r.params = ?", params)):
+            if value is not None:
+                query += f" AND {condition}"
+                args.append(value)
+        with self._lock:
+            rows = self.conn.execute(query, args).fetchall()
+
+        entries, missing = [], []
+        for row in rows:
+            entry = self._entry(row)
+            if bands is not None and not set(bands) <= set(entry['bands']):
+                continue
+            entry['coverage'] = shapely.from_wkt(entry['footprint']).intersection(aoi).area / aoi.area
+            if entry['coverage'] < min_coverage:
+                continue
+            if not os.path.isfile(entry['path']):
+                missing.append((entry['id'],))
+                continue
+            entries.append(entry)
+        if missing:
+            log.info(f"Dropping {len(missing)} rasters missing from the cache from the index")
+            with self._lock, self.conn:
+                self._delete(missing)
+        return sorted(entries, key=lambda e: (-e['coverage'], e['cloud_cover'] or 0.0, e['product_date']))
+
+    def evict(self,
+              uuid: Optional[str] = None,
+              before: Optional[str] = None,
+              missing: bool = False,
+              delete_files: bool = False) -> int:
+        """Remove the entries of uuid, of products older than the date before or of missing files,
+        and their rasters with delete_files. Returns the number of removed entries."""
+        evicted = []
+        for entry in self.entries():
+            if (uuid is not None and entry['uuid'] == uuid) or \
+                    (before is not None and (entry['product_date'] or '') < str(before)[:10]) or \
+                    (missing and not os.path.isfile(entry['path'])):
+                evicted.append(entry)
+        for entry in evicted:
+            if delete_files and os.path.isfile(entry['path']):
+                os.remove(entry['path'])
+        with self._lock, self.conn:
+            self._delete([(entry['id'],) for entry in evicted])
+        log.info(f"Evicted {len(evicted)} rasters from {self.db_path}")
+        return len(evicted)
+
+
+def _print(entries: List[Dict]):
+    print(f"{'uuid':<38}{'tile':<7}{'date':<12}{'res':>4}{'format':>8}{'cloud':>7}{'MB':>8}  bands")
+    for e in entries:
+        print(f"{e['uuid']:<38}{e['tile_id'] or '':<7}{e['product_date'] or '':<12}{e['resolution']:>4}"
+              f"{e['format']:>8}{e['cloud_cover'] or 0.0:>7.1f}{e['size'] / 1e6:>8.1f}  {','.join(e['bands'])}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', default='cache/rasters.sqlite', help='index database')
+    commands = parser.add_subparsers(dest='command', required=True)
+    listing = commands.add_parser('list', help='list the indexed rasters')
+    listing.add_argument('--tile', help='MGRS tile id')
+    query = commands.add_parser('query', help='rasters covering an EPSG:4326 bounding box')
+    query.add_argument('--bbox', type=float, nargs=4, required=True, metavar=('MINX', 'MINY', 'MAXX', 'MAXY'))
+    query.add_argument('--start', help='first product date')
+    query.add_argument('--end', help='last product date')
+    query.add_argument('--bands', nargs='+', help='bands the rasters must hold')
+    query.add_argument('--resolution', type=int, help='resolution in metres')
+    query.add_argument('--max-cloud', type=float, help='maximum cloud cover')
+    query.add_argument('--min-coverage', type=float, default=1.0, help='minimum covered part of the bbox')
+    evict = commands.add_parser('evict', help='remove entries and optionally their rasters')
+    evict.add_argument('--uuid', help='product uuid')
+    evict.add_argument('--before', help='products older than this date')
+    evict.add_argument('--missing', action='store_true', help='entries whose raster is missing')
+    evict.add_argument('--delete-files', action='store_true', help='delete the rasters too')
+    args = parser.parse_args()
+
+    index = RasterIndex(Path(args.db))
+    if args.command == 'list':
+        _print(index.entries(tile_id=args.tile))
+    elif args.command == 'query':
+        _print(index.query(tuple(args.bbox), start_date=args.start, end_date=args.end, bands=args.bands,
+                           resolution=args.resolution, max_cloud=args.max_cloud, min_coverage=args.min_coverage))
+    else:
+        print(f"{index.evict(uuid=args.uuid, before=args.before, missing=args.missing, delete_files=args.delete_files)}"
+              " entries evicted")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,61 @@
+"""
+ Windowed reads of remote rasters through GDAL /vsicurl/
+"""
+import logging
+from typing import Callable, Dict, Optional, Tuple, Union
+import requests
+import rasterio
+from rasterio.features import geometry_window
+from rasterio.warp import transform_geom
+from rasterio.windows import transform as window_transform
+from shapely.geometry import mapping
+from code.transfer import follow_redirects
+
+log = logging.getLogger(__name__)
+
+
+def resolve_url(session:requests.Session, url:str)->Tuple[str, bool]:
+    """Follow the redirect chain of url and tell whether the final location serves HTTP Range requests."""
+    response = follow_redirects(session, url, stream=True, headers={'Range': 'bytes=0-0'})
+    with response:
+        response.raise_for_status()
+        return response.url, response.status_code == 206
+
+
+def gdal_http_options(headers:Optional[Dict[str, str]]=None)->Dict[str, str]:
+    options = {'GDAL_DISABLE_READDIR_ON_OPEN': 'EMPTY_DIR',
+               'GDAL_HTTP_MULTIRANGE': 'YES',
+               'GDAL_HTTP_MERGE_CONSECUTIVE_RANGES': 'YES',
+               'GDAL_HTTP_MAX_RETRY': '5',
+               'GDAL_HTTP_RETRY_DELAY': '1',
+               'VSI_CACHE': 'TRUE'}
+    if headers:
+        options['GDAL_HTTP_HEADERS'] = '\r\n'.join([f"{k}: {v}" for k, v in headers.items()])
+    return options
+
+
+def read_window(path:str, aoi, output_img:Union[str, Callable[[int], str]],
+                headers:Optional[Dict[str, str]]=None, aoi_crs:str='epsg:4326')->str:
+    """Read only the window of a raster intersecting aoi and write it as a GeoTIFF.
+
+    A http(s) path is opened through /vsicurl/ and has to serve HTTP Range requests,
+    GDAL then only transfers the bytes of the window. output_img may be a callable returning
+    the output path for the byte size of the window (e.g. a MemoryStore reservation).
+    """
+    if path.startswith(('http://', 'https://')):
+        path = f"/vsicurl/{path}"
+    with rasterio.Env(**gdal_http_options(headers)):
+        with rasterio.open(path) as src:
+            geom = transform_geom(aoi_crs, src.crs, mapping(aoi))
+            window = geometry_window(src, [geom])
+            data = src.read(window=window)
+            meta = src.meta.copy()
+    meta.update({'driver': 'GTiff',
+                 'height': data.shape[1],
+                 'width': data.shape[2],
+                 'transform': window_transform(window, meta['transform'])})
+    if callable(output_img):
+        output_img = output_img(data.nbytes)
+    with rasterio.open(output_img, 'w', **meta) as dest:
+        dest.write(data)
+    return output_img
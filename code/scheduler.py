@@ -0,0 +1,198 @@
+"""
+ Pipelined scheduler overlapping downloads and transforms of many areas
+"""
+import os
+import time
+import queue
+import shutil
+import logging
+import tempfile
+import threading
+import multiprocessing
+from pathlib import Path
+from typing import Dict, Optional, Union
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import pandas as pd
+import geopandas as gpd
+from omegaconf import DictConfig
+from code.dataset import AreaDataset
+from code.imagery_store import operator_from_config, transform_product
+
+log = logging.getLogger(__name__)
+
+_DONE = object()
+
+
+class PipelineScheduler():
+    """Run search -> download -> transform for every area of the descriptor.
+
+    Downloads run in a pool of `download_workers` threads, transforms in a pool of
+    `transform_workers` processes. At most `queue_size` downloaded products wait for a
+    transform, which bounds the disk used by the staging folders. A failing area is
+    retried `retries` times and then recorded without stopping the others.
+    """
+    def __init__(self,
+                 area_descriptor: Optional[Union[pd.DataFrame, gpd.GeoDataFrame]],
+                 imagery_directory: str,
+                 config: DictConfig,
+                 download_workers: int = 2,
+                 transform_workers: int = 2,
+                 queue_size: int = 4,
+                 retries: int = 2):
+        self.dataset = AreaDataset(area_descriptor=area_descriptor, imagery_directory=imagery_directory,
+                                   config=config)
+        self.config = config
+        self.imagery_dir = Path(imagery_directory)
+        self.download_workers = max(1, download_workers)
+        self.transform_workers = max(1, transform_workers)
+        self.retries = retries
+        self.ready = queue.Queue(maxsize=max(1, queue_size))
+        self.todo = queue.Queue()
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.stats = {'areas': len(self.dataset), 'done': 0, 'skipped': 0, 'cached': 0, 'empty': 0, 'failed': {},
+                      'download_seconds': 0.0, 'transform_seconds': 0.0, 'bytes': 0}
+
+    def _operator(self):
+        # One operator per download thread, all sharing the token manager and bulk search candidates
+        if not hasattr(self.local, 'operator'):
+            store = self.dataset.imagery_store
+            operator = operator_from_config(self.config, self.imagery_dir, token_manager=store.token_manager)
+            operator.candidates = store.candidates
+            operator.candidates_query = store.candidates_query
+            self.local.operator = operator
+        return self.local.operator
+
+    def _download_worker(self):
+        try:
+            while True:
+                idx = self.todo.get()
+                if idx is _DONE:
+                    return
+                try:
+                    area_coords, tile_id = self.dataset.area(idx)
+                except Exception as e:
+                    log.info(f"Area {idx} is not readable from the descriptor: {e}")
+                    with self.lock:
+                        self.stats['failed'][idx] = f"area: {e}"
+                    continue
+                self._download(idx, area_coords, tile_id)
+        finally:
+            # The run loop waits for one _DONE per download thread, even when a thread fails
+            self.ready.put(_DONE)
+
+    def _download(self, idx, area_coords, tile_id):
+        for attempt in range(self.retries + 1):
+            staging = tempfile.mkdtemp(dir=self.imagery_dir)
+            start = time.perf_counter()
+            try:
+                operator = self._operator()
+                sample = operator.fetch(area_coords=area_coords,
+                                        start_date=str(self.config.start_date),
+                                        end_date=str(self.config.end_date),
+                                        cfg=self.config,
+                                        tile_id=tile_id,
+                                        resolution=int(self.config.resolution),
+                                        local_dir=staging)
+                with self.lock:
+                    self.stats['download_seconds'] += time.perf_counter() - start
+                if len(sample) == 0:
+                    shutil.rmtree(staging, ignore_errors=True)
+                    with self.lock:
+                        self.stats['skipped' if operator.skipped else 'empty'] += 1
+                else:
+                    # Blocks while queue_size products wait for a transform
+                    self.ready.put((idx, sample, dict(operator.product), staging))
+                return
+            except Exception as e:
+                shutil.rmtree(staging, ignore_errors=True)
+                log.info(f"Download of area {idx} ({tile_id}) failed, attempt {attempt + 1}: {e}")
+                if attempt == self.retries:
+                    with self.lock:
+                        self.stats['failed'][idx] = f"download: {e}"
+
+    def _from_cache(self, idx) -> bool:
+        """Serve the area from an indexed raster of the local cache, without search, download nor transform"""
+        try:
+            product = self.dataset.from_cache(*self.dataset.area(idx))
+        except Exception as e:
+            log.info(f"Local index lookup of area {idx} failed: {e}")
+            return False
+        if product is None:
+            return False
+        with self.lock:
+            self.stats['cached'] += 1
+        return True
+
+    def run(self) -> Dict:
+        start = time.perf_counter()
+        areas = list(range(len(self.dataset)))
+        if self.dataset.raster_index is not None:
+            # Areas covered by the local index never reach the catalogue
+            areas = [idx for idx in areas if not self._from_cache(idx)]
+        if len(areas) > 0:
+            self.dataset.search(areas)
+        for idx in areas:
+            self.todo.put(idx)
+        for _ in range(self.download_workers):
+            self.todo.put(_DONE)
+        threads = [threading.Thread(target=self._download_worker, daemon=True) for _ in range(self.download_workers)]
+        for thread in threads:
+            thread.start()
+
+        running, attempts, finished = {}, {}, 0
+        with ProcessPoolExecutor(max_workers=self.transform_workers,
+                                 mp_context=multiprocessing.get_context('spawn')) as executor:
+            while finished < self.download_workers or running:
+                # Take new products only while a transform process is free
+                if finished < self.download_workers and len(running) < self.transform_workers:
+                    try:
+                        item = self.ready.get(timeout=0.1)
+                    except queue.Empty:
+                        item = None
+                    if item is _DONE:
+                        finished += 1
+                    elif item is not None:
+                        running[self._submit(executor, item)] = (item, time.perf_counter())
+                    if len(running) == 0:
+                        continue
+                done, _ = wait(list(running), timeout=0.1, return_when=FIRST_COMPLETED)
+                for future in done:
+                    item, submitted = running.pop(future)
+                    idx, sample, product, staging = item
+                    try:
+                        output_img = future.result()
+                        with self.lock:
+                            self.stats['done'] += 1
+                            self.stats['transform_seconds'] += time.perf_counter() - submitted
+                            self.stats['bytes'] += os.path.getsize(output_img)
+                        shutil.rmtree(staging, ignore_errors=True)
+                    except Exception as e:
+                        attempts[idx] = attempts.get(idx, 0) + 1
+                        log.info(f"Transform of area {idx} ({product['uuid']}) failed, attempt {attempts[idx]}: {e}")
+                        if attempts[idx] <= self.retries:
+                            running[self._submit(executor, item)] = (item, time.perf_counter())
+                        else:
+                            shutil.rmtree(staging, ignore_errors=True)
+                            with self.lock:
+                                self.stats['failed'][idx] = f"transform: {e}"
+        for thread in threads:
+            thread.join()
+        self.stats['seconds'] = time.perf_counter() - start
+        self.summary()
+        return self.stats
+
+    def _submit(self, executor, item):
+        idx, sample, product, staging = item
+        return executor.submit(transform_product, sample, product, self.config, self.imagery_dir, staging)
+
+    def summary(self):
+        stats = self.stats
+        seconds = max(stats['seconds'], 1e-9)
+        log.info(f"Processed {stats['done']}/{stats['areas']} areas in {seconds:.1f} s "
+                 f"({stats['done'] / seconds * 3600:.1f} areas/h, {stats['bytes'] / 1e6 / seconds:.1f} MB/s written), "
+                 f"{stats['skipped']} up to date, {stats['cached']} from the local index, "
+                 f"{stats['empty']} without product, {len(stats['failed'])} failed")
+        log.info(f"Busy time: download {stats['download_seconds']:.1f} s, transform {stats['transform_seconds']:.1f} s")
+        for idx, error in stats['failed'].items():
+            log.info(f"Area {idx} failed in {error}")
@@ -0,0 +1,110 @@
+"""
+ Pooled HTTP session and access token management
+"""
+import time
+import threading
+import logging
+from typing import Optional
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from code.exception import OperatorInteractionException
+from code.metrics import METRICS, span
+
+log = logging.getLogger(__name__)
+
+TOKEN_URL = "https://identity.dataspace.copernicus.eu/auth/realms/CDSE/protocol/openid-connect/token"
+
+
+class TokenManager():
+    """Thread-safe holder of the CopernicusHub tokens.
+
+    The access token is refreshed `refresh_margin` seconds before `expires_in` using the
+    refresh token, and a new login is done only when the refresh token has expired too.
+    """
+    def __init__(self,
+                 username: str,
+                 password: str,
+                 token_url: str = TOKEN_URL,
+                 client_id: str = 'cdse-public',
+                 refresh_margin: float = 60.0,
+                 session: Optional[requests.Session] = None):
+        self.username = username
+        self.password = password
+        self.token_url = token_url
+        self.client_id = client_id
+        self.refresh_margin = refresh_margin
+        self.session = session or requests.Session()
+        self.tokens = {}
+        self.expires_at = 0.0
+        self.refresh_expires_at = 0.0
+        self._lock = threading.Lock()
+
+    def access_token(self) -> str:
+        # Only one thread renews the token, the others wait and reuse it
+        with self._lock:
+            now = time.monotonic()
+            if now < self.expires_at - self.refresh_margin:
+                return self.tokens['access_token']
+            if self.tokens.get('refresh_token') and now < self.refresh_expires_at - self.refresh_margin:
+                try:
+                    self._request_token({'grant_type': 'refresh_token',
+                                         'refresh_token': self.tokens['refresh_token']})
+                    return self.tokens['access_token']
+                except OperatorInteractionException:
+                    log.info("Token refresh failed, logging in again")
+            self._request_token({'grant_type': 'password',
+                                 'username': self.username,
+                                 'password': self.password})
+            return self.tokens['access_token']
+
+    def _request_token(self, data: dict):
+        data.update({'client_id': self.client_id})
+        requested_at = time.monotonic()
+        try:
+            with span('token', grant=data['grant_type']):
+                r = self.session.post(self.token_url, data=data)
+                r.raise_for_status()
+                tokens = r.json()
+        except Exception as e:
+            log.exception(f"Access token creation failed: {e}")
+            raise OperatorInteractionException(
+                'CopernicusHub access token creation failed. Please check the account credentials') from e
+        self.tokens = tokens
+        self.expires_at = requested_at + float(tokens.get('expires_in', 600))
+        self.refresh_expires_at = requested_at + float(tokens.get('refresh_expires_in', 0))
+
+
+class BearerAuth(requests.auth.AuthBase):
+    """Attach a fresh bearer token to every request, including each redirect hop."""
+    def __init__(self, token_manager: TokenManager):
+        self.token_manager = token_manager
+
+    def __call__(self, r):
+        r.headers['Authorization'] = f"Bearer {self.token_manager.access_token()}"
+        return r
+
+
+def build_session(token_manager: Optional[TokenManager] = None,
+                  pool_size: int = 8,
+                  retries: int = 5,
+                  backoff_factor: float = 1.0) -> requests.Session:
+    """Long-lived keep-alive session with a bounded connection pool and exponential backoff.
+
+    429/503 responses are retried after the delay given by their Retry-After header.
+    """
+    retry = Retry(total=retries,
+                  backoff_factor=backoff_factor,
+                  status_forcelist=(429, 500, 502, 503, 504),
+                  allowed_methods=frozenset(['GET', 'HEAD', 'POST']),
+                  respect_retry_after_header=True,
+                  raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry, pool_block=True)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    if token_manager is not None:
+        session.auth = BearerAuth(token_manager)
+    # Requests, retries and redirects are counted into the spans of the calling thread
+    session.hooks['response'].append(METRICS.on_response)
+    return session
@@ -0,0 +1,74 @@
+"""
+ Spatial index of the Sentinel-2 tile grid
+"""
+import logging
+from functools import lru_cache
+from typing import List, Optional
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from shapely import STRtree
+
+log = logging.getLogger(__name__)
+
+ID_COLUMNS = ['tile_id', 'Name', 'name', 'TILE_ID', 'tile']
+
+
+def coverage_ratio(footprints: np.ndarray, aoi: shapely.Geometry) -> np.ndarray:
+    """Part of the AOI covered by each footprint, computed over the whole array at once"""
+    return shapely.area(shapely.intersection(footprints, aoi)) / aoi.area
+
+
+class TileIndex():
+    """STRtree over the global S2 tile grid to find the MGRS tiles of AOIs locally"""
+    def __init__(self, tiles: gpd.GeoDataFrame, id_column: Optional[str] = None):
+        if id_column is None:
+            id_column = next((c for c in ID_COLUMNS if c in tiles.columns), None)
+            if id_column is None:
+                raise ValueError(f"No tile id column in the tile grid, expected one of {ID_COLUMNS}")
+        self.tile_ids = tiles[id_column].astype(str).to_numpy()
+        self.geometries = tiles.geometry.to_numpy()
+        self.crs = tiles.crs
+        self.tree = STRtree(self.geometries)
+
+    @classmethod
+    def from_file(cls, path: str, id_column: Optional[str] = None, crs: str = 'epsg:4326') -> 'TileIndex':
+        if path.endswith('.csv'):
+            tiles = pd.read_csv(path)
+            tiles = gpd.GeoDataFrame(tiles, geometry=shapely.from_wkt(tiles['geometry'].to_numpy()), crs=crs)
+        else:
+            tiles = gpd.read_file(path)
+            if tiles.crs is not None and tiles.crs != crs:
+                tiles = tiles.to_crs(crs)
+        return cls(tiles, id_column=id_column)
+
+    def query(self, aoi: shapely.Geometry) -> List[str]:
+        """Tile ids intersecting the AOI"""
+        return self.tile_ids[self.tree.query(aoi, predicate='intersects')].tolist()
+
+    def query_bulk(self, aois) -> pd.DataFrame:
+        """(aoi, tile_id) pairs of all intersecting AOIs and tiles"""
+        aoi_idx, tile_idx = self.tree.query(np.asarray(aois), predicate='intersects')
+        return pd.DataFrame({'aoi': aoi_idx, 'tile_id': self.tile_ids[tile_idx]})
+
+    def geometry(self, tile_ids: List[str]) -> np.ndarray:
+        """Geometries of tile ids, None for unknown tiles"""
+        lookup = pd.Series(self.geometries, index=self.tile_ids)
+        lookup = lookup[~lookup.index.duplicated()]
+        return lookup.reindex([str(t) for t in tile_ids]).to_numpy()
+
+    def areas(self, aoi_gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+        """Area descriptor with one row per AOI and intersecting tile"""
+        aoi_gdf = aoi_gdf.to_crs(self.crs) if aoi_gdf.crs is not None and aoi_gdf.crs != self.crs else aoi_gdf
+        pairs = self.query_bulk(aoi_gdf.geometry.to_numpy())
+        areas = aoi_gdf.iloc[pairs['aoi'].to_numpy()].reset_index(drop=True)
+        areas['tile_id'] = pairs['tile_id'].to_numpy()
+        return areas
+
+
+@lru_cache(maxsize=4)
+def load_tile_index(path: str, id_column: Optional[str] = None) -> TileIndex:
+    """Tile index of a grid file, loaded once per process"""
+    log.info(f"Loading S2 tile grid {path}")
+    return TileIndex.from_file(path, id_column=id_column)
@@ -0,0 +1,221 @@
+"""
+ Concurrent transfer of product files
+"""
+import io
+import os
+import time
+import fcntl
+import hashlib
+import logging
+from pathlib import Path
+from contextlib import contextmanager
+from typing import BinaryIO, Callable, Dict, List, Optional, Tuple
+from urllib.parse import urljoin
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import requests
+from tqdm import tqdm
+from code.exception import OperatorInteractionException
+from code.metrics import span
+
+log = logging.getLogger(__name__)
+
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+MAX_REDIRECTS = 10
+
+
+def follow_redirects(session:requests.Session, url:str, **kwargs)->requests.Response:
+    """Send a GET request and follow the 30x chain by hand so every hop keeps the bearer token."""
+    for _ in range(MAX_REDIRECTS):
+        response = session.get(url, allow_redirects=False, **kwargs)
+        if response.status_code not in REDIRECT_CODES:
+            return response
+        url = urljoin(url, response.headers["Location"])
+        response.close()
+    raise OperatorInteractionException(f"Too many redirects while requesting {url}")
+
+
+def _range_total(response:requests.Response)->Optional[int]:
+    """Total size of the remote file in the Content-Range of a 206 or 416 response"""
+    content_range = response.headers.get('Content-Range')
+    if content_range and '/' in content_range and not content_range.endswith('*'):
+        return int(content_range.rsplit('/', 1)[-1])
+    return None
+
+
+def _expected_size(response:requests.Response, offset:int)->Optional[int]:
+    total = _range_total(response)
+    if total is not None:
+        return total
+    if response.headers.get('Content-Length') is not None:
+        return offset + int(response.headers['Content-Length'])
+    return None
+
+
+def _md5(path:Path, chunk_size:int)->str:
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+@contextmanager
+def _file_lock(path:Path):
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def download_file(get_session:Callable[[], requests.Session], url:str, output_file:str,
+                  chunk_size:int=1024*1024, checksum:Optional[str]=None, max_resumes:int=3)->Dict:
+    """Download url into output_file through a `.part` file that is resumed with HTTP Range requests.
+
+    The finished file is checked against the Content-Length and, when given, its MD5 checksum.
+    Concurrent downloads of the same output_file (threads or processes) are serialised by a lock
+    on `<file>.lock`, the later ones find the finished file and do not download it again.
+    """
+    output_file = Path(output_file)
+    output_file.parent.mkdir(parents=True, exist_ok=True)
+    with span('transfer', file=output_file.name) as record, \
+            _file_lock(output_file.with_name(output_file.name + '.lock')):
+        start = time.perf_counter()
+        if output_file.exists() and (checksum is None or _md5(output_file, chunk_size) == checksum.lower()):
+            log.info(f"{output_file.name} was downloaded by a concurrent transfer")
+            return {'file': output_file.name, 'path': str(output_file), 'bytes': 0, 'seconds': 0.0, 'mbps': 0.0}
+        part_file = output_file.with_name(output_file.name + '.part')
+        nbytes = 0
+        for attempt in range(max_resumes + 1):
+            offset = part_file.stat().st_size if part_file.exists() else 0
+            headers = {'Range': f"bytes={offset}-"} if offset > 0 else {}
+            try:
+                response = follow_redirects(get_session(), url, stream=True, headers=headers)
+                with response:
+                    if response.status_code == 416 and _range_total(response) == offset:
+                        # The part file already holds the whole content
+                        expected = offset
+                    elif response.status_code == 416:
+                        # The part file is longer than the remote file (stale or changed), start over
+                        part_file.unlink()
+                        if attempt == max_resumes:
+                            raise OperatorInteractionException(f"Range of {output_file.name} not satisfiable")
+                        log.info(f"Part file of {output_file.name} does not match the remote file, restarting")
+                        continue
+                    else:
+                        response.raise_for_status()
+                        if response.status_code != 206:
+                            offset = 0
+                        expected = _expected_size(response, offset)
+                        with open(part_file, 'ab' if offset > 0 else 'wb') as output_img:
+                            for chunk in response.iter_content(chunk_size=chunk_size):
+                                if chunk:
+                                    output_img.write(chunk)
+                                    nbytes += len(chunk)
+                break
+            except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError) as e:
+                if attempt == max_resumes:
+                    raise
+                log.info(f"Connection dropped while downloading {output_file.name}, resuming: {e}")
+
+        size = part_file.stat().st_size
+        if expected is not None and size != expected:
+            raise OperatorInteractionException(f"Incomplete download of {output_file.name}: {size} of {expected} bytes")
+        if checksum is not None and _md5(part_file, chunk_size) != checksum.lower():
+            part_file.unlink()
+            raise OperatorInteractionException(f"Checksum mismatch for {output_file.name}")
+        os.replace(part_file, output_file)
+
+        seconds = time.perf_counter() - start
+        stats = {'file': output_file.name,
+                 'path': str(output_file),
+                 'bytes': nbytes,
+                 'seconds': seconds,
+                 'mbps': nbytes / 1e6 / seconds if seconds > 0 else 0.0}
+        record.update({'bytes_read': nbytes, 'bytes_written': size})
+        log.info(f"Downloaded {stats['file']}: {nbytes / 1e6:.1f} MB in {seconds:.1f} s ({stats['mbps']:.1f} MB/s)")
+    return stats
+
+
+def download_stream(get_session:Callable[[], requests.Session], url:str,
+                    open_output:Callable[[Optional[int]], BinaryIO], chunk_size:int=1024*1024,
+                    max_resumes:int=3)->BinaryIO:
+    """Download url into the file object returned by open_output, resumed with HTTP Range requests
+    after a dropped connection.
+
+    open_output is called once with the expected size (None when the server does not send it)
+    before any byte is read, so the caller can reserve memory or pick a file. The chunks are
+    written straight into it, a restarted download seeks it to 0 and truncates it.
+    """
+    with span('transfer', file=url.rsplit('/', 2)[-2] if url.endswith('/$value') else url) as record:
+        start = time.perf_counter()
+        output, written, expected = None, 0, None
+        for attempt in range(max_resumes + 1):
+            headers = {'Range': f"bytes={written}-"} if written > 0 else {}
+            try:
+                response = follow_redirects(get_session(), url, stream=True, headers=headers)
+                with response:
+                    if response.status_code == 416 and _range_total(response) == written:
+                        expected = written
+                    elif response.status_code == 416:
+                        output.seek(0)
+                        output.truncate()
+                        written = 0
+                        if attempt == max_resumes:
+                            raise OperatorInteractionException(f"Range of {url} not satisfiable")
+                        continue
+                    else:
+                        response.raise_for_status()
+                        if response.status_code != 206 and written > 0:
+                            output.seek(0)
+                            output.truncate()
+                            written = 0
+                        expected = _expected_size(response, written)
+                        if output is None:
+                            output = open_output(expected)
+                        for chunk in response.iter_content(chunk_size=chunk_size):
+                            if chunk:
+                                output.write(chunk)
+                                written += len(chunk)
+                break
+            except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError) as e:
+                if attempt == max_resumes:
+                    raise
+                log.info(f"Connection dropped while downloading {url}, resuming: {e}")
+        if expected is not None and written != expected:
+            raise OperatorInteractionException(f"Incomplete download of {url}: {written} of {expected} bytes")
+        seconds = time.perf_counter() - start
+        record['bytes_read'] = written
+        log.info(f"Downloaded {written / 1e6:.1f} MB in {seconds:.1f} s "
+                 f"({written / 1e6 / max(seconds, 1e-9):.1f} MB/s)")
+    return output
+
+
+def download_bytes(get_session:Callable[[], requests.Session], url:str, chunk_size:int=1024*1024,
+                   max_resumes:int=3)->bytes:
+    """Download url into memory, resumed with HTTP Range requests after a dropped connection."""
+    buffer = io.BytesIO()
+    download_stream(get_session, url, lambda size: buffer, chunk_size, max_resumes)
+    return buffer.getvalue()
+
+
+def download_files(get_session:Callable[[], requests.Session], jobs:List[Tuple],
+                   max_workers:int=4, chunk_size:int=1024*1024)->List[Dict]:
+    """Download (url, output_file[, md5]) jobs with at most max_workers concurrent transfers."""
+    start = time.perf_counter()
+    results = []
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futures = {executor.submit(download_file, get_session, job[0], job[1], chunk_size, *job[2:]): job[1]
+                   for job in jobs}
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                log.info(f"Download of {Path(futures[future]).name} failed: {e}")
+    seconds = time.perf_counter() - start
+    nbytes = sum(r['bytes'] for r in results)
+    if results:
+        log.info(f"Downloaded {len(results)}/{len(jobs)} files: {nbytes / 1e6:.1f} MB in {seconds:.1f} s "
+                 f"({nbytes / 1e6 / max(seconds, 1e-9):.1f} MB/s aggregate)")
+    return results
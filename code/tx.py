@@ -3,26 +3,91 @@
 """
 import shutil
 import os
+import math
 import pathlib
 import logging
-from typing import List
+import threading
+from functools import lru_cache
+from typing import Dict, List, Tuple
 import glob
 import uuid
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import geopandas as gpd
 import rasterio
+import rasterio.shutil
+from affine import Affine
 from rasterio.mask import mask
 from rasterio.merge import merge
-from rasterio.warp import calculate_default_transform, reproject, Resampling
+from rasterio.warp import calculate_default_transform, transform_bounds, Resampling
+from rasterio.crs import CRS
+from rasterio.features import geometry_mask, geometry_window
+from rasterio.vrt import WarpedVRT
+from rasterio.windows import Window, from_bounds, bounds as window_bounds, transform as window_transform
+from code.metrics import span, timed
 
 log = logging.getLogger(__name__)
 
+# Reflectance 0..10000 mapped to 0..255, precomputed for every uint16 value
+S2_UINT8_LUT = (np.clip(np.arange(65536, dtype=np.float64)/10000, 0, 1)*255).astype(np.uint8)
+
 def normilize_s2(arr:np.array)->np.array:
-    new_arr = np.clip(arr/10000, 0, 1)
-    new_arr = new_arr*255
+    if arr.dtype == np.uint16:
+        return S2_UINT8_LUT[arr]
+    new_arr = arr.astype(np.float32)
+    new_arr /= 10000
+    np.clip(new_arr, 0, 1, out=new_arr)
+    new_arr *= 255
     return new_arr.astype(np.uint8)
 
-def clip_by_polygon(input_img:str, gdf_bbox:gpd.GeoDataFrame, output_img:str)->str:
+# Creation options of the output GeoTIFFs: plain 'gtiff' or cloud-optimized 'cog'
+OUTPUT_PROFILES = {
+    'gtiff': {'creation': {}, 'overviews': []},
+    'cog': {'creation': {'tiled': True, 'blockxsize': 512, 'blockysize': 512, 'compress': 'deflate',
+                         'predictor': 2, 'num_threads': 'ALL_CPUS', 'bigtiff': 'IF_SAFER'},
+            'overviews': [2, 4, 8, 16], 'overview_resampling': 'average'},
+}
+
+def build_profile(profile:str='gtiff', compress:str=None, predictor:int=None, blocksize:int=None,
+                  num_threads=None, overviews:List[int]=None, overview_resampling:str=None)->Dict:
+    """Output profile from OUTPUT_PROFILES with the given options overriding its defaults"""
+    if profile not in OUTPUT_PROFILES:
+        raise ValueError(f"Unknown output profile {profile}, expected one of {list(OUTPUT_PROFILES)}")
+    out = {'creation': dict(OUTPUT_PROFILES[profile]['creation']),
+           'overviews': list(OUTPUT_PROFILES[profile]['overviews']),
+           'overview_resampling': OUTPUT_PROFILES[profile].get('overview_resampling', 'nearest')}
+    options = {'compress': compress, 'predictor': predictor, 'num_threads': num_threads}
+    out['creation'].update({k: v for k, v in options.items() if v is not None})
+    if blocksize is not None:
+        out['creation'].update({'tiled': True, 'blockxsize': blocksize, 'blockysize': blocksize})
+    if overviews is not None:
+        out['overviews'] = list(overviews)
+    if overview_resampling is not None:
+        out['overview_resampling'] = overview_resampling
+    return out
+
+DEFAULT_PROFILE = build_profile('gtiff')
+
+def profile_meta(meta:Dict, profile:Dict=None)->Dict:
+    """Update the raster meta with the creation options of the output profile"""
+    creation = dict((profile or DEFAULT_PROFILE)['creation'])
+    if creation.get('predictor') == 2 and np.dtype(meta['dtype']).kind == 'f':
+        # Floating point predictor for float rasters
+        creation['predictor'] = 3
+    meta.update(creation)
+    return meta
+
+def build_overviews(dest:rasterio.io.DatasetWriter, profile:Dict=None):
+    profile = profile or DEFAULT_PROFILE
+    factors = [f for f in profile['overviews'] if min(dest.width, dest.height) // f >= 1]
+    if len(factors) > 0:
+        resampling = Resampling[profile['overview_resampling']]
+        dest.build_overviews(factors, resampling)
+        dest.update_tags(ns='rio_overview', resampling=resampling.name)
+
+@timed('clip')
+def clip_by_polygon(input_img:str, gdf_bbox:gpd.GeoDataFrame, output_img:str, profile:Dict=None)->str:
     with rasterio.open(input_img) as src:
         clip_image, out_transform = mask(src, gdf_bbox.geometry, crop=True)
         out_meta = src.meta.copy()
@@ -30,47 +95,269 @@ def clip_by_polygon(input_img:str, gdf_bbox:gpd.GeoDataFrame, output_img:str)->s
                          "height": clip_image.shape[1],
                          "width": clip_image.shape[2],
                          "transform": out_transform})
-        with rasterio.open(output_img, "w+", **out_meta) as dest:
+        with rasterio.open(output_img, "w+", **profile_meta(out_meta, profile)) as dest:
             dest.write(clip_image)
+            build_overviews(dest, profile)
+    return output_img
+
+@timed('window')
+def clip_by_bounds(input_img:str, bounds:Tuple, output_img:str, indexes:List[int]=None, bounds_crs:str='epsg:4326',
+                   min_valid:float=0.0, profile:Dict=None)->str:
+    """Write the window of bounds (in bounds_crs) of the bands indexes of a raster, reading nothing else.
+
+    Returns None without writing when less than min_valid of the window holds data.
+    """
+    with rasterio.open(input_img) as src:
+        window = from_bounds(*transform_bounds(bounds_crs, src.crs, *bounds), transform=src.transform)
+        window = window.round_offsets().round_lengths().intersection(Window(0, 0, src.width, src.height))
+        indexes = indexes or list(src.indexes)
+        if min_valid > 0 and (src.read_masks(indexes[0], window=window) > 0).mean() < min_valid:
+            return None
+        out_meta = src.meta.copy()
+        out_meta.update({"driver": "GTiff",
+                         "count": len(indexes),
+                         "height": int(window.height),
+                         "width": int(window.width),
+                         "transform": src.window_transform(window)})
+        tmp_img = part_path(output_img)
+        with rasterio.open(tmp_img, "w", **profile_meta(out_meta, profile)) as dest:
+            dest.write(src.read(indexes, window=window))
+            build_overviews(dest, profile)
+        commit_part(tmp_img, output_img)
+    return output_img
+
+def read_on_grid(src:rasterio.DatasetReader, bounds, shape, resampling=Resampling.nearest)->np.array:
+    """Read the band over bounds resampled to shape, boundless (through a VRT) only for blocks crossing the band edge"""
+    window = from_bounds(*bounds, transform=src.transform)
+    outside = window.col_off < 0 or window.row_off < 0 or \
+        window.col_off + window.width > src.width + 1e-6 or window.row_off + window.height > src.height + 1e-6
+    return src.read(1, window=window, out_shape=shape, resampling=resampling, boundless=outside, fill_value=0)
+
+def _read_block(src:rasterio.DatasetReader, window:Window, normalize, transform=None,
+                resampling=Resampling.nearest)->np.array:
+    """Read a block of the output grid, bands of another resolution are resampled within the read.
+
+    normalize is a bool for the UINT8 lookup table or the radiometric mapping of the band.
+    """
+    if transform is None or src.transform.almost_equals(transform):
+        block = src.read(1, window=window)
+    else:
+        block = read_on_grid(src, window_bounds(window, transform), (int(window.height), int(window.width)),
+                             resampling)
+    if callable(normalize):
+        return normalize(block)
+    return normilize_s2(block) if normalize else block
+
+def band_name(path:str)->str:
+    """Band of a band file named `{band}_...`"""
+    return pathlib.Path(path).name.split('_')[0]
+
+# Categorical bands (class codes): never normalized and always resampled with nearest
+CLASS_BANDS = ('SCL',)
+
+def band_resampling(path:str, resampling)->Resampling:
+    """Resampling of a band, nearest for the class bands"""
+    if band_name(path) in CLASS_BANDS:
+        return Resampling.nearest
+    return Resampling[resampling] if isinstance(resampling, str) else resampling
+
+def _cast(dtype):
+    return lambda block: block.astype(dtype, copy=False)
+
+def band_normalizers(imgs:List[str], srcs:List[rasterio.DatasetReader], normalize:bool, radiometry,
+                      meta_out:Dict, src_offsets:Dict[str, int]=None)->List:
+    """Per-band mapping of the blocks (radiometric stage, UINT8 lookup table or none), meta_out gets its dtype.
+
+    Class bands keep their codes, only cast to the output dtype. src_offsets are the BOA offsets
+    already applied to the blocks, see `Radiometry.mapping`.
+    """
+    if radiometry is not None:
+        meta_out.update({'dtype': radiometry.dtype, 'nodata': radiometry.out_nodata})
+        normalizers = [radiometry.mapping(band_name(img), src, (src_offsets or {}).get(band_name(img), 0))
+                       if band_name(img) not in CLASS_BANDS else None for img, src in zip(imgs, srcs)]
+    else:
+        if normalize:
+            meta_out.update({'dtype': 'uint8'})
+        normalizers = [normalize] * len(srcs)
+    return [_cast(meta_out['dtype']) if band_name(img) in CLASS_BANDS else norm
+            for img, norm in zip(imgs, normalizers)]
+
+def finest_band(srcs:List[rasterio.DatasetReader])->rasterio.DatasetReader:
+    """Band defining the output grid of bands of mixed resolutions"""
+    return min(srcs, key=lambda src: abs(src.res[0]))
+
+def output_grid(srcs:List[rasterio.DatasetReader], resolution:float=None)->Tuple:
+    """Transform, width and height of the output grid: the grid of the finest band, coarsened to
+    resolution when its pixels are finer (e.g. B08, only delivered at 10 m, in a 20 m output)"""
+    ref = finest_band(srcs)
+    if resolution is None or abs(ref.res[0]) >= resolution:
+        return ref.transform, ref.width, ref.height
+    factor = resolution / abs(ref.res[0])
+    return ref.transform * Affine.scale(factor), math.ceil(ref.width / factor - 1e-6), \
+        math.ceil(ref.height / factor - 1e-6)
+
+def _snap(window:Window)->Window:
+    """Window extended to whole pixels"""
+    col, row = math.floor(window.col_off + 1e-6), math.floor(window.row_off + 1e-6)
+    return Window(col, row, math.ceil(window.col_off + window.width - 1e-6) - col,
+                  math.ceil(window.row_off + window.height - 1e-6) - row)
+
+@timed('stack')
+def band_stack(imgs: List[str], output_img:str, normalize:bool=False, block_size:int=1024, num_threads:int=4,
+               profile:Dict=None, resampling:str='nearest', radiometry=None, grid_resolution:float=None):
+    """Stack the bands block by block, peak memory is bounded by block_size and not by the scene size.
+
+    The bands of a block are decoded in parallel threads, GDAL releases the GIL while decoding.
+    The output grid is the one of the finest band (coarsened to grid_resolution), the other bands
+    are resampled while reading. A Radiometry maps the blocks of each band in place of normalize.
+    """
+    with ExitStack() as stack:
+        srcs = [stack.enter_context(rasterio.open(band)) for band in imgs]
+        ref = finest_band(srcs)
+        transform, width, height = output_grid(srcs, grid_resolution)
+        meta_out = ref.meta.copy()
+        meta_out.update({'driver':'GTiff', 'count':len(imgs), 'transform': transform, 'width': width, 'height': height,
+                         'tiled': True, 'blockxsize': block_size, 'blockysize': block_size})
+        normalizers = band_normalizers(imgs, srcs, normalize, radiometry, meta_out)
+        with rasterio.open(output_img, 'w', **profile_meta(meta_out, profile)) as dest, \
+                ThreadPoolExecutor(max_workers=max(1, num_threads)) as executor:
+            for _, window in dest.block_windows(1):
+                blocks = executor.map(lambda src, img, norm: _read_block(src, window, norm, transform,
+                                                                         band_resampling(img, resampling)),
+                                      srcs, imgs, normalizers)
+                for band_nr, block in enumerate(blocks, start=1):
+                    dest.write(block, band_nr, window=window)
+            build_overviews(dest, profile)
     return output_img
 
-def band_stack(imgs: List[str], output_img:str, normalize:bool=False):
-    meta_out = rasterio.open(imgs[0]).meta.copy()
-    meta_out.update({'driver':'GTiff', 'count':len(imgs)})
-    with rasterio.open(output_img, 'w+', **meta_out) as dest:
-        for band_nr, band in enumerate(imgs, start=1):
-            with rasterio.open(band) as src_bnd:
-                if normalize:
-                    dest.write(normilize_s2(src_bnd.read(1)), band_nr)
-                else:
-                    dest.write(src_bnd.read(1), band_nr)
+@timed('fused')
+def fused_stack(imgs: List[str], output_img:str, normalize:bool=False, gdf:gpd.GeoDataFrame=None,
+                dst_crs:str=None, block_size:int=1024, num_threads:int=4, profile:Dict=None,
+                resampling:str='nearest', resolution=None, warp_threads:int=1, warp_mem_limit:int=64,
+                radiometry=None, grid_resolution:float=None)->str:
+    """Stack, clip and reproject the bands in a single pass without intermediate GeoTIFFs.
+
+    Only the bounding window of the polygons is read from the bands, a WarpedVRT per band warps it
+    to dst_crs on the fly, and the output is written once next to output_img and renamed into place.
+    Bands coarser than the finest one are resampled to its grid within the same reads, the warp
+    options are the ones of `reproject_to_wgs84`, radiometry and grid_resolution the ones of `band_stack`.
+    """
+    with ExitStack() as stack:
+        srcs = [stack.enter_context(rasterio.open(band)) for band in imgs]
+        ref = finest_band(srcs)
+        grid, grid_width, grid_height = output_grid(srcs, grid_resolution)
+        window = Window(0, 0, grid_width, grid_height)
+        if gdf is not None:
+            window = geometry_window(ref, gdf.to_crs(ref.crs).geometry)
+            if grid != ref.transform:
+                window = _snap(from_bounds(*window_bounds(window, ref.transform), transform=grid)).intersection(
+                    Window(0, 0, grid_width, grid_height))
+        crs, transform = ref.crs, window_transform(window, grid)
+        width, height = int(window.width), int(window.height)
+        readers, offset = srcs, window
+        if dst_crs is not None and CRS.from_user_input(dst_crs) != ref.crs:
+            crs = CRS.from_user_input(dst_crs)
+            transform, width, height = warp_grid(ref.crs, crs, width, height, window_bounds(window, grid), resolution)
+            readers = [stack.enter_context(WarpedVRT(src, crs=crs, transform=transform, width=width, height=height,
+                                                     resampling=band_resampling(img, resampling),
+                                                     warp_mem_limit=warp_mem_limit, num_threads=warp_threads))
+                       for src, img in zip(srcs, imgs)]
+            offset, grid = Window(0, 0, width, height), transform
+        shapes = list(gdf.to_crs(crs).geometry) if gdf is not None else None
+        meta_out = ref.meta.copy()
+        meta_out.update({'driver': 'GTiff', 'count': len(imgs), 'crs': crs, 'transform': transform,
+                         'width': width, 'height': height,
+                         'tiled': True, 'blockxsize': block_size, 'blockysize': block_size})
+        normalizers = band_normalizers(imgs, srcs, normalize, radiometry, meta_out)
+        nodata = meta_out['nodata'] if meta_out.get('nodata') is not None else 0
+        tmp_img = part_path(output_img)
+        with rasterio.open(tmp_img, 'w', **profile_meta(meta_out, profile)) as dest, \
+                ThreadPoolExecutor(max_workers=max(1, num_threads)) as executor:
+            for _, out_window in dest.block_windows(1):
+                src_window = Window(out_window.col_off + offset.col_off, out_window.row_off + offset.row_off,
+                                    out_window.width, out_window.height)
+                blocks = executor.map(lambda reader, img, norm: _read_block(reader, src_window, norm, grid,
+                                                                            band_resampling(img, resampling)),
+                                      readers, imgs, normalizers)
+                inside = None
+                if shapes is not None:
+                    inside = geometry_mask(shapes, out_shape=(int(out_window.height), int(out_window.width)),
+                                           transform=dest.window_transform(out_window), invert=True)
+                for band_nr, block in enumerate(blocks, start=1):
+                    if inside is not None:
+                        block = np.where(inside, block, np.array(nodata).astype(block.dtype))
+                    dest.write(block, band_nr, window=out_window)
+            build_overviews(dest, profile)
+        commit_part(tmp_img, output_img)
     return output_img
 
-def reproject_to_wgs84(input_img:str, output_img:str, dst_crs:str='epsg:4326')-> str:
+def warp_grid(src_crs, dst_crs, width:int, height:int, bounds:Tuple, resolution=None)->Tuple:
+    """Transform, width and height of the dst_crs grid covering bounds, of the given resolution in dst_crs units.
+
+    Grids are cached per process: repeat dates of a tile share its source grid and skip the computation.
+    """
+    if resolution is not None and not isinstance(resolution, (int, float)):
+        resolution = tuple(resolution)
+    return _warp_grid(CRS.from_user_input(src_crs).to_string(), CRS.from_user_input(dst_crs).to_string(),
+                      int(width), int(height), tuple(bounds), resolution)
+
+@lru_cache(maxsize=256)
+def _warp_grid(src_crs:str, dst_crs:str, width:int, height:int, bounds:Tuple, resolution)->Tuple:
+    return calculate_default_transform(src_crs, dst_crs, width, height, *bounds, resolution=resolution)
+
+@timed('reproject')
+def reproject_to_wgs84(input_img:str, output_img:str, dst_crs:str='epsg:4326', profile:Dict=None,
+                       resampling:str='nearest', resolution=None, block_size:int=1024, num_threads:int=4,
+                       warp_threads:int=1, warp_mem_limit:int=64, class_bands:List[int]=None)-> str:
+    """Warp the raster to dst_crs block by block.
+
+    The output blocks are warped in num_threads threads, each reading through its own WarpedVRT of
+    the input, and GDAL warps every block with warp_threads threads within warp_mem_limit MB.
+    The class_bands (1-based indexes) are warped with nearest whatever the resampling.
+    """
+    class_bands = sorted(class_bands or [])
     with rasterio.open(input_img, 'r') as src:
-        transform, width, height = calculate_default_transform(
-            src.crs, dst_crs, src.width, src.height, *src.bounds)
+        transform, width, height = warp_grid(src.crs, dst_crs, src.width, src.height, src.bounds, resolution)
         kwargs = src.meta.copy()
-        kwargs.update({
-            "driver": "GTiff",
-            'crs': dst_crs,
-            'transform': transform,
-            'width': width,
-            'height': height
-        })
-        with rasterio.open(output_img, 'w', **kwargs) as dst:
-            for i in range(1, src.count + 1):
-                reproject(
-                    source=rasterio.band(src, i),
-                    destination=rasterio.band(dst, i),
-                    src_transform=src.transform,
-                    src_crs=src.crs,
-                    dst_transform=transform,
-                    dst_crs=dst_crs,
-                    resampling=Resampling.nearest)
+    kwargs.update({
+        "driver": "GTiff",
+        'crs': dst_crs,
+        'transform': transform,
+        'width': width,
+        'height': height,
+        'tiled': True, 'blockxsize': block_size, 'blockysize': block_size
+    })
+    local, lock = threading.local(), threading.Lock()
+
+    def warp_block(window:Window)->np.ndarray:
+        vrts = getattr(local, 'vrts', None)
+        if vrts is None:
+            with lock:
+                reader = handles.enter_context(rasterio.open(input_img))
+                vrts = local.vrts = [handles.enter_context(
+                    WarpedVRT(reader, crs=dst_crs, transform=transform, width=width, height=height,
+                              resampling=method, warp_mem_limit=warp_mem_limit, num_threads=warp_threads))
+                    for method in (Resampling[resampling], Resampling.nearest)]
+        block = vrts[0].read(window=window)
+        if class_bands:
+            block[[i - 1 for i in class_bands]] = vrts[1].read(class_bands, window=window)
+        return block
+
+    tmp_img = part_path(output_img)
+    with ExitStack() as handles, rasterio.open(tmp_img, 'w', **profile_meta(kwargs, profile)) as dst, \
+            ThreadPoolExecutor(max_workers=max(1, num_threads)) as executor:
+        windows = [window for _, window in dst.block_windows(1)]
+        # Submit a few blocks ahead only, so finished blocks do not pile up in memory
+        step = max(1, num_threads) * 2
+        for i in range(0, len(windows), step):
+            for window, block in zip(windows[i:i + step], executor.map(warp_block, windows[i:i + step])):
+                dst.write(block, window=window)
+        build_overviews(dst, profile)
+    commit_part(tmp_img, output_img)
     return output_img
 
-def mosaic_images(input_imgs:List[str], output_img:str):
+@timed('mosaic')
+def mosaic_images(input_imgs:List[str], output_img:str, profile:Dict=None):
     raster_to_mosaic = [rasterio.open(img) for img in input_imgs]
     mosaic, output = merge(datasets=raster_to_mosaic,
                            resampling=Resampling.bilinear,
@@ -85,19 +372,38 @@ def mosaic_images(input_imgs:List[str], output_img:str):
          "transform": output,
          }
     )
-    with rasterio.open(output_img, "w+", **output_meta) as dest:
+    with rasterio.open(output_img, "w+", **profile_meta(output_meta, profile)) as dest:
         dest.write(mosaic)
+        build_overviews(dest, profile)
     return output_img
 
+def part_path(output_img:str)->str:
+    """Temporary name of an output renamed into place once written, /vsimem/ outputs are written in place"""
+    return output_img if output_img.startswith('/vsimem/') else f"{output_img}.part"
+
+def commit_part(tmp_img:str, output_img:str):
+    if tmp_img != output_img:
+        os.replace(tmp_img, output_img)
+
 def copy_remote(local_path:str, remote_path:str):
     try:
-        shutil.copyfile(local_path, remote_path)
+        with span('copy') as record:
+            # Copy under a temporary name so an interrupted run never leaves a truncated output
+            if local_path.startswith('/vsimem/'):
+                rasterio.shutil.copyfiles(local_path, f"{remote_path}.part")
+            else:
+                shutil.copyfile(local_path, f"{remote_path}.part")
+            os.replace(f"{remote_path}.part", remote_path)
+            record['bytes_written'] = os.path.getsize(remote_path)
     except Exception as e:
         log.exception(f"Failed to upload file to SDS: {e}")
 
 class Tx():
     def __init__(self, sample:List[str], uuid, local_dir,
-                 tile:str, date: str, format:str, reproject_4326:bool=False):
+                 tile:str, date: str, format:str, reproject_4326:bool=False,
+                 block_size:int=1024, num_threads:int=4, fused:bool=True, profile:Dict=None,
+                 sink=None, metadata:Dict=None, store=None, resampling:str='nearest', warp:Dict=None,
+                 index=None, radiometry=None, grid_resolution:float=None):
         self.sample = sample
         self.bands = len(sample)
         self.tile = tile
@@ -106,18 +412,86 @@ class Tx():
         self.format = format
         self.cache = local_dir
         self.wgs84 = reproject_4326
+        self.block_size = block_size
+        self.num_threads = num_threads
+        self.fused = fused
+        self.profile = profile or DEFAULT_PROFILE
+        # Optional sink (e.g. ZarrCubeSink) replacing the `{uuid}.tif` output, with the product metadata
+        self.sink = sink
+        self.metadata = metadata or {'uuid': self.uuid, 'product_date': date}
+        # Resampling of the bands coarser than the output grid
+        self.resampling = resampling
+        # Optional MemoryStore holding the intermediate rasters in /vsimem/ instead of tempfolder
+        self.store = store
+        # Options of the reprojection to EPSG:4326: resolution, warp_threads and warp_mem_limit
+        self.warp = dict(warp or {})
+        # Optional RasterIndex of the cache updated with every `{uuid}.tif` output
+        self.index = index
+        # Optional Radiometry mapping the bands in place of the UINT8 normalisation of format
+        self.radiometry = radiometry
+        # Resolution in metres of the output grid, finer bands are resampled to it
+        self.grid_resolution = grid_resolution
+
+    @property
+    def class_bands(self)->List[int]:
+        """Indexes of the class bands (e.g. SCL) in the stacked rasters"""
+        return [i + 1 for i, band in enumerate(self.sample) if band_name(band) in CLASS_BANDS]
+
+    def _temp_img(self, tempfolder:str, name:str)->str:
+        if self.store is None:
+            return os.path.join(tempfolder, name)
+        with ExitStack() as stack:
+            _, width, height = output_grid([stack.enter_context(rasterio.open(band)) for band in self.sample],
+                                           self.grid_resolution)
+            itemsize = np.dtype(self.radiometry.dtype).itemsize if self.radiometry is not None else \
+                (1 if self.format == 'UINT8' else 2)
+            size = width * height * self.bands * itemsize
+        return self.store.path(name, size)
+
+    def _output_img(self, tempfolder:str)->str:
+        if self.sink is not None:
+            return self._temp_img(tempfolder, f'{self.uuid}.tif')
+        return os.path.join(self.cache, f'{self.uuid}.tif')
+
+    def _publish(self, local_img:str):
+        self.output = local_img
+        if self.sink is not None:
+            # The output holds the bands in the order of the sample
+            self.sink.append(self.tile, local_img, self.metadata, bands=[band_name(band) for band in self.sample])
+            return
+        if local_img != os.path.join(self.cache, f'{self.uuid}.tif'):
+            self.output = os.path.join(self.cache, f'{self.uuid}.tif')
+            copy_remote(local_img, self.output)
+        if self.index is not None:
+            # The output holds the bands in the order of the sample
+            self.index.add(self.output, self.metadata, bands=[band_name(band) for band in self.sample])
 
     def etl_process_tile(self, tempfolder:str):
         if self.format == 'UINT8':
             norm_img = True
         else:
             norm_img = False
-        self.stack = band_stack(imgs=self.sample, output_img=os.path.join(tempfolder, f'{self.tile}_{self.date}.tif'), normalize=norm_img)
+        if self.fused:
+            self.output = fused_stack(imgs=self.sample, output_img=self._output_img(tempfolder),
+                                      normalize=norm_img, dst_crs='epsg:4326' if self.wgs84 else None,
+                                      block_size=self.block_size, num_threads=self.num_threads,
+                                      profile=self.profile, resampling=self.resampling,
+                                      radiometry=self.radiometry, grid_resolution=self.grid_resolution,
+                                      **self.warp)
+            self._publish(self.output)
+            return
+        self.stack = band_stack(imgs=self.sample, output_img=self._temp_img(tempfolder, f'{self.tile}_{self.date}.tif'),
+                                normalize=norm_img, block_size=self.block_size, num_threads=self.num_threads,
+                                profile=self.profile, resampling=self.resampling, radiometry=self.radiometry,
+                                grid_resolution=self.grid_resolution)
         if self.wgs84:
-            self.wgs84 = reproject_to_wgs84(self.stack, os.path.join(tempfolder, pathlib.Path(self.stack).name))
-            copy_remote(self.wgs84, os.path.join(self.cache, f'{self.uuid}.tif'))
+            self.wgs84 = reproject_to_wgs84(self.stack, self._temp_img(tempfolder, f'{self.tile}_{self.date}_wgs84.tif'),
+                                            profile=self.profile, resampling=self.resampling,
+                                            block_size=self.block_size, num_threads=self.num_threads,
+                                            class_bands=self.class_bands, **self.warp)
+            self._publish(self.wgs84)
         else:
-            copy_remote(self.stack, os.path.join(self.cache, f'{self.uuid}.tif'))
+            self._publish(self.stack)
 
 
     def etl_process_by_polygon(self, tempfolder:str, gdf:gpd.GeoDataFrame):
@@ -125,20 +499,35 @@ class Tx():
             norm_img = True
         else:
             norm_img = False
-        self.stack = band_stack(imgs=self.sample, output_img=os.path.join(tempfolder, f'{self.tile}_{self.date}.tif'),
-                                normalize=norm_img)
-
-        self.stack = band_stack(imgs=self.sample, output_img=os.path.join(tempfolder, f'{self.tile}_{self.date}.tif'),
-                                normalize=norm_img)
-        self.clip = clip_by_polygon(self.stack, gdf_bbox=gdf,output_img=os.path.join(tempfolder, f'{self.tile}_{self.date}_clip.tif'))
+        if self.fused:
+            self.output = fused_stack(imgs=self.sample, output_img=self._output_img(tempfolder),
+                                      normalize=norm_img, gdf=gdf, dst_crs='epsg:4326' if self.wgs84 else None,
+                                      block_size=self.block_size, num_threads=self.num_threads,
+                                      profile=self.profile, resampling=self.resampling,
+                                      radiometry=self.radiometry, grid_resolution=self.grid_resolution,
+                                      **self.warp)
+            self._publish(self.output)
+            return
+        self.stack = band_stack(imgs=self.sample, output_img=self._temp_img(tempfolder, f'{self.tile}_{self.date}.tif'),
+                                normalize=norm_img, block_size=self.block_size, num_threads=self.num_threads,
+                                profile=self.profile, resampling=self.resampling, radiometry=self.radiometry,
+                                grid_resolution=self.grid_resolution)
+        self.clip = clip_by_polygon(self.stack, gdf_bbox=gdf,output_img=self._temp_img(tempfolder, f'{self.tile}_{self.date}_clip.tif'),
+                                    profile=self.profile)
         if self.wgs84:
-            self.wgs84 = reproject_to_wgs84(self.clip, os.path.join(tempfolder, pathlib.Path(self.stack).name))
-            copy_remote(self.wgs84, os.path.join(self.cache, f'{self.uuid}.tif'))
+            self.wgs84 = reproject_to_wgs84(self.clip, self._temp_img(tempfolder, f'{self.tile}_{self.date}_wgs84.tif'),
+                                            profile=self.profile, resampling=self.resampling,
+                                            block_size=self.block_size, num_threads=self.num_threads,
+                                            class_bands=self.class_bands, **self.warp)
+            self._publish(self.wgs84)
         else:
-            copy_remote(self.clip, os.path.join(self.cache, f'{self.uuid}.tif'))
-
-
-
-
-
+            self._publish(self.clip)
 
+    def etl_process_composite(self, scenes:List[Dict], tempfolder:str, method:str='median'):
+        """Composite of many dates of the tile written to `{uuid}.tif`"""
+        from code.composite import composite
+        self.output = composite(scenes, output_img=self._output_img(tempfolder), method=method,
+                                normalize=self.format == 'UINT8', block_size=self.block_size,
+                                num_threads=self.num_threads, profile=self.profile, resampling=self.resampling,
+                                grid_resolution=self.grid_resolution, radiometry=self.radiometry)
+        self._publish(self.output)